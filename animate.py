@@ -0,0 +1,266 @@
+import argparse
+import shutil
+import subprocess
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from utilities import FaultBinner, FaultStore
+
+# Colors of the page grid
+PADDING_COLOR = (0, 0, 0)
+UNTOUCHED_COLOR = (48, 48, 48)
+MINOR_COLOR = (255, 127, 14)
+MAJOR_COLOR = (31, 119, 180)
+# Pages faulted since the previous frame
+HIGHLIGHT_COLOR = (255, 255, 255)
+
+# Page states, indexes into PAGE_STATE_COLORS
+UNTOUCHED = 0
+MINOR = 1
+MAJOR = 2
+PAGE_STATE_COLORS = np.array([UNTOUCHED_COLOR, MINOR_COLOR, MAJOR_COLOR], np.uint8)
+
+# Black columns between side by side grids
+SEPARATOR_WIDTH = 4
+
+
+class PageGridAnimation:
+    """
+    Grid of the pages of a file, `width` pages per row, lighting up pages as they are faulted. The grid starts at
+    `first_page` of the file, e.g. the first page of a zip entry.
+
+    The raster is updated in place with only the pages faulted since the previous frame, so the cost of a frame does
+    not depend on the size of the file.
+    """
+
+    def __init__(
+        self, binner: FaultBinner, num_pages: int, width: int, first_page: int = 0
+    ):
+        self.binner = binner
+        self.pages = binner.pages - first_page
+        if len(self.pages):
+            num_pages = max(num_pages, int(self.pages.max()) + 1)
+        num_rows = max((num_pages + width - 1) // width, 1)
+        self.shape = (num_rows, width, 3)
+
+        self.raster = np.empty((num_rows * width, 3), np.uint8)
+        self.raster[:] = PADDING_COLOR
+        self.raster[:num_pages] = UNTOUCHED_COLOR
+        self._states = np.full(num_rows * width, UNTOUCHED, np.uint8)
+        # Next fault to draw
+        self._position = 0
+        self._highlighted = np.arange(0)
+
+    def advance(self, ts: float) -> np.ndarray:
+        """
+        Draw the faults up to and including ts
+
+        @returns the raster with shape (rows, width, 3)
+        """
+        # Settle the pages highlighted by the previous frame
+        self.raster[self._highlighted] = PAGE_STATE_COLORS[
+            self._states[self._highlighted]
+        ]
+
+        end = np.searchsorted(self.binner.ts, ts, side="right")
+        pages = self.pages[self._position : end]
+        states = np.where(self.binner.is_major[self._position : end], MAJOR, MINOR)
+        # A page that had a major fault stays major
+        np.maximum.at(self._states, pages, states.astype(np.uint8))
+        self.raster[pages] = HIGHLIGHT_COLOR
+
+        self._highlighted = pages
+        self._position = end
+        return self.raster.reshape(self.shape)
+
+
+def compose(rasters: List[np.ndarray]) -> np.ndarray:
+    """
+    Place grids side by side, aligned to the top
+    """
+    num_rows = max(raster.shape[0] for raster in rasters)
+    frame = []
+    for i, raster in enumerate(rasters):
+        if i:
+            frame.append(np.zeros((num_rows, SEPARATOR_WIDTH, 3), np.uint8))
+        padding = np.zeros((num_rows - raster.shape[0], raster.shape[1], 3), np.uint8)
+        frame.append(np.concatenate([raster, padding]))
+    return np.ascontiguousarray(np.concatenate(frame, axis=1))
+
+
+def find_file(store: FaultStore, file_name: str) -> str:
+    """
+    Match the file by name or suffix (e.g. base.vdex) since install paths differ between runs
+    """
+    matches = [
+        name
+        for name in store.file_names()
+        if name == file_name or name.endswith(file_name)
+    ]
+    if len(matches) != 1:
+        raise ValueError(
+            f"Expected one file matching {file_name}, found: {matches or 'none'}"
+        )
+    return matches[0]
+
+
+def ffmpeg_command(
+    output: str, frame_shape: Tuple[int, int], fps: int, scale: int
+) -> List[str]:
+    height, width = frame_shape
+    filters = f"scale=iw*{scale}:ih*{scale}:flags=neighbor"
+    if output.endswith(".gif"):
+        filters += ",split[a][b];[a]palettegen[p];[b][p]paletteuse"
+        codec = []
+    else:
+        # yuv420p needs even dimensions
+        filters += ",pad=ceil(iw/2)*2:ceil(ih/2)*2"
+        codec = ["-c:v", "libx264", "-pix_fmt", "yuv420p"]
+    return (
+        ["ffmpeg", "-y", "-loglevel", "error"]
+        + ["-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{width}x{height}"]
+        + ["-r", str(fps), "-i", "-", "-vf", filters]
+        + codec
+        + [output]
+    )
+
+
+def render(
+    animations: List[PageGridAnimation],
+    output: str,
+    fps: int,
+    length: float,
+    scale: int,
+):
+    """
+    Stream the frames to ffmpeg which scales them up and encodes the video or GIF
+    """
+    duration = max(
+        (
+            animation.binner.ts[-1]
+            for animation in animations
+            if len(animation.binner.ts)
+        ),
+        default=0,
+    )
+    num_frames = max(int(fps * length), 1)
+    frame_shape = compose(
+        [animation.raster.reshape(animation.shape) for animation in animations]
+    ).shape
+
+    ffmpeg = subprocess.Popen(
+        ffmpeg_command(output, frame_shape[:2], fps, scale), stdin=subprocess.PIPE
+    )
+    try:
+        for i in range(num_frames):
+            ts = duration * (i + 1) / num_frames
+            frame = compose([animation.advance(ts) for animation in animations])
+            ffmpeg.stdin.write(frame.tobytes())
+    finally:
+        ffmpeg.stdin.close()
+        ffmpeg.wait()
+    if ffmpeg.returncode != 0:
+        raise subprocess.CalledProcessError(ffmpeg.returncode, "ffmpeg")
+
+
+def load_animation(
+    output_dir: str,
+    file_name: str,
+    zip_entry_name: Optional[str],
+    include_minor: bool,
+    width: int,
+) -> PageGridAnimation:
+    store = FaultStore.load(output_dir)
+    file_name = find_file(store, file_name)
+    _, file_size, file_offset = store.extract_faults(file_name, zip_entry_name)
+    page_size = store.page_size
+    # Faults are at offsets within the file, zip entries start at the page of their local header
+    first_page = file_offset // page_size if file_offset else 0
+    num_pages = (
+        -(-(file_offset - first_page * page_size + file_size) // page_size)
+        if file_size
+        else 0
+    )
+    print(f"Animating {file_name} from {output_dir}")
+    return PageGridAnimation(
+        store.binner(file_name, zip_entry_name, include_minor),
+        num_pages,
+        width,
+        first_page,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Animate the page faults of a file over startup as a grid of pages"
+    )
+    parser.add_argument(
+        "--base", type=str, required=True, help="Output directory to animate"
+    )
+    parser.add_argument(
+        "--test",
+        type=str,
+        default=None,
+        help="Output directory to animate side by side with the base (default: none)",
+    )
+    parser.add_argument(
+        "--file",
+        type=str,
+        required=True,
+        help="Name or suffix of the file to animate (e.g. base.vdex)",
+    )
+    parser.add_argument(
+        "--zip-entry",
+        type=str,
+        default=None,
+        help="Zip entry of the APK to animate (default: the whole file)",
+    )
+    parser.add_argument(
+        "--include-minor",
+        action="store_true",
+        default=False,
+        help="Include minor page faults (default: false)",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="faults.mp4",
+        help="Output .mp4 or .gif (default: faults.mp4)",
+    )
+    parser.add_argument(
+        "--width",
+        type=int,
+        default=128,
+        help="Pages per row of the grid (default: 128)",
+    )
+    parser.add_argument(
+        "--scale", type=int, default=4, help="Pixels per page (default: 4)"
+    )
+    parser.add_argument(
+        "--fps", type=int, default=30, help="Frames per second (default: 30)"
+    )
+    parser.add_argument(
+        "--length",
+        type=float,
+        default=10,
+        help="Length of the animation in seconds, startup is played back over it (default: 10)",
+    )
+
+    args = parser.parse_args()
+    if shutil.which("ffmpeg") is None:
+        parser.error("ffmpeg is required to encode the animation")
+
+    animations = [
+        load_animation(
+            output_dir, args.file, args.zip_entry, args.include_minor, args.width
+        )
+        for output_dir in [args.base, args.test]
+        if output_dir
+    ]
+    render(animations, args.output, args.fps, args.length, args.scale)
+    print("Animation written to:", args.output)
+
+
+if __name__ == "__main__":
+    main()
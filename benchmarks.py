@@ -0,0 +1,534 @@
+import argparse
+import csv
+import hashlib
+import json
+import os
+import re
+import statistics
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+import faults
+from utilities import DEFAULT_PAGE_SIZE, extract_faults, load_mappings
+
+
+def legacy_user_page_faults_query(process_name: str) -> str:
+    return f"""
+        INCLUDE PERFETTO MODULE android.startup.startups;
+
+        SELECT
+        ftrace_event.ts,
+        process.name as process_name,
+        thread.name as thread_name,
+        EXTRACT_ARG(ftrace_event.arg_set_id, "address")  as address,
+        EXTRACT_ARG(ftrace_event.arg_set_id, "ip")  as ip
+        FROM ftrace_event
+            left join thread ON ftrace_event.utid = thread.utid
+            left join process ON thread.upid = process.upid
+        WHERE
+        ftrace_event.name = 'page_fault_user'
+        AND ftrace_event.ts >= (SELECT MIN(ts) from android_startups WHERE package = process.name)
+        AND ftrace_event.ts <= (SELECT MIN(ts_end) from android_startups WHERE package = process.name)
+        AND process.name = '{process_name}'
+        ORDER BY ts ASC
+    """
+
+
+def legacy_add_to_page_cache_query(process_name: str) -> str:
+    return f"""
+        INCLUDE PERFETTO MODULE android.startup.startups;
+
+        SELECT
+        ftrace_event.ts,
+        process.name as process_name,
+        thread.name as thread_name,
+        EXTRACT_ARG(ftrace_event.arg_set_id, "s_dev")  as sdev,
+        EXTRACT_ARG(ftrace_event.arg_set_id, "i_ino")  as inode,
+        EXTRACT_ARG(ftrace_event.arg_set_id, "index")  as offset
+        FROM ftrace_event
+            left join thread ON ftrace_event.utid = thread.utid
+            left join process ON thread.upid = process.upid
+        WHERE
+        ftrace_event.name = 'mm_filemap_add_to_page_cache'
+        AND ftrace_event.ts >= (SELECT MIN(ts) from android_startups WHERE package = process.name)
+        AND ftrace_event.ts <= (SELECT MIN(ts_end) from android_startups WHERE package = process.name)
+        AND process.name = '{process_name}'
+        ORDER BY ts ASC
+    """
+
+
+def legacy_page_cache_inodes_query(process_name: str) -> str:
+    return f"""
+        INCLUDE PERFETTO MODULE android.startup.startups;
+
+        SELECT DISTINCT
+        EXTRACT_ARG(ftrace_event.arg_set_id, "s_dev")  as sdev,
+        EXTRACT_ARG(ftrace_event.arg_set_id, "i_ino")  as inode
+        FROM ftrace_event
+            left join thread ON ftrace_event.utid = thread.utid
+            left join process ON thread.upid = process.upid
+        WHERE
+        ftrace_event.name = 'mm_filemap_add_to_page_cache'
+        AND ftrace_event.ts >= (SELECT MIN(ts) from android_startups WHERE package = process.name)
+        AND ftrace_event.ts <= (SELECT MIN(ts_end) from android_startups WHERE package = process.name)
+        AND process.name = '{process_name}'
+    """
+
+
+# The queries faults.py used before the startup bounds were precomputed
+LEGACY_QUERIES: Dict[str, Callable[[str], str]] = {
+    "user_page_faults": legacy_user_page_faults_query,
+    "add_to_page_cache": legacy_add_to_page_cache_query,
+    "page_cache_inodes": legacy_page_cache_inodes_query,
+}
+
+QUERIES: Dict[str, Callable[[str], str]] = {
+    "user_page_faults": faults.user_page_faults_query,
+    "add_to_page_cache": faults.add_to_page_cache_query,
+    "page_cache_inodes": faults.page_cache_inodes_query,
+}
+
+
+def run_query(query: str, trace: str, trace_processor=None) -> Iterator[Tuple]:
+    if trace_processor is None:
+        for row in faults.run_trace_query(query, trace):
+            yield tuple(row.values())
+        return
+
+    result = trace_processor.query(query)
+    for row in result:
+        yield tuple(getattr(row, name) for name in result.column_names)
+
+
+def time_query(query: str, trace: str, trace_processor=None) -> Tuple[float, int, str]:
+    """
+    @returns the wall time, the number of rows and a checksum of the rows (independent of row order)
+    """
+    start = time.perf_counter()
+    rows = [str(row) for row in run_query(query, trace, trace_processor)]
+    elapsed = time.perf_counter() - start
+    checksum = hashlib.sha256("\n".join(sorted(rows)).encode("utf-8")).hexdigest()
+    return elapsed, len(rows), checksum
+
+
+def benchmark_queries(trace: str, process_name: str, repetitions: int):
+    trace_processor = None
+    if faults.TraceProcessor is not None:
+        print("Loading trace...")
+        trace_processor = faults.TraceProcessor(
+            trace=trace,
+            config=faults.TraceProcessorConfig(
+                bin_path="./trace_processor", ingest_ftrace_in_raw=True
+            ),
+        )
+    else:
+        # Every query loads the trace again, so report the load time to subtract from the results
+        load_time = statistics.median(
+            time_query("SELECT 1", trace)[0] for _ in range(repetitions)
+        )
+        print(
+            f"perfetto is not installed, timings include trace load ({load_time:.3f}s)"
+        )
+
+    print(
+        f"{'query':<20} {'legacy (s)':>12} {'optimized (s)':>14} {'speedup':>8} "
+        f"{'legacy rows':>12} {'optimized rows':>15} {'match':>6}"
+    )
+    try:
+        for name, legacy_query in LEGACY_QUERIES.items():
+            results = {}
+            for label, query in [
+                ("legacy", legacy_query(process_name.replace("'", "''"))),
+                ("optimized", QUERIES[name](process_name)),
+            ]:
+                runs = [
+                    time_query(query, trace, trace_processor)
+                    for _ in range(repetitions)
+                ]
+                results[label] = (
+                    statistics.median(run[0] for run in runs),
+                    runs[0][1],
+                    runs[0][2],
+                )
+
+            legacy, optimized = results["legacy"], results["optimized"]
+            print(
+                f"{name:<20} {legacy[0]:>12.3f} {optimized[0]:>14.3f} "
+                f"{legacy[0] / max(optimized[0], 1e-9):>7.2f}x "
+                f"{legacy[1]:>12} {optimized[1]:>15} {str(legacy[2] == optimized[2]):>6}"
+            )
+    finally:
+        if trace_processor is not None:
+            trace_processor.close()
+
+
+# Copies of the fixture's mappings are this far apart in the address space, beyond user space addresses
+COPY_ADDRESS_STRIDE = 1 << 48
+# Faults written at a time by the generator
+GENERATOR_BLOCK_SIZE = 1_000_000
+# Device id of the synthetic page cache events
+SYNTHETIC_DEV = 64775
+# Files whose faults extract_faults is benchmarked on
+EXTRACTED_FILES = 10
+
+MAPS_LINE_RE = re.compile(
+    r"^(?P<begin>[0-9a-f]+)-(?P<end>[0-9a-f]+)\s+(?P<perms>\S+)\s+(?P<offset>[0-9a-f]+)\s+(?P<dev>\S+)"
+    r"\s+(?P<inode>[0-9]+)\s*(?P<path>.*)$"
+)
+
+
+def copy_file_name(file_name: str, copy: int) -> str:
+    """
+    @returns the name of a copy of a file, e.g. base.2.apk
+    """
+    if copy == 0:
+        return file_name
+    root, extension = os.path.splitext(file_name)
+    return f"{root}.{copy}{extension}"
+
+
+def generate_fixture(fixture_dir: str, output_dir: str, scale: int):
+    """
+    Synthesize a run `scale` times larger than the fixture without a device. Each copy of the fixture maps its own
+    copy of every file at distinct addresses and replays the fixture's faults, interleaved in time, so access
+    patterns keep the locality of the recorded startup.
+
+    Writes faults.csv and maps.txt for user page faults, and page_cache_faults.csv and inodes.txt with the page
+    cache events the same faults would add, along with file_sizes.csv.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    with open(os.path.join(fixture_dir, "maps.txt")) as f:
+        maps_lines = [line.rstrip("\n") for line in f]
+    with open(os.path.join(output_dir, "maps.txt"), "w") as f:
+        for copy in range(scale):
+            for line in maps_lines:
+                match = MAPS_LINE_RE.match(line)
+                if not match:
+                    continue
+                if copy and (int(match["inode"]) == 0 or " (deleted)" in line):
+                    continue
+                shift = copy * COPY_ADDRESS_STRIDE
+                f.write(
+                    f"{int(match['begin'], 16) + shift:x}-{int(match['end'], 16) + shift:x} {match['perms']} "
+                    f"{match['offset']} {match['dev']} {match['inode']} {copy_file_name(match['path'], copy)}\n"
+                )
+
+    file_sizes = {}
+    with open(os.path.join(fixture_dir, "file_sizes.csv"), newline="") as f:
+        for row in csv.DictReader(f):
+            if not row["zip_entry_name"]:
+                for copy in range(scale):
+                    file_sizes[copy_file_name(row["file_name"], copy)] = int(
+                        row["size"]
+                    )
+    faults.write_file_sizes(output_dir, file_sizes)
+
+    map_index = faults.build_map_index(faults.parse_maps(fixture_dir))
+    file_names = sorted(set(map_index.file_names.tolist()))
+    # Each copy of a file has its own inode
+    with open(os.path.join(output_dir, "inodes.txt"), "w") as f:
+        f.write(
+            faults.format_inode_lines(
+                {
+                    (SYNTHETIC_DEV, 1 + copy * len(file_names) + i): copy_file_name(
+                        file_name, copy
+                    )
+                    for copy in range(scale)
+                    for i, file_name in enumerate(file_names)
+                }
+            )
+        )
+
+    with open(os.path.join(fixture_dir, "faults.csv"), newline="") as f:
+        # Query results can start with an empty line
+        rows = list(csv.DictReader(line for line in f if line.strip()))
+    ts = np.array([int(row["ts"]) for row in rows], dtype=np.int64)
+    addresses = np.array([int(row["address"]) for row in rows], dtype=np.uint64)
+    entry_idx = faults.find_map_entries(map_index, addresses)
+    mapped = entry_idx >= 0
+    file_offsets = np.zeros(len(rows), dtype=np.int64)
+    file_offsets[mapped] = (
+        addresses[mapped] - map_index.begin_addresses[entry_idx[mapped]]
+    ).astype(np.int64) + map_index.offsets[entry_idx[mapped]]
+
+    process_names = np.array([row["process_name"] for row in rows], dtype=object)
+    thread_names = np.array([row["thread_name"] for row in rows], dtype=object)
+    file_idx = np.searchsorted(
+        np.array(file_names, dtype=object),
+        map_index.file_names[np.maximum(entry_idx, 0)],
+    )
+
+    # Write the copies of a block of fixture faults at a time to bound memory
+    copies = np.arange(scale)
+    block_size = max(1, GENERATOR_BLOCK_SIZE // scale)
+    with (
+        open(os.path.join(output_dir, "faults.csv"), "w", newline="") as faults_file,
+        open(
+            os.path.join(output_dir, "page_cache_faults.csv"), "w", newline=""
+        ) as page_cache_file,
+    ):
+        for start in range(0, len(rows), block_size):
+            block = slice(start, start + block_size)
+            block_ts = (ts[block, None] + copies).ravel()
+            # Only file backed faults move with their copy of the mapping
+            shifts = mapped[block, None] * copies * COPY_ADDRESS_STRIDE
+            block_addresses = (
+                addresses[block, None] + shifts.astype(np.uint64)
+            ).ravel()
+            pd.DataFrame(
+                {
+                    "ts": block_ts,
+                    "process_name": np.repeat(process_names[block], scale),
+                    "thread_name": np.repeat(thread_names[block], scale),
+                    "address": block_addresses,
+                    "ip": block_addresses,
+                }
+            ).to_csv(faults_file, header=start == 0, index=False)
+
+            block_mapped = np.repeat(mapped[block], scale)
+            inodes = 1 + copies * len(file_names) + file_idx[block, None]
+            pd.DataFrame(
+                {
+                    "ts": block_ts[block_mapped],
+                    "process_name": np.repeat(process_names[block], scale)[
+                        block_mapped
+                    ],
+                    "thread_name": np.repeat(thread_names[block], scale)[block_mapped],
+                    "sdev": SYNTHETIC_DEV,
+                    "inode": inodes.ravel()[block_mapped],
+                    "offset": np.repeat(
+                        file_offsets[block] // DEFAULT_PAGE_SIZE, scale
+                    )[block_mapped],
+                }
+            ).to_csv(page_cache_file, header=start == 0, index=False)
+
+
+def read_user_page_faults(path: str) -> Iterator[Dict]:
+    """
+    Stream faults.csv like `parse_user_page_faults` streams query results
+    """
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            row["ts"] = int(row["ts"])
+            row["address"] = int(row["address"])
+            yield row
+
+
+def read_page_cache_faults(path: str) -> Iterator[Dict]:
+    """
+    Stream page_cache_faults.csv like `parse_add_to_page_cache` streams query results
+    """
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            row["ts"] = int(row["ts"])
+            row["sdev"] = int(row["sdev"])
+            row["inode"] = int(row["inode"])
+            row["offset"] = int(row["offset"]) * DEFAULT_PAGE_SIZE
+            yield row
+
+
+def measure(
+    stage: Callable[[], int], memory: bool
+) -> Tuple[float, int, Optional[float]]:
+    """
+    Run the stage, then again under tracemalloc for its peak memory since tracemalloc slows it down
+
+    @returns the wall time, the number of faults processed and the peak memory in MB
+    """
+    start = time.perf_counter()
+    rows = stage()
+    elapsed = time.perf_counter() - start
+    if not memory:
+        return elapsed, rows, None
+
+    tracemalloc.start()
+    try:
+        stage()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return elapsed, rows, peak / (1 << 20)
+
+
+def benchmark_offline(
+    fixture_dir: str, scales: List[int], work_dir: str, memory: bool
+) -> List[Dict]:
+    results = []
+    print(
+        f"{'scale':>6} {'stage':<26} {'faults':>10} {'time (s)':>9} {'faults/s':>11} {'peak (MB)':>10}"
+    )
+    for scale in scales:
+        data_dir = os.path.join(work_dir, f"scale_{scale}")
+        user_dir = os.path.join(data_dir, "user_page_faults")
+        page_cache_dir = os.path.join(data_dir, "page_cache")
+        print(f"Generating {scale}x fixture...")
+        generate_fixture(fixture_dir, data_dir, scale)
+        for output_dir in (user_dir, page_cache_dir):
+            os.makedirs(output_dir, exist_ok=True)
+        file_sizes = faults.load_file_sizes(data_dir)
+        for output_dir in (user_dir, page_cache_dir):
+            faults.write_file_sizes(output_dir, file_sizes)
+        map_entries = faults.parse_maps(data_dir)
+
+        def run_parse_maps() -> int:
+            return len(faults.parse_maps(data_dir))
+
+        def run_user_page_fault_mappings() -> int:
+            rows_in, _ = faults.compute_user_page_fault_mappings(
+                read_user_page_faults(os.path.join(data_dir, "faults.csv")),
+                map_entries,
+                {},
+                user_dir,
+                file_sizes,
+            )
+            return rows_in
+
+        def run_page_cache_mappings() -> int:
+            rows_in, _ = faults.compute_page_cache_mappings(
+                read_page_cache_faults(os.path.join(data_dir, "page_cache_faults.csv")),
+                faults.compute_inode_mapping(data_dir),
+                {},
+                page_cache_dir,
+                file_sizes,
+            )
+            return rows_in
+
+        def run_load_mappings() -> int:
+            mapped_faults, _ = load_mappings(user_dir)
+            return len(mapped_faults)
+
+        def run_extract_faults() -> int:
+            mapped_faults, file_sizes_rows = load_mappings(user_dir)
+            most_faulted = (
+                mapped_faults["file_name"].value_counts().index[:EXTRACTED_FILES]
+            )
+            return sum(
+                len(extract_faults(file_name, None, file_sizes_rows, mapped_faults)[0])
+                for file_name in most_faulted
+            )
+
+        for name, stage in [
+            ("parse_maps", run_parse_maps),
+            ("user_page_fault_mappings", run_user_page_fault_mappings),
+            ("page_cache_mappings", run_page_cache_mappings),
+            ("load_mappings", run_load_mappings),
+            ("extract_faults", run_extract_faults),
+        ]:
+            elapsed, rows, peak = measure(stage, memory)
+            results.append(
+                {
+                    "scale": scale,
+                    "stage": name,
+                    "faults": rows,
+                    "time_s": elapsed,
+                    "faults_per_s": rows / max(elapsed, 1e-9),
+                    "peak_memory_mb": peak,
+                }
+            )
+            peak_column = f"{peak:>10.1f}" if peak is not None else f"{'-':>10}"
+            print(
+                f"{scale:>6} {name:<26} {rows:>10} {elapsed:>9.3f} "
+                f"{rows / max(elapsed, 1e-9):>11.0f} {peak_column}"
+            )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark page fault processing")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    queries_parser = subparsers.add_parser(
+        "queries",
+        help="Compare the legacy and optimized trace_processor queries on a recorded trace",
+    )
+    queries_parser.add_argument(
+        "--trace", type=str, required=True, help="Path to a recorded faults.pftrace"
+    )
+    queries_parser.add_argument(
+        "--package", type=str, required=True, help="Android package name of the trace"
+    )
+    queries_parser.add_argument(
+        "--repetitions",
+        type=int,
+        default=3,
+        help="Number of runs per query (default: 3)",
+    )
+
+    offline_parser = subparsers.add_parser(
+        "offline",
+        help="Measure the processing stages on fixtures scaled up by a synthetic generator, without a device or "
+        "trace_processor",
+    )
+    offline_parser.add_argument(
+        "--fixture",
+        type=str,
+        default="example/pre-ordering",
+        help="Run with faults.csv, maps.txt and file_sizes.csv to scale up (default: example/pre-ordering)",
+    )
+    offline_parser.add_argument(
+        "--scales",
+        type=int,
+        nargs="+",
+        default=[1, 10],
+        help="Scales of the fixture to benchmark, e.g. 1 10 100 1000 (default: 1 10)",
+    )
+    offline_parser.add_argument(
+        "--work-dir",
+        type=str,
+        help="Directory for the generated data and outputs (default: a temporary directory)",
+    )
+    offline_parser.add_argument(
+        "--no-memory",
+        action="store_true",
+        default=False,
+        help="Skip measuring the peak memory of each stage, which runs each stage again under tracemalloc "
+        "(default: false)",
+    )
+    offline_parser.add_argument(
+        "--json",
+        type=str,
+        help="Write the results to this JSON file",
+    )
+
+    generate_parser = subparsers.add_parser(
+        "generate",
+        help="Write a synthetic run scaled up from a fixture, with user page faults and page cache events",
+    )
+    generate_parser.add_argument(
+        "--fixture",
+        type=str,
+        default="example/pre-ordering",
+        help="Run with faults.csv, maps.txt and file_sizes.csv to scale up (default: example/pre-ordering)",
+    )
+    generate_parser.add_argument(
+        "--scale", type=int, required=True, help="Number of copies of the fixture"
+    )
+    generate_parser.add_argument(
+        "--output", type=str, required=True, help="Directory to write the run to"
+    )
+
+    args = parser.parse_args()
+
+    if args.benchmark == "queries":
+        benchmark_queries(args.trace, args.package, args.repetitions)
+    elif args.benchmark == "offline":
+        with tempfile.TemporaryDirectory() as temp_dir:
+            results = benchmark_offline(
+                args.fixture, args.scales, args.work_dir or temp_dir, not args.no_memory
+            )
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=2)
+            print(f"Wrote {args.json}")
+    elif args.benchmark == "generate":
+        generate_fixture(args.fixture, args.output, args.scale)
+
+
+if __name__ == "__main__":
+    main()
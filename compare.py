@@ -0,0 +1,157 @@
+import argparse
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from utilities import (
+    DEFAULT_PAGE_SIZE,
+    load_mapped_faults,
+    load_page_size,
+    normalize_install_path,
+)
+
+# Key of the row holding the metrics of the whole run
+TOTAL = "(total)"
+
+METRICS = [
+    "major_faults",
+    "unique_pages",
+    "time_to_last_fault_ms",
+    "readahead_hit_ratio",
+]
+
+
+def load_faults(output_dir: str) -> pd.DataFrame:
+    """
+    Load the mapped faults with install paths normalized so files match across installs
+    """
+    mapped_faults = load_mapped_faults(output_dir)
+    # Maps the categories rather than every row
+    mapped_faults["file_name"] = (
+        mapped_faults["file_name"].map(normalize_install_path).astype("category")
+    )
+    mapped_faults["zip_entry_name"] = (
+        mapped_faults["zip_entry_name"].astype(object).fillna("").astype("category")
+    )
+    return mapped_faults
+
+
+def compute_metrics(
+    mapped_faults: pd.DataFrame, page_size: int = DEFAULT_PAGE_SIZE
+) -> pd.DataFrame:
+    """
+    Compute the metrics of each file and zip entry, and of the whole run
+
+    - major_faults: faults that required disk I/O
+    - unique_pages: distinct pages faulted
+    - time_to_last_fault_ms: time from the first fault of the run to the last fault of the file
+    - readahead_hit_ratio: share of faults served from the page cache (e.g. brought in by readahead)
+
+    @returns a data frame indexed by (file_name, zip_entry_name)
+    """
+    start_ts = mapped_faults["ts"].min()
+    faults = mapped_faults.assign(
+        page=mapped_faults["offset"] // page_size,
+        time_ms=(mapped_faults["ts"] - start_ts) / 1e6,
+    )
+    grouped = faults.groupby(["file_name", "zip_entry_name"], observed=True)
+    metrics = pd.DataFrame(
+        {
+            "faults": grouped.size(),
+            "major_faults": grouped["is_major"].sum(),
+            "unique_pages": grouped["page"].nunique(),
+            "time_to_last_fault_ms": grouped["time_ms"].max(),
+        }
+    )
+    metrics.index = metrics.index.set_levels(
+        [level.astype(str) for level in metrics.index.levels]
+    )
+
+    metrics.loc[(TOTAL, ""), :] = [
+        metrics["faults"].sum(),
+        metrics["major_faults"].sum(),
+        metrics["unique_pages"].sum(),
+        faults["time_ms"].max() if len(faults) else 0,
+    ]
+    metrics["readahead_hit_ratio"] = 1 - metrics["major_faults"] / metrics["faults"]
+    return metrics
+
+
+def diff_metrics(base: pd.DataFrame, test: pd.DataFrame) -> pd.DataFrame:
+    """
+    @returns the base and test metrics of every file side by side, ranked by the change in major faults
+    """
+    diff = base[METRICS].join(
+        test[METRICS], how="outer", lsuffix="_base", rsuffix="_test"
+    )
+    counts = [f"{metric}_{side}" for metric in METRICS[:2] for side in ["base", "test"]]
+    diff[counts] = diff[counts].fillna(0).astype(np.int64)
+    for metric in METRICS:
+        diff[f"{metric}_delta"] = diff[f"{metric}_test"] - diff[f"{metric}_base"]
+
+    ranks = diff["major_faults_delta"].abs().to_numpy(dtype=np.float64)
+    # Keep the total first
+    ranks[diff.index.get_level_values("file_name") == TOTAL] = np.inf
+    order = np.lexsort((-diff["unique_pages_delta"].abs().to_numpy(), -ranks))
+    return diff.iloc[order][
+        [f"{metric}_{side}" for metric in METRICS for side in ["base", "test", "delta"]]
+    ]
+
+
+def format_diff(diff: pd.DataFrame, top: int) -> str:
+    rows = diff.head(top + 1).reset_index()
+    rows["file"] = rows["file_name"].where(
+        rows["zip_entry_name"] == "",
+        rows["file_name"] + "!/" + rows["zip_entry_name"],
+    )
+    columns: List[str] = ["file"] + [
+        column for column in diff.columns if not column.startswith("readahead")
+    ]
+    rows["readahead_hit_ratio"] = (
+        rows["readahead_hit_ratio_base"].map("{:.2f}".format)
+        + " -> "
+        + rows["readahead_hit_ratio_test"].map("{:.2f}".format)
+    )
+    return rows[columns + ["readahead_hit_ratio"]].to_string(
+        index=False, float_format="{:.1f}".format
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the page faults of every file between two output directories"
+    )
+    parser.add_argument(
+        "--base", type=str, required=True, help="Output directory of the baseline"
+    )
+    parser.add_argument(
+        "--test", type=str, required=True, help="Output directory to compare"
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=20,
+        help="Number of files to print, ranked by the change in major faults (default: 20)",
+    )
+    parser.add_argument(
+        "--csv",
+        type=str,
+        default=None,
+        help="Write the metrics of every file to a CSV (default: none)",
+    )
+
+    args = parser.parse_args()
+
+    diff = diff_metrics(
+        compute_metrics(load_faults(args.base), load_page_size(args.base)),
+        compute_metrics(load_faults(args.test), load_page_size(args.test)),
+    )
+    print(format_diff(diff, args.top))
+    if args.csv:
+        diff.to_csv(args.csv)
+        print("Comparison written to:", args.csv)
+
+
+if __name__ == "__main__":
+    main()
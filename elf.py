@@ -0,0 +1,269 @@
+import os
+import shutil
+import struct
+import subprocess
+import zipfile
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+
+from faults import DeviceSession, get_cache_dir, read_device_file_range
+
+ELF_MAGIC = b"\x7fELF"
+ELF_CLASS_64 = 2
+ELF_DATA_LSB = 1
+
+SHT_SYMTAB = 2
+SHT_NOBITS = 8
+SHT_DYNSYM = 11
+SHN_UNDEF = 0
+PT_NOTE = 4
+NT_GNU_BUILD_ID = 3
+STT_OBJECT = 1
+STT_FUNC = 2
+
+SYMBOL_KINDS = {STT_OBJECT: "object", STT_FUNC: "function"}
+
+# e_phoff, e_shoff, e_phentsize, e_phnum, e_shentsize, e_shnum, e_shstrndx for each ELF class
+ELF_HEADER_FORMATS = {
+    1: ("<28xLL6xHHHHH", 52),
+    ELF_CLASS_64: ("<32xQQ6xHHHHH", 64),
+}
+SECTION_HEADER_DTYPES = {
+    1: np.dtype(
+        [
+            ("name", "<u4"),
+            ("type", "<u4"),
+            ("flags", "<u4"),
+            ("addr", "<u4"),
+            ("offset", "<u4"),
+            ("size", "<u4"),
+            ("link", "<u4"),
+            ("info", "<u4"),
+            ("addralign", "<u4"),
+            ("entsize", "<u4"),
+        ]
+    ),
+    ELF_CLASS_64: np.dtype(
+        [
+            ("name", "<u4"),
+            ("type", "<u4"),
+            ("flags", "<u8"),
+            ("addr", "<u8"),
+            ("offset", "<u8"),
+            ("size", "<u8"),
+            ("link", "<u4"),
+            ("info", "<u4"),
+            ("addralign", "<u8"),
+            ("entsize", "<u8"),
+        ]
+    ),
+}
+SYMBOL_DTYPES = {
+    1: np.dtype(
+        [
+            ("name", "<u4"),
+            ("value", "<u4"),
+            ("size", "<u4"),
+            ("info", "u1"),
+            ("other", "u1"),
+            ("shndx", "<u2"),
+        ]
+    ),
+    ELF_CLASS_64: np.dtype(
+        [
+            ("name", "<u4"),
+            ("info", "u1"),
+            ("other", "u1"),
+            ("shndx", "<u2"),
+            ("value", "<u8"),
+            ("size", "<u8"),
+        ]
+    ),
+}
+# p_type, p_offset and p_filesz of a program header
+PROGRAM_HEADER_FORMATS = {1: "<LL8xL", ELF_CLASS_64: "<L4xQ16xQ"}
+
+
+def is_elf(data, base: int = 0) -> bool:
+    return data[base : base + 4] == ELF_MAGIC
+
+
+def read_build_id(read_range: Callable[[int, int], bytes]) -> Optional[str]:
+    """
+    Read the GNU build ID from the PT_NOTE segments of an ELF file. Only reads the headers and notes so it works
+    with ranged reads of files on the device.
+
+    Args:
+        read_range: Reads (offset, length) bytes of the ELF file
+
+    @returns the build ID as hex or None if the file has none
+    """
+    ident = read_range(0, 6)
+    if ident[:4] != ELF_MAGIC or ident[5] != ELF_DATA_LSB:
+        return None
+    elf_class = ident[4]
+    header_format, header_size = ELF_HEADER_FORMATS[elf_class]
+    phoff, _shoff, phentsize, phnum, _shentsize, _shnum, _shstrndx = struct.unpack_from(
+        header_format, read_range(0, header_size)
+    )
+
+    program_headers = read_range(phoff, phentsize * phnum)
+    for i in range(phnum):
+        p_type, p_offset, p_filesz = struct.unpack_from(
+            PROGRAM_HEADER_FORMATS[elf_class], program_headers, i * phentsize
+        )
+        if p_type != PT_NOTE:
+            continue
+        notes = read_range(p_offset, p_filesz)
+        pos = 0
+        while pos + 12 <= len(notes):
+            name_size, desc_size, note_type = struct.unpack_from("<3L", notes, pos)
+            name_start = pos + 12
+            desc_start = name_start + (name_size + 3) // 4 * 4
+            if note_type == NT_GNU_BUILD_ID and notes[name_start:desc_start].startswith(
+                b"GNU\0"
+            ):
+                return notes[desc_start : desc_start + desc_size].hex()
+            pos = desc_start + (desc_size + 3) // 4 * 4
+    return None
+
+
+def parse_elf(
+    data, base: int = 0
+) -> Tuple[
+    Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray], List[Tuple[int, int, str]]
+]:
+    """
+    Parse the sections and the function and object symbols of the ELF file at `base`. Symbols come from .symtab,
+    or .dynsym when the library is stripped.
+
+    @returns the starts, ends, names and kinds of the symbols and the (start, end, name) of the sections, all in
+    offsets of `data`
+    """
+    elf_class = data[base + 4]
+    header_format, _ = ELF_HEADER_FORMATS[elf_class]
+    _phoff, shoff, _phentsize, _phnum, _shentsize, shnum, shstrndx = struct.unpack_from(
+        header_format, data, base
+    )
+    section_headers = np.frombuffer(
+        data, SECTION_HEADER_DTYPES[elf_class], shnum, base + shoff
+    ).copy()
+
+    def string(table_offset: int, name: int) -> str:
+        start = base + table_offset + name
+        return data[start : data.find(b"\0", start)].decode("utf-8", errors="replace")
+
+    shstrtab_offset = int(section_headers[shstrndx]["offset"])
+    sections = [
+        (
+            base + int(header["offset"]),
+            base + int(header["offset"] + header["size"]),
+            string(shstrtab_offset, int(header["name"])),
+        )
+        for header in section_headers
+        if header["type"] != SHT_NOBITS and header["size"] and header["offset"]
+    ]
+
+    # Prefer the full symbol table over the dynamic one
+    symbol_tables = np.flatnonzero(section_headers["type"] == SHT_SYMTAB)
+    if not len(symbol_tables):
+        symbol_tables = np.flatnonzero(section_headers["type"] == SHT_DYNSYM)
+    if not len(symbol_tables):
+        empty = np.empty(0, np.int64)
+        return (empty, empty, np.empty(0, object), np.empty(0, object)), sections
+
+    table = section_headers[symbol_tables[0]]
+    symbol_dtype = SYMBOL_DTYPES[elf_class]
+    symbols = np.frombuffer(
+        data,
+        symbol_dtype,
+        int(table["size"]) // symbol_dtype.itemsize,
+        base + int(table["offset"]),
+    ).copy()
+
+    # Symbol values are virtual addresses, translate them to file offsets through their section
+    symbol_types = symbols["info"] & 0xF
+    shndx = symbols["shndx"].astype(np.int64)
+    keep = (
+        np.isin(symbol_types, list(SYMBOL_KINDS))
+        & (symbols["size"] > 0)
+        & (shndx != SHN_UNDEF)
+        & (shndx < shnum)
+    )
+    keep[keep] = section_headers["type"][shndx[keep]] != SHT_NOBITS
+    symbols, symbol_types, shndx = symbols[keep], symbol_types[keep], shndx[keep]
+    starts = (
+        symbols["value"].astype(np.int64)
+        - section_headers["addr"][shndx].astype(np.int64)
+        + section_headers["offset"][shndx].astype(np.int64)
+        + base
+    )
+    ends = starts + symbols["size"].astype(np.int64)
+
+    # Aliases share an address, keep the first name of each
+    starts, first = np.unique(starts, return_index=True)
+    ends = ends[first]
+    strtab_offset = int(section_headers[table["link"]]["offset"])
+    names = np.array(
+        [string(strtab_offset, int(name)) for name in symbols["name"][first]],
+        dtype=object,
+    )
+    kinds = np.array([SYMBOL_KINDS[t] for t in symbol_types[first]], dtype=object)
+    return (starts, ends, names, kinds), sections
+
+
+def find_stored_libraries(path: str, data) -> List[int]:
+    """
+    Find the native libraries stored uncompressed in an APK, which the linker maps directly from the APK
+
+    @returns the offset of the data of each library
+    """
+    offsets = []
+    with zipfile.ZipFile(path) as apk:
+        for entry in apk.infolist():
+            if not entry.filename.endswith(".so") or entry.compress_type != 0:
+                continue
+            # The local header's extra field can differ from the central directory's due to zipalign padding
+            name_length, extra_length = struct.unpack_from(
+                "<HH", data, entry.header_offset + 26
+            )
+            offset = entry.header_offset + 30 + name_length + extra_length
+            if is_elf(data, offset):
+                offsets.append(offset)
+    return offsets
+
+
+def pull_library(device: DeviceSession, file_path: str) -> Optional[str]:
+    """
+    Pull a native library from the device, reusing the copy cached for the same build ID
+
+    @returns the local path of the library
+    """
+    try:
+        build_id = read_build_id(
+            lambda offset, length: read_device_file_range(
+                device, file_path, offset, length
+            )
+        )
+    except (subprocess.CalledProcessError, struct.error, KeyError, IndexError) as e:
+        print(f"Failed to read the build ID of {file_path} ({e})")
+        return None
+    if build_id is None:
+        return None
+
+    cache_path = os.path.join(get_cache_dir("elf"), f"{build_id}.so")
+    if os.path.exists(cache_path):
+        return cache_path
+
+    print(f"Pulling {file_path}...")
+    result = subprocess.run(
+        device.adb + ["pull", file_path, f"{cache_path}.partial"],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        print(f"Failed to pull: {file_path} ({result.stderr.strip()})")
+        return None
+    shutil.move(f"{cache_path}.partial", cache_path)
+    return cache_path
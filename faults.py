@@ -1,276 +1,1107 @@
 import argparse
+import base64
+import cProfile
 import csv
+import hashlib
+import json
 import os
 import re
+import resource
 import shlex
-from functools import lru_cache
-from typing import Optional, Tuple, List, Dict
+import signal
+import sys
+from contextlib import ExitStack, contextmanager
+from functools import cached_property
+from typing import (
+    Callable,
+    Optional,
+    Tuple,
+    List,
+    Dict,
+    Iterable,
+    Iterator,
+    Sequence,
+    Set,
+)
 import time
 import shutil
+import struct
 import subprocess
-from zipfile import ZipFile
-
-# TODO: Support arbitrary page sizes
-PAGE_SIZE = 4096
-
-
-@lru_cache(maxsize=1)
-def has_root() -> bool:
+import tempfile
+import threading
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+
+import numpy as np
+import pandas as pd
+
+try:
+    from perfetto.trace_processor import TraceProcessor, TraceProcessorConfig
+except ImportError:
+    # Installed by uv sync. Without it, TraceSession falls back to a new trace_processor per query
+    TraceProcessor = None
+
+from readahead import DEFAULT_RA_PAGES, ReadaheadPolicy, ResidencyModel
+from utilities import (
+    DEFAULT_PAGE_SIZE,
+    DEVICE_INFO_FILE,
+    FAULT_STORE_DIR,
+    FaultStoreWriter,
+    load_mapped_faults,
+    load_page_size,
+    read_device_info,
+)
+
+MAPPED_FAULTS_FIELDS = [
+    "ts",
+    "process_name",
+    "thread_name",
+    "file_name",
+    "zip_entry_name",
+    "offset",
+    "is_major",
+]
+
+# Number of trace events mapped and written at a time
+DEFAULT_CHUNK_SIZE = 50000
+
+# Partitions whose inodes only change with the build
+READ_ONLY_PARTITIONS = ["/apex", "/system", "/system_ext", "/product", "/vendor"]
+# Number of inodes searched for per find command
+INODE_BATCH_SIZE = 1000
+# Number of files passed to a single `stat` command
+STAT_BATCH_SIZE = 500
+
+# Seconds given to record_android_trace to start tracing before launching the app
+TRACE_START_DELAY = 3
+# Seconds to keep tracing after the app reports that it launched
+DEFAULT_SETTLE_TIME = 5
+
+# Fingerprints of the processing stages that produced the outputs of a directory
+STAGES_FILE = ".stages.json"
+# Metrics of the stages that ran, written with --profile
+RUN_METRICS_FILE = "run_metrics.json"
+# cProfile stats of the processing phase, written with --cprofile
+PROCESSING_PROFILE_FILE = "processing.prof"
+# ru_maxrss is in KB on Linux and in bytes on macOS
+MAXRSS_PER_MB = 1 << 20 if sys.platform == "darwin" else 1 << 10
+
+# Max nanoseconds between a major fault and the uninterruptible sleep of its thread waiting for the read
+IO_STALL_MAX_GAP_NS = 1_000_000
+IO_STALLS_FILE = "io_stalls.csv"
+IO_STALLS_FIELDS = [
+    "file_name",
+    "zip_entry_name",
+    "thread_name",
+    "major_faults",
+    "stalled_faults",
+    "stall_ms",
+    "max_stall_ms",
+]
+
+# Milliseconds of trace mapped at a time when processing windows
+DEFAULT_WINDOW_CHUNK_MS = 1000
+
+# Per-window outputs are written to <output>/windows/<name>
+WINDOWS_DIR = "windows"
+WINDOWS_FILE = "windows.json"
+# Run files copied to each window directory so it can be loaded like a run
+WINDOW_RUN_FILES = ["file_sizes.csv", "apk_indexes.json", DEVICE_INFO_FILE]
+
+# Zip entry name reported for APK faults that fall outside of every zip entry
+UNATTRIBUTED_ZIP_ENTRY = "unattributed"
+
+ZIP_EOCD_SIGNATURE = b"PK\x05\x06"
+ZIP_EOCD_FORMAT = "<4s4H2LH"
+ZIP_EOCD_SIZE = 22
+ZIP_MAX_COMMENT_LENGTH = 0xFFFF
+ZIP_CENTRAL_HEADER_SIGNATURE = b"PK\x01\x02"
+ZIP_CENTRAL_HEADER_FORMAT = "<4s6H3L5H2L"
+ZIP_CENTRAL_HEADER_SIZE = 46
+ZIP_LOCAL_HEADER_SIZE = 30
+# The name and extra field lengths of a local header, whose extra field zipalign pads to align the entry's data
+ZIP_LOCAL_HEADER_LENGTHS_OFFSET = 26
+ZIP_LOCAL_HEADER_LENGTHS_FORMAT = "<2H"
+ZIP_LOCAL_HEADER_LENGTHS_SIZE = 4
+# The APK signing block sits between the last entry and the central directory, and ends with its size (excluding
+# the size field itself) and magic
+APK_SIG_BLOCK_MAGIC = b"APK Sig Block 42"
+APK_SIG_BLOCK_FOOTER_FORMAT = "<Q16s"
+APK_SIG_BLOCK_FOOTER_SIZE = 24
+APK_SIG_BLOCK_SIZE_FIELD_SIZE = 8
+# Bumped when the bounds of indexed entries change, so cached indexes are rebuilt
+APK_INDEX_VERSION = 3
+
+
+def has_root(adb: List[str]) -> bool:
     try:
-        output = subprocess.check_output("adb root", shell=True, text=True)
+        output = subprocess.check_output(adb + ["root"], text=True)
         return "adbd cannot run as root in production builds" not in output
     except subprocess.CalledProcessError:
         return False
 
 
-def _shell_executes_as_root(prefix: List[str]) -> bool:
-    try:
-        result = subprocess.run(
-            prefix + ["id"],
-            capture_output=True,
-            text=True,
+class DeviceSession:
+    """
+    A single root shell on the device that every device command is multiplexed over.
+
+    Each command runs in a subshell, without access to the session's stdin, followed by a unique marker carrying its
+    exit status, which frames the command's output on the shared stdout. This replaces spawning an adb process per
+    command.
+
+    Everything known about the device is kept on the session so sessions to different devices can be used concurrently.
+    """
+
+    def __init__(self, serial: Optional[str] = None):
+        # Without a serial, adb picks the only connected device
+        self.serial = serial
+        self.adb = ["adb", "-s", serial] if serial else ["adb"]
+        self.round_trips = 0
+        # The adb command used to open the root shell
+        self.root_prefix: Optional[List[str]] = None
+        self._shell: Optional[subprocess.Popen] = None
+
+    def _open_shell(self) -> subprocess.Popen:
+        candidates: List[List[str]] = []
+        if has_root(self.adb):
+            candidates.append(self.adb + ["shell"])
+
+        candidates.extend(
+            [
+                self.adb + ["shell", "su", "0", "sh"],
+                self.adb + ["shell", "su"],
+            ]
+        )
+
+        for argv in candidates:
+            shell = subprocess.Popen(
+                argv,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                # Keep the shell alive when Ctrl-C stops tracing
+                start_new_session=True,
+            )
+            # `su` may hang waiting for a grant
+            timer = threading.Timer(5, shell.kill)
+            timer.start()
+            try:
+                if "uid=0" in self._communicate(shell, "id")[1]:
+                    self.root_prefix = argv
+                    return shell
+            except (OSError, EOFError):
+                pass
+            finally:
+                timer.cancel()
+            shell.kill()
+            shell.wait()
+
+        raise RuntimeError(
+            "Unable to acquire a root shell over adb. Ensure the device or emulator provides root access."
+        )
+
+    def _communicate(self, shell: subprocess.Popen, command: str) -> Tuple[int, str]:
+        marker = f"__FAULTS_{uuid.uuid4().hex}__"
+        shell.stdin.write(
+            f"(\n{command}\n) </dev/null\nprintf '\\n%s %d\\n' {marker} $?\n".encode(
+                "utf-8"
+            )
+        )
+        shell.stdin.flush()
+        self.round_trips += 1
+
+        output = []
+        marker_prefix = marker.encode("utf-8")
+        while True:
+            line = shell.stdout.readline()
+            if not line:
+                raise EOFError("The device shell exited")
+            if line.startswith(marker_prefix):
+                returncode = int(line.split()[1])
+                break
+            output.append(line)
+
+        # Drop the newline printed before the marker
+        stdout = b"".join(output)[:-1]
+        return returncode, stdout.decode("utf-8", errors="replace")
+
+    def run(self, command: str, check: bool = False) -> subprocess.CompletedProcess:
+        """
+        Run a shell command as root on the device
+        """
+        if self._shell is None:
+            self._shell = self._open_shell()
+        returncode, stdout = self._communicate(self._shell, command)
+        if check and returncode != 0:
+            raise subprocess.CalledProcessError(returncode, command, stdout)
+        return subprocess.CompletedProcess(command, returncode, stdout)
+
+    def getprop(self, name: str) -> str:
+        return self.run(f"getprop {shlex.quote(name)}", check=True).stdout.strip()
+
+    def wait_for_prop(self, name: str, value: str, poll_interval: float = 0.1):
+        """
+        Wait until the property has the value by polling on the device
+        """
+        self.run(
+            f'while [ "$(getprop {shlex.quote(name)})" != {shlex.quote(value)} ]; do sleep {poll_interval}; done',
             check=True,
-            timeout=5,
         )
-        return "uid=0" in result.stdout
-    except subprocess.CalledProcessError:
-        return False
 
+    def file_sizes(self, file_paths: List[str]) -> Dict[str, int]:
+        """
+        Returns the size of each file that exists using batched `stat` calls
+        """
+        sizes = {}
+        for i in range(0, len(file_paths), STAT_BATCH_SIZE):
+            quoted_paths = " ".join(
+                shlex.quote(p) for p in file_paths[i : i + STAT_BATCH_SIZE]
+            )
+            # stat exits with an error if any file is missing, the others are still reported
+            result = self.run(f"stat -c '%s %n' {quoted_paths}")
+            for line in result.stdout.splitlines():
+                size, _, file_path = line.partition(" ")
+                if size.isdigit():
+                    sizes[file_path] = int(size)
+        return sizes
+
+    @cached_property
+    def sdk_version(self) -> int:
+        return int(self.getprop("ro.build.version.sdk"))
+
+    @cached_property
+    def arch(self) -> str:
+        return self.getprop("ro.product.cpu.abi")
+
+    @cached_property
+    def page_size(self) -> int:
+        return int(self.run("getconf PAGESIZE", check=True).stdout.strip())
+
+    @cached_property
+    def fingerprint(self) -> str:
+        return self.getprop("ro.build.fingerprint")
+
+    def close(self):
+        if self._shell is not None:
+            # Exit explicitly as forked processes may hold the write end of stdin open
+            self._shell.stdin.write(b"exit\n")
+            self._shell.stdin.close()
+            self._shell.wait()
+            self._shell = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+@dataclass
+class MapIndex:
+    """
+    Columnar view of /proc/pid/maps entries sorted by begin address
+    """
 
-@lru_cache(maxsize=1)
-def get_root_shell_prefix() -> List[str]:
-    candidates: List[List[str]] = []
-    if has_root():
-        candidates.append(["adb", "shell", "sh", "-c"])
+    begin_addresses: np.ndarray
+    end_addresses: np.ndarray
+    offsets: np.ndarray
+    file_names: np.ndarray
 
-    candidates.extend(
-        [
-            ["adb", "shell", "su", "0", "sh", "-c"],
-            ["adb", "shell", "su", "-c"],
-        ]
+
+def build_map_index(map_entries: List[Dict]) -> MapIndex:
+    """
+    Build a MapIndex from the entries returned by `parse_maps`
+    """
+    map_entries = sorted(map_entries, key=lambda e: e["begin_address"])
+    return MapIndex(
+        begin_addresses=np.array(
+            [e["begin_address"] for e in map_entries], dtype=np.uint64
+        ),
+        end_addresses=np.array(
+            [e["end_address"] for e in map_entries], dtype=np.uint64
+        ),
+        offsets=np.array([e["offset"] for e in map_entries], dtype=np.int64),
+        file_names=np.array([e["file_name"] for e in map_entries], dtype=object),
     )
 
-    for prefix in candidates:
-        if _shell_executes_as_root(prefix):
-            return prefix
 
-    raise RuntimeError(
-        "Unable to acquire a root shell over adb. Ensure the device or emulator provides root access."
+def find_map_entries(map_index: MapIndex, addresses: np.ndarray) -> np.ndarray:
+    """
+    Find the /proc/pid/map entry matching each address.
+
+    @returns the index of the entry within map_index for each address or -1 if the address is not mapped
+    """
+    addresses = addresses.astype(np.uint64, copy=False)
+    entry_idx = np.searchsorted(map_index.begin_addresses, addresses, side="right") - 1
+    in_range = entry_idx >= 0
+    in_range[in_range] = (
+        addresses[in_range] < map_index.end_addresses[entry_idx[in_range]]
     )
+    return np.where(in_range, entry_idx, -1)
 
 
-def run_root_shell(command: str, **kwargs) -> subprocess.CompletedProcess:
-    prefix = get_root_shell_prefix()
-    # Ensure proper command escaping when using `-c`
-    if prefix and prefix[-1] == "-c":
-        escaped_command = command.replace("\\", "\\\\").replace('"', '\\"')
-        command_arg = f'"{escaped_command}"'
-    else:
-        command_arg = command
-    return subprocess.run(prefix + [command_arg], **kwargs)
+@dataclass
+class ApkIndex:
+    """
+    Zip entries of an APK sorted by local header offset.
 
+    An entry spans [header_offset, end_offset) which covers the local header and the compressed data
+    """
+
+    entry_names: np.ndarray
+    header_offsets: np.ndarray
+    end_offsets: np.ndarray
+    sizes: np.ndarray
+
+
+def find_zip_entries(apk_index: ApkIndex, offsets: np.ndarray) -> np.ndarray:
+    """
+    Find the zip entry matching each file offset.
 
-@lru_cache(maxsize=1)
-def get_device_sdk_version() -> int:
+    @returns the index of the entry within apk_index for each offset or -1 if the offset is not within an entry
     """
-    Returns the device SDK version as an integer.
+    entry_idx = np.searchsorted(apk_index.header_offsets, offsets, side="right") - 1
+    in_entry = entry_idx >= 0
+    in_entry[in_entry] = offsets[in_entry] < apk_index.end_offsets[entry_idx[in_entry]]
+    return np.where(in_entry, entry_idx, -1)
+
+
+def resolve_zip_entry_names(
+    file_names: np.ndarray, offsets: np.ndarray, apk_indexes: Dict[str, ApkIndex]
+) -> np.ndarray:
     """
-    output = subprocess.check_output(
-        ["adb", "shell", "getprop", "ro.build.version.sdk"], text=True
-    )
-    return int(output.strip())
+    Resolve the zip entry name of every fault that landed in an indexed APK.
 
+    Faults between entries (e.g. the APK signing block or central directory) are reported as unattributed
+    """
+    zip_entry_names = np.full(len(file_names), None, dtype=object)
+    for apk_path, apk_index in apk_indexes.items():
+        in_apk = file_names == apk_path
+        if not in_apk.any():
+            continue
+        entry_idx = find_zip_entries(apk_index, offsets[in_apk])
+        entry_names = np.append(apk_index.entry_names, UNATTRIBUTED_ZIP_ENTRY)
+        # -1 selects the trailing unattributed name
+        zip_entry_names[in_apk] = entry_names[entry_idx]
+    return zip_entry_names
 
-def find_map_entry(map_entries, addr: int) -> Optional[any]:
+
+def run_trace_query(query: str, trace: str) -> Iterator[Dict[str, str]]:
     """
-    Find the /proc/pid/map entry matching address
+    Stream the rows of a query from a new trace_processor as they are produced
     """
-    for map_entry in map_entries:
-        if map_entry["begin_address"] <= addr <= map_entry["end_address"]:
-            return map_entry
-    return None
+    with tempfile.NamedTemporaryFile("w", suffix=".sql") as query_file:
+        query_file.write(query)
+        query_file.flush()
+
+        p = subprocess.Popen(
+            ["./trace_processor", "-q", query_file.name, trace],
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        try:
+            # The query output is preceded by blank lines
+            yield from csv.DictReader(line for line in p.stdout if line.strip())
+        except GeneratorExit:
+            # The consumer stopped early
+            p.kill()
+            raise
+        finally:
+            p.stdout.close()
+            p.wait()
 
+    if p.returncode != 0:
+        raise subprocess.CalledProcessError(p.returncode, p.args)
 
-def find_zip_entry(zip_entries, offset: int) -> Optional[any]:
+
+class TraceSession:
     """
-    Find the zip entry matching file offset.
+    Runs queries against a trace loaded once into a long-lived trace_processor.
 
-    This assumes that the zip entries are ordered by offset
+    Query results are cached on disk keyed by the trace's content hash and the query text, so re-processing an
+    unchanged trace does not start trace_processor at all. If the perfetto Python package is missing, each uncached
+    query falls back to a new trace_processor that loads the whole trace again, which is logged once per session.
+    Queries are measured as the trace_processor stage of the profiler.
     """
-    for zip_entry in reversed(zip_entries):
-        if zip_entry["offset"] < offset:
-            return zip_entry
-    return None
 
+    def __init__(self, trace: str, profiler: Optional["StageProfiler"] = None):
+        self.trace = trace
+        self.profiler = profiler or StageProfiler(enabled=False)
+        self.cache_dir = get_cache_dir("trace_queries")
+        self._trace_hash = None
+        self._trace_processor = None
+        self._warned_cold_queries = False
+
+    def trace_hash(self) -> str:
+        if not self._trace_hash:
+            sha = hashlib.sha256()
+            with open(self.trace, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    sha.update(block)
+            self._trace_hash = sha.hexdigest()
+        return self._trace_hash
+
+    def _run(self, query: str) -> Iterator[Dict]:
+        if TraceProcessor is None:
+            if not self._warned_cold_queries:
+                print(
+                    "The perfetto package is not installed (run uv sync), "
+                    f"each query loads {self.trace} into a new trace_processor"
+                )
+                self._warned_cold_queries = True
+            yield from run_trace_query(query, self.trace)
+            return
+
+        if self._trace_processor is None:
+            self._trace_processor = TraceProcessor(
+                trace=self.trace,
+                config=TraceProcessorConfig(
+                    bin_path="./trace_processor",
+                    # Queries read ftrace events from the ftrace_event table
+                    ingest_ftrace_in_raw=True,
+                ),
+            )
+        result = self._trace_processor.query(query)
+        for row in result:
+            yield {name: getattr(row, name) for name in result.column_names}
+
+    def cache_query(self, query: str) -> str:
+        """
+        Run the query unless its results are already cached
+
+        @returns the path of the cached results
+        """
+        with self.profiler.stage("trace_processor"):
+            query_hash = hashlib.sha256(query.encode("utf-8")).hexdigest()
+            cache_path = os.path.join(
+                self.cache_dir, f"{self.trace_hash()}-{query_hash}.csv"
+            )
 
-def parse_user_page_faults(
-    process_name: str, output_dir: str, trace: str
-) -> List[Dict]:
-    query = f"""
-        INCLUDE PERFETTO MODULE android.startup.startups;
+            if not os.path.exists(cache_path):
+                # Write to a temporary file so interrupted queries are not cached
+                partial_path = f"{cache_path}.{os.getpid()}.partial"
+                with open(partial_path, "w", newline="") as f:
+                    writer = None
+                    for row in self._run(query):
+                        if writer is None:
+                            writer = csv.DictWriter(f, fieldnames=list(row))
+                            writer.writeheader()
+                        writer.writerow(row)
+                os.replace(partial_path, cache_path)
+        return cache_path
+
+    def query_chunks(
+        self, queries: Iterable[str], raw_output: Optional[str] = None
+    ) -> Iterator[Dict]:
+        """
+        Stream the rows of queries returning consecutive chunks of one result, running each query once the previous
+        one has been consumed.
+
+        If provided, the concatenated results are also written to `raw_output` as csv
+        """
+        with open(raw_output or os.devnull, "w", newline="") as raw_file:
+            wrote_header = False
+            for query in queries:
+                cache_path = self.cache_query(query)
+                with open(cache_path, newline="") as f:
+                    # Queries without results are cached as empty files
+                    header = f.readline()
+                    if header and not wrote_header:
+                        raw_file.write(header)
+                        wrote_header = True
+                    shutil.copyfileobj(f, raw_file)
+                with open(cache_path, newline="") as f:
+                    yield from csv.DictReader(f)
+
+    def query(self, query: str, raw_output: Optional[str] = None) -> Iterator[Dict]:
+        """
+        Stream the rows of a query.
+
+        If provided, the query results are also written to `raw_output` as csv
+        """
+        cache_path = self.cache_query(query)
+        if raw_output:
+            shutil.copyfile(cache_path, raw_output)
+        with open(cache_path, newline="") as f:
+            yield from csv.DictReader(f)
+
+    def close(self):
+        if self._trace_processor is not None:
+            self._trace_processor.close()
+            self._trace_processor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def chunked(
+    rows: Iterable[Dict], chunk_size: int, chunk_ns: Optional[int] = None
+) -> Iterator[List[Dict]]:
+    """
+    Split rows into chunks of at most `chunk_size` rows. If `chunk_ns` is provided, a chunk also ends once the ts of
+    a row is `chunk_ns` or more after the first row of the chunk, which requires rows ordered by ts.
+    """
+    chunk = []
+    for row in rows:
+        if chunk_ns is not None and chunk and row["ts"] - chunk[0]["ts"] >= chunk_ns:
+            yield chunk
+            chunk = []
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def sql_string(value: str) -> str:
+    """
+    Quote a value as a SQL string literal
+    """
+    return "'" + value.replace("'", "''") + "'"
 
-        SELECT
-        ftrace_event.ts,
-        process.name as process_name,
-        thread.name as thread_name,
-        EXTRACT_ARG(ftrace_event.arg_set_id, "address")  as address,
-        EXTRACT_ARG(ftrace_event.arg_set_id, "ip")  as ip
-        FROM ftrace_event
-            left join thread ON ftrace_event.utid = thread.utid
-            left join process ON thread.upid = process.upid
-        WHERE
-        ftrace_event.name = 'page_fault_user'
-        AND ftrace_event.ts >= (SELECT MIN(ts) from android_startups WHERE package = process.name)
-        AND ftrace_event.ts <= (SELECT MIN(ts_end) from android_startups WHERE package = process.name)
-        AND process.name = '{process_name}'
-        ORDER BY ts ASC
+
+def get_bounds_query(bounds: Optional[Tuple[int, int]]) -> Tuple[str, str]:
+    """
+    @returns the modules to include and the query of the inclusive (ts_start, ts_end) bounds, the startup of the
+    process in the `params` table by default
     """
+    if bounds is None:
+        return (
+            "INCLUDE PERFETTO MODULE android.startup.startups;",
+            """
+            SELECT MIN(ts) AS ts_start, MIN(ts_end) AS ts_end
+            FROM android_startups
+            WHERE package = (SELECT process_name FROM params)
+            """,
+        )
+    return "", f"SELECT {int(bounds[0])} AS ts_start, {int(bounds[1])} AS ts_end"
 
-    with open("/tmp/query.sql", "w") as file:
-        file.write(query)
 
-    subprocess.run(
-        f"./trace_processor -q /tmp/query.sql {trace} > {os.path.join(output_dir, 'faults.csv')}",
-        check=True,
-        shell=True,
+def process_events_query(
+    event_name: str,
+    process_name: str,
+    select: str,
+    bounds: Optional[Tuple[int, int]] = None,
+) -> str:
+    """
+    Build a query over the `event_name` ftrace events of a process between the inclusive `bounds` timestamps, or
+    during its startup by default.
+
+    The bounds are computed once and events are narrowed down by name, thread and time before `select` runs
+    against the `events` table (ts, arg_set_id, process_name, thread_name, tid), so args are only extracted for
+    matches.
+    """
+    include, bounds_query = get_bounds_query(bounds)
+    return f"""
+        {include}
+
+        WITH
+        params AS (
+            SELECT {sql_string(process_name)} AS process_name
+        ),
+        bounds AS (
+            {bounds_query}
+        ),
+        process_threads AS (
+            SELECT thread.utid, thread.tid, process.name AS process_name, thread.name AS thread_name
+            FROM thread
+                JOIN process ON thread.upid = process.upid
+            WHERE process.name = (SELECT process_name FROM params)
+        ),
+        events AS (
+            SELECT
+            ftrace_event.ts,
+            ftrace_event.arg_set_id,
+            process_threads.process_name,
+            process_threads.thread_name,
+            process_threads.tid
+            FROM ftrace_event
+                JOIN process_threads ON ftrace_event.utid = process_threads.utid
+            WHERE
+            ftrace_event.name = {sql_string(event_name)}
+            AND ftrace_event.ts >= (SELECT ts_start FROM bounds)
+            AND ftrace_event.ts <= (SELECT ts_end FROM bounds)
+        )
+        {select}
+    """
+
+
+def user_page_faults_query(
+    process_name: str, bounds: Optional[Tuple[int, int]] = None
+) -> str:
+    return process_events_query(
+        "page_fault_user",
+        process_name,
+        """
+        SELECT
+        ts,
+        process_name,
+        thread_name,
+        tid,
+        EXTRACT_ARG(arg_set_id, "address")  as address,
+        EXTRACT_ARG(arg_set_id, "ip")  as ip
+        FROM events
+        ORDER BY ts ASC
+        """,
+        bounds,
     )
 
-    user_page_fault_entries = []
-    with open(os.path.join(output_dir, "faults.csv")) as csv_file:
-        next(csv_file)
-        csv_reader = csv.DictReader(csv_file)
 
-        for row in csv_reader:
-            row["address"] = int(row["address"])
-            user_page_fault_entries.append(row)
+def add_to_page_cache_query(
+    process_name: str, bounds: Optional[Tuple[int, int]] = None
+) -> str:
+    return process_events_query(
+        "mm_filemap_add_to_page_cache",
+        process_name,
+        """
+        SELECT
+        ts,
+        process_name,
+        thread_name,
+        tid,
+        EXTRACT_ARG(arg_set_id, "s_dev")  as sdev,
+        EXTRACT_ARG(arg_set_id, "i_ino")  as inode,
+        EXTRACT_ARG(arg_set_id, "index")  as offset
+        FROM events
+        ORDER BY ts ASC
+        """,
+        bounds,
+    )
 
-    return user_page_fault_entries
 
+def page_cache_inodes_query(
+    process_name: str, bounds: Optional[Tuple[int, int]] = None
+) -> str:
+    return process_events_query(
+        "mm_filemap_add_to_page_cache",
+        process_name,
+        """
+        SELECT DISTINCT
+        EXTRACT_ARG(arg_set_id, "s_dev")  as sdev,
+        EXTRACT_ARG(arg_set_id, "i_ino")  as inode
+        FROM events
+        """,
+        bounds,
+    )
 
-def parse_add_to_page_cache(
-    process_name: str, output_dir: str, trace: str
-) -> List[Dict]:
-    query = f"""
-        INCLUDE PERFETTO MODULE android.startup.startups;
 
+def io_stalls_query(process_name: str, bounds: Optional[Tuple[int, int]] = None) -> str:
+    """
+    Build a query over the uninterruptible sleeps of the threads of a process, which is how threads wait for disk I/O
+    """
+    include, bounds_query = get_bounds_query(bounds)
+    return f"""
+        {include}
+
+        WITH
+        params AS (
+            SELECT {sql_string(process_name)} AS process_name
+        ),
+        bounds AS (
+            {bounds_query}
+        )
         SELECT
-        ftrace_event.ts,
-        process.name as process_name,
-        thread.name as thread_name,
-        EXTRACT_ARG(ftrace_event.arg_set_id, "s_dev")  as sdev,
-        EXTRACT_ARG(ftrace_event.arg_set_id, "i_ino")  as inode,
-        EXTRACT_ARG(ftrace_event.arg_set_id, "index")  as offset
-        FROM ftrace_event
-            left join thread ON ftrace_event.utid = thread.utid
-            left join process ON thread.upid = process.upid
+        thread_state.ts,
+        thread_state.dur,
+        thread.tid
+        FROM thread_state
+            JOIN thread ON thread_state.utid = thread.utid
+            JOIN process ON thread.upid = process.upid
         WHERE
-        ftrace_event.name = 'mm_filemap_add_to_page_cache'
-        AND ftrace_event.ts >= (SELECT MIN(ts) from android_startups WHERE package = process.name)
-        AND ftrace_event.ts <= (SELECT MIN(ts_end) from android_startups WHERE package = process.name)
-        AND process.name = '{process_name}'
-        ORDER BY ts ASC
+        process.name = (SELECT process_name FROM params)
+        AND thread_state.state IN ('D', 'DK')
+        AND thread_state.ts >= (SELECT ts_start FROM bounds)
+        AND thread_state.ts <= (SELECT ts_end FROM bounds)
+        ORDER BY thread_state.ts ASC
     """
 
-    with open("/tmp/query.sql", "w") as file:
-        file.write(query)
 
-    subprocess.run(
-        f"./trace_processor -q /tmp/query.sql {trace} > {os.path.join(output_dir, 'faults.csv')}",
-        check=True,
-        shell=True,
+def parse_user_page_faults(
+    session: TraceSession,
+    process_name: str,
+    output_dir: str,
+    ranges: Optional[List[Tuple[int, int]]] = None,
+) -> Iterator[Dict]:
+    queries = [
+        user_page_faults_query(process_name, bounds)
+        for bounds in ([None] if ranges is None else ranges)
+    ]
+    for row in session.query_chunks(
+        queries, raw_output=os.path.join(output_dir, "faults.csv")
+    ):
+        row["ts"] = int(row["ts"])
+        row["tid"] = int(row["tid"])
+        row["address"] = int(row["address"])
+        yield row
+
+
+def parse_add_to_page_cache(
+    session: TraceSession,
+    process_name: str,
+    output_dir: str,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    ranges: Optional[List[Tuple[int, int]]] = None,
+) -> Iterator[Dict]:
+    queries = [
+        add_to_page_cache_query(process_name, bounds)
+        for bounds in ([None] if ranges is None else ranges)
+    ]
+    for row in session.query_chunks(
+        queries, raw_output=os.path.join(output_dir, "faults.csv")
+    ):
+        row["ts"] = int(row["ts"])
+        row["tid"] = int(row["tid"])
+        row["sdev"] = int(row["sdev"])
+        row["inode"] = int(row["inode"])
+        # Use byte offests to match user_page_faults
+        row["offset"] = int(row["offset"]) * page_size
+        yield row
+
+
+def parse_page_cache_inodes(
+    session: TraceSession,
+    process_name: str,
+    ranges: Optional[List[Tuple[int, int]]] = None,
+) -> List[Tuple[int, int]]:
+    """
+    Returns the distinct (s_dev, i_ino) pairs added to the page cache by the process during startup, or within the
+    time ranges if provided
+    """
+    queries = [
+        page_cache_inodes_query(process_name, bounds)
+        for bounds in ([None] if ranges is None else ranges)
+    ]
+    return list(
+        dict.fromkeys(
+            (int(row["sdev"]), int(row["inode"]))
+            for row in session.query_chunks(queries)
+        )
     )
 
-    user_page_fault_entries = []
-    with open(os.path.join(output_dir, "faults.csv")) as csv_file:
-        next(csv_file)
-        csv_reader = csv.DictReader(csv_file)
 
-        for row in csv_reader:
-            row["sdev"] = int(row["sdev"])
-            row["inode"] = int(row["inode"])
-            # Use byte offests to match user_page_faults
-            row["offset"] = int(row["offset"]) * PAGE_SIZE
-            user_page_fault_entries.append(row)
+@dataclass
+class Window:
+    """
+    A time range of the trace whose faults are also written to <output>/windows/<name>. Bounds are inclusive.
+    """
+
+    name: str
+    ts_start: int
+    ts_end: int
+
+
+def parse_window_spec(spec: str) -> Tuple[str, Optional[str]]:
+    """
+    Parse a window spec: startup, startup:N, slice:GLOB, ts:START-END or full
+
+    @returns the kind and value of the window spec
+    """
+    kind, _, value = spec.partition(":")
+    if (
+        (kind == "startup" and (not value or value.isdigit()))
+        or (kind == "slice" and value)
+        or (kind == "ts" and re.fullmatch(r"(\d+)-(\d+)", value))
+        or (kind == "full" and not value)
+    ):
+        return kind, value or None
+    raise ValueError(f"Invalid window: {spec}")
+
+
+def window_spec(spec: str) -> str:
+    """
+    Validate a --window argument
+    """
+    parse_window_spec(spec)
+    return spec
+
+
+def window_name(name: str) -> str:
+    """
+    Make a slice name usable as a directory name
+    """
+    return re.sub(r"[^\w.-]+", "_", name).strip("_") or "slice"
+
+
+def resolve_windows(
+    session: TraceSession, process_name: str, specs: Sequence[str]
+) -> List[Window]:
+    """
+    Find the time ranges of the window specs in the trace. Specs matching several startups or slices resolve to
+    one window per match, numbered in time order.
+    """
+    windows: Dict[str, Window] = {}
+    for spec in specs:
+        kind, value = parse_window_spec(spec)
+        if kind == "ts":
+            ts_start, ts_end = map(int, value.split("-"))
+            bounds = [(f"ts_{ts_start}_{ts_end}", ts_start, ts_end)]
+        elif kind == "full":
+            row = next(
+                session.query(
+                    "SELECT start_ts AS ts, end_ts AS ts_end FROM trace_bounds"
+                )
+            )
+            bounds = [("full", int(row["ts"]), int(row["ts_end"]))]
+        else:
+            if kind == "startup":
+                query = f"""
+                    INCLUDE PERFETTO MODULE android.startup.startups;
+
+                    SELECT ts, ts_end
+                    FROM android_startups
+                    WHERE package = {sql_string(process_name)}
+                    ORDER BY ts ASC
+                """
+                prefix = "startup"
+            else:
+                # Slices that had not ended when the trace stopped have a negative duration
+                query = f"""
+                    SELECT
+                    ts,
+                    IIF(dur < 0, (SELECT end_ts FROM trace_bounds), ts + dur) AS ts_end
+                    FROM slice
+                    WHERE name GLOB {sql_string(value)}
+                    ORDER BY ts ASC
+                """
+                prefix = window_name(value)
+            bounds = [
+                (f"{prefix}_{i}", int(row["ts"]), int(row["ts_end"]))
+                for i, row in enumerate(session.query(query))
+                if row["ts_end"]
+            ]
+            if kind == "startup" and value is not None:
+                bounds = [b for b in bounds if b[0] == f"startup_{value}"]
+
+        if not bounds:
+            print(f"No window matches {spec}")
+        for name, ts_start, ts_end in bounds:
+            windows[name] = Window(name, ts_start, ts_end)
+    return list(windows.values())
+
+
+def get_window_ranges(windows: List[Window]) -> List[Tuple[int, int]]:
+    """
+    @returns inclusive time ranges covering the windows in time order, merged where windows overlap
+    """
+    merged: List[Tuple[int, int]] = []
+    for window in sorted(windows, key=lambda w: w.ts_start):
+        if merged and window.ts_start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], window.ts_end))
+        else:
+            merged.append((window.ts_start, window.ts_end))
+    return merged
 
-    return user_page_fault_entries
 
+def resolve_query_ranges(
+    session: TraceSession, process_name: str, window_specs: Sequence[str]
+) -> Tuple[List[Window], Optional[List[Tuple[int, int]]]]:
+    """
+    @returns the windows and the time ranges to query for them, one query per range, or no ranges to query the
+    startup without windows
+    """
+    if not window_specs:
+        return [], None
+    windows = resolve_windows(session, process_name, window_specs)
+    return windows, get_window_ranges(windows)
 
-def dump_maps(package_name: str, output_dir: str):
+
+def dump_maps(device: DeviceSession, package_name: str, output_dir: str):
     print("Dumping maps...")
-    pid = subprocess.check_output(
-        f"adb shell pidof {package_name}", encoding="utf-8", shell=True
-    ).strip()
-    result = run_root_shell(
-        f"cat /proc/{pid}/maps", check=True, capture_output=True, text=True
-    )
+    pid = device.run(f"pidof {shlex.quote(package_name)}", check=True).stdout.strip()
+    result = device.run(f"cat /proc/{pid}/maps", check=True)
     with open(os.path.join(output_dir, "maps.txt"), "w", encoding="utf-8") as f:
         f.write(result.stdout)
 
 
-def dump_inodes(output_dir: str):
+def get_package_dirs(device: DeviceSession, package_name: str) -> List[str]:
+    """
+    Returns the install directories of the package (e.g. /data/app/~~.../<package>-.../)
+    """
+    output = device.run(f"pm path {shlex.quote(package_name)}", check=True).stdout
+    return sorted(
+        set(
+            os.path.dirname(line[len("package:") :].strip())
+            for line in output.splitlines()
+            if line.startswith("package:")
+        )
+    )
+
+
+def find_inodes(
+    device: DeviceSession, search_dirs: List[str], inodes: Set[Tuple[int, int]]
+) -> Dict[Tuple[int, int], str]:
+    """
+    Resolve the file paths of (dev, inode) pairs by searching the given directories on the device
+    """
+    resolved = {}
+    inode_numbers = sorted(set(inode for _, inode in inodes))
+    for i in range(0, len(inode_numbers), INODE_BATCH_SIZE):
+        inum_filter = " -o ".join(
+            f"-inum {inode}" for inode in inode_numbers[i : i + INODE_BATCH_SIZE]
+        )
+        dirs = " ".join(shlex.quote(d) for d in search_dirs)
+        command = f'find {dirs} \\( {inum_filter} \\) -print0 2>/dev/null | xargs -0 stat -c "%d %i %n"'
+        # find exits with an error for unreadable directories, which is expected
+        result = device.run(command)
+        for (dev, inode), file_name in parse_inode_lines(result.stdout).items():
+            if (dev, inode) in inodes:
+                resolved[(dev, inode)] = file_name
+    return resolved
+
+
+def resolve_inodes(
+    device: DeviceSession, package_name: str, inodes: Iterable[Tuple[int, int]]
+) -> Dict[Tuple[int, int], str]:
+    """
+    Resolve the file paths of (dev, inode) pairs.
+
+    The search is scoped to the package's install directory first, then the read-only partitions and finally the
+    rest of /data. Files on read-only partitions are cached per build fingerprint.
+    """
+    unresolved = set(inodes)
+
+    fingerprint = device.fingerprint
+    cache_path = os.path.join(
+        get_cache_dir("inodes"),
+        f"{hashlib.sha256(fingerprint.encode('utf-8')).hexdigest()}.txt",
+    )
+    cached = {}
+    if os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cached = parse_inode_lines(f.read())
+
+    resolved = {inode: cached[inode] for inode in unresolved if inode in cached}
+    unresolved -= resolved.keys()
+
+    for search_dirs in [
+        get_package_dirs(device, package_name),
+        READ_ONLY_PARTITIONS,
+        ["/data"],
+    ]:
+        if not unresolved or not search_dirs:
+            continue
+        found = find_inodes(device, search_dirs, unresolved)
+        resolved.update(found)
+        unresolved -= found.keys()
+
+    cached.update(
+        (inode, file_name)
+        for inode, file_name in resolved.items()
+        if file_name.startswith(tuple(f"{p}/" for p in READ_ONLY_PARTITIONS))
+    )
+    with open(cache_path, "w", encoding="utf-8") as f:
+        f.write(format_inode_lines(cached))
+    return resolved
+
+
+def dump_inodes(
+    device: DeviceSession,
+    package_name: str,
+    output_dir: str,
+    inodes: Iterable[Tuple[int, int]],
+):
+    """
+    Resolve only the (dev, inode) pairs that appear in the trace
+    """
     print("Dumping inodes...")
+    inodes = set(inodes)
+    resolved = resolve_inodes(device, package_name, inodes)
+    if len(resolved) < len(inodes):
+        print(f"Unable to resolve {len(inodes) - len(resolved)} inodes")
 
-    command = 'find /apex /system /data /vendor -print0 | xargs -0 stat -c "%d %i %n"'
-    result = run_root_shell(command, check=True, capture_output=True, text=True)
     with open(os.path.join(output_dir, "inodes.txt"), "w", encoding="utf-8") as f:
-        f.write(result.stdout.strip())
+        f.write(format_inode_lines(resolved))
 
 
-def is_emulator() -> bool:
-    try:
-        result = subprocess.run(
-            ["adb", "shell", "getprop", "ro.boot.qemu"],
-            capture_output=True,
-            text=True,
+def is_emulator(device: DeviceSession) -> bool:
+    return device.getprop("ro.boot.qemu") == "1"
+
+
+def launch_app(device: DeviceSession, package_name: str):
+    """
+    Launch the package's launcher activity and wait for it to be displayed
+    """
+    quoted_package = shlex.quote(package_name)
+    result = device.run(
+        f"cmd package resolve-activity --brief -c android.intent.category.LAUNCHER {quoted_package}"
+    )
+    lines = result.stdout.strip().splitlines()
+    if result.returncode == 0 and lines and "/" in lines[-1]:
+        device.run(f"am start -W -n {shlex.quote(lines[-1])}", check=True)
+    else:
+        device.run(
+            f"monkey -p {quoted_package} -c android.intent.category.LAUNCHER 1",
             check=True,
         )
-        return result.stdout.strip() == "1"
-    except subprocess.CalledProcessError:
-        return False
 
 
-def collect_trace(package_name: str, output_dir: str):
+def prepare_cold_start(device: DeviceSession, package_name: str):
     """
-    Collect trace data from the Android device.
-
-    Args:
-        package_name: Name of the Android package to trace
-        output_dir: Directory where trace files will be saved
+    Stop the package and clear the page cache so its next launch is a cold start
     """
     # Stop the package
     print("Force stopping process...")
-    subprocess.run(
-        ["adb", "shell", "am", "force-stop", package_name],
-        check=True,
-        text=True,
-    )
+    device.run(f"am force-stop {shlex.quote(package_name)}", check=True)
 
     # Clear page cache
     print("Clearing page cache...")
-    sdk_version = get_device_sdk_version()
-    if sdk_version < 31:
-        run_root_shell("echo 3 > /proc/sys/vm/drop_caches", check=True)
+    if device.sdk_version < 31:
+        device.run("echo 3 > /proc/sys/vm/drop_caches", check=True)
     else:
-        run_root_shell("setprop perf.drop_caches 3", check=True)
+        device.run("setprop perf.drop_caches 3", check=True)
         # Wait until `getprop` returns a value
-        while (
-            subprocess.check_output(
-                ["adb", "shell", "getprop", "perf.drop_caches"], text=True
-            ).strip()
-            != "0"
-        ):
-            time.sleep(0.1)
+        device.wait_for_prop("perf.drop_caches", "0")
+
+
+def collect_trace(
+    device: DeviceSession,
+    package_name: str,
+    output_dir: str,
+    launch: bool = False,
+    settle_time: float = DEFAULT_SETTLE_TIME,
+):
+    """
+    Collect trace data from the Android device.
+
+    Args:
+        device: Session to the device to trace
+        package_name: Name of the Android package to trace
+        output_dir: Directory where trace files will be saved
+        launch: Launch the app and stop tracing once it settled instead of waiting for the user
+        settle_time: Seconds to keep tracing after the app launched
+    """
+    prepare_cold_start(device, package_name)
 
     # Start tracing
     trace_file = os.path.join(output_dir, "faults.pftrace")
 
     # Start the trace process
+    p = None
     try:
         p = subprocess.Popen(
-            f"./record_android_trace -c ftrace.config -n -o {trace_file} -tt",
+            [
+                "./record_android_trace",
+                "-c",
+                "ftrace.config",
+                "-n",
+                "-o",
+                trace_file,
+                "-tt",
+            ]
+            + (["--serial", device.serial] if device.serial else []),
             stdin=subprocess.PIPE,
-            shell=True,
         )
+        if launch:
+            time.sleep(TRACE_START_DELAY)
+            print("Launching app...")
+            launch_app(device, package_name)
+            time.sleep(settle_time)
+            # Stop tracing the same way as Ctrl-C
+            p.send_signal(signal.SIGINT)
         p.wait()
     except KeyboardInterrupt:
         print("Tracing stopped. Waiting for process to finish...")
@@ -280,89 +1111,329 @@ def collect_trace(package_name: str, output_dir: str):
         print(f"Trace collected at {trace_file}")
 
 
-def get_arch() -> str:
-    return subprocess.check_output(
-        "adb shell getprop ro.product.cpu.abi", shell=True, text=True
-    ).strip()
-
-
-def parse_maps(output_dir: str) -> List[Dict]:
+def parse_maps_lines(lines: Iterable[str]) -> List[Dict]:
     map_entries = []
 
     # Example line:
     # address space | perm | offset | dev (storage device) | inode | file path
     # 12c00000-52c00000 rw-p 00000000 00:00 0      [anon:dalvik-main space (region space)]
     # 77593e689000-77593e693000: 77593e689000-77593e693000 r--p 00148000 07:30 14     /apex/com.android.runtime/bin/linker64
-    with open(f"{output_dir}/maps.txt") as file:
-        for line in file.readlines():
-            columns = re.split(r"\s+", line.strip())
+    for line in lines:
+        columns = re.split(r"\s+", line.strip())
 
-            addr_space = columns[0]
-            offset = columns[2]
-            inode = columns[4]
+        addr_space = columns[0]
+        offset = columns[2]
+        inode = columns[4]
 
-            # Only consider files on disk
-            if int(inode) == 0 or " (deleted)" in line:
-                continue
+        # Only consider files on disk
+        if int(inode) == 0 or " (deleted)" in line:
+            continue
 
-            file_path = columns[-1]
+        file_path = columns[-1]
 
-            [begin_addr, end_addr] = addr_space.split("-")
+        [begin_addr, end_addr] = addr_space.split("-")
 
-            map_entries.append(
-                {
-                    "begin_address": int(begin_addr, 16),
-                    "end_address": int(end_addr, 16),
-                    "file_name": file_path,
-                    "offset": int(offset, 16),
-                }
-            )
+        map_entries.append(
+            {
+                "begin_address": int(begin_addr, 16),
+                "end_address": int(end_addr, 16),
+                "file_name": file_path,
+                "offset": int(offset, 16),
+            }
+        )
 
     return map_entries
 
 
-def pull_apks(file_names: List[str], output_dir: str) -> Dict[str, List[Dict]]:
-    print("Pulling APKs...")
-    # Pull APKs to compute the offsets of files within
-    pulled_apks = {}
+def parse_maps(output_dir: str) -> List[Dict]:
+    with open(f"{output_dir}/maps.txt") as file:
+        return parse_maps_lines(file.readlines())
+
+
+def read_device_file_range(
+    device: DeviceSession, file_path: str, offset: int, length: int
+) -> bytes:
+    """
+    Read `length` bytes at `offset` of a file on the device without pulling the whole file
+    """
+    block_size = 4096
+    first_block = offset // block_size
+    block_count = (offset + length + block_size - 1) // block_size - first_block
+    # Base64 keeps the binary output intact through the adb shell
+    result = device.run(
+        f"dd if={shlex.quote(file_path)} bs={block_size} skip={first_block} count={block_count} 2>/dev/null | base64",
+        check=True,
+    )
+    data = base64.b64decode(result.stdout)
+    start = offset - first_block * block_size
+    return data[start : start + length]
+
+
+def read_device_file_fields(
+    device: DeviceSession, file_path: str, offsets: Sequence[int], length: int
+) -> List[bytes]:
+    """
+    Read `length` bytes at each offset of a file on the device in a single round trip
+    """
+    if not offsets:
+        return []
+    # Single byte blocks let dd skip to any offset
+    result = device.run(
+        f"for offset in {' '.join(str(offset) for offset in offsets)}; do "
+        f"dd if={shlex.quote(file_path)} bs=1 skip=$offset count={length} 2>/dev/null; "
+        "done | base64",
+        check=True,
+    )
+    data = base64.b64decode(result.stdout)
+    if len(data) != length * len(offsets):
+        raise ValueError(f"Short read of {file_path}")
+    return [data[i : i + length] for i in range(0, len(data), length)]
+
+
+def find_entries_end(footer: bytes, central_directory_offset: int) -> int:
+    """
+    Find where the zip entries end from the bytes right before the central directory
+
+    @returns the start of the APK signing block, or the central directory offset for zips without one
+    """
+    if len(footer) == APK_SIG_BLOCK_FOOTER_SIZE:
+        block_size, magic = struct.unpack(APK_SIG_BLOCK_FOOTER_FORMAT, footer)
+        block_start = (
+            central_directory_offset - block_size - APK_SIG_BLOCK_SIZE_FIELD_SIZE
+        )
+        if magic == APK_SIG_BLOCK_MAGIC and block_start >= 0:
+            return block_start
+    return central_directory_offset
+
+
+def parse_central_directory(central_directory: bytes) -> List[Tuple[int, str, int]]:
+    """
+    Parse the raw bytes of a zip central directory
+
+    @returns the local header offset, name and compressed size of each entry, sorted by local header offset
+    """
+    entries = []
+    pos = 0
+    while pos + ZIP_CENTRAL_HEADER_SIZE <= len(central_directory):
+        (
+            signature,
+            _version_made_by,
+            _version_needed,
+            flags,
+            _compression,
+            _mod_time,
+            _mod_date,
+            _crc,
+            compress_size,
+            _file_size,
+            name_length,
+            extra_length,
+            comment_length,
+            _disk_start,
+            _internal_attrs,
+            _external_attrs,
+            header_offset,
+        ) = struct.unpack_from(ZIP_CENTRAL_HEADER_FORMAT, central_directory, pos)
+        if signature != ZIP_CENTRAL_HEADER_SIGNATURE:
+            break
+
+        name_start = pos + ZIP_CENTRAL_HEADER_SIZE
+        raw_name = central_directory[name_start : name_start + name_length]
+        # Bit 11 flags UTF-8 names, otherwise zip names are cp437
+        name = raw_name.decode("utf-8" if flags & 0x800 else "cp437")
+        entries.append((header_offset, name, compress_size))
+        pos = name_start + name_length + extra_length + comment_length
+
+    entries.sort()
+    return entries
+
+
+def build_apk_index(
+    entries: List[Tuple[int, str, int]],
+    local_header_lengths: List[bytes],
+    entries_end: int,
+) -> ApkIndex:
+    """
+    Build an ApkIndex from the central directory entries and the name and extra field lengths of their local headers,
+    which locate the data exactly as the local extra field can be longer than the central directory's. `entries_end`
+    bounds the last entry.
+    """
+    header_offsets = np.array([e[0] for e in entries], dtype=np.int64)
+    sizes = np.array([e[2] for e in entries], dtype=np.int64)
+    lengths = np.array(
+        [
+            struct.unpack(ZIP_LOCAL_HEADER_LENGTHS_FORMAT, header_lengths)
+            for header_lengths in local_header_lengths
+        ],
+        dtype=np.int64,
+    ).reshape(-1, 2)
+    data_offsets = header_offsets + ZIP_LOCAL_HEADER_SIZE + lengths.sum(axis=1)
+    # Never overlap the next entry (or the signing block / central directory) in malformed zips
+    next_offsets = np.append(header_offsets[1:], entries_end)
+    return ApkIndex(
+        entry_names=np.array([e[1] for e in entries], dtype=object),
+        header_offsets=header_offsets,
+        end_offsets=np.minimum(data_offsets + sizes, next_offsets),
+        sizes=sizes,
+    )
+
+
+def read_apk_index(device: DeviceSession, file_path: str, file_size: int) -> ApkIndex:
+    """
+    Index an APK on the device by reading only its end of central directory record, central directory and the
+    lengths in its local headers
+    """
+    tail_length = min(file_size, ZIP_EOCD_SIZE + ZIP_MAX_COMMENT_LENGTH)
+    tail = read_device_file_range(
+        device, file_path, file_size - tail_length, tail_length
+    )
+    eocd = tail.rfind(ZIP_EOCD_SIGNATURE)
+    if eocd < 0:
+        raise ValueError(f"No end of central directory record found in {file_path}")
+
+    (
+        _signature,
+        _disk,
+        _central_directory_disk,
+        _disk_entries,
+        _total_entries,
+        central_directory_size,
+        central_directory_offset,
+        _comment_length,
+    ) = struct.unpack_from(ZIP_EOCD_FORMAT, tail, eocd)
+    if 0xFFFFFFFF in (central_directory_size, central_directory_offset):
+        raise ValueError(f"Zip64 archives are not supported: {file_path}")
+
+    # Read the signing block footer along with the central directory
+    footer_length = min(central_directory_offset, APK_SIG_BLOCK_FOOTER_SIZE)
+    data = read_device_file_range(
+        device,
+        file_path,
+        central_directory_offset - footer_length,
+        footer_length + central_directory_size,
+    )
+    entries = parse_central_directory(data[footer_length:])
+    local_header_lengths = read_device_file_fields(
+        device,
+        file_path,
+        [e[0] + ZIP_LOCAL_HEADER_LENGTHS_OFFSET for e in entries],
+        ZIP_LOCAL_HEADER_LENGTHS_SIZE,
+    )
+    return build_apk_index(
+        entries,
+        local_header_lengths,
+        find_entries_end(data[:footer_length], central_directory_offset),
+    )
+
+
+def apk_index_from_json(cached: Dict) -> ApkIndex:
+    return ApkIndex(
+        entry_names=np.array(cached["entry_names"], dtype=object),
+        header_offsets=np.array(cached["header_offsets"], dtype=np.int64),
+        end_offsets=np.array(cached["end_offsets"], dtype=np.int64),
+        sizes=np.array(cached["sizes"], dtype=np.int64),
+    )
+
+
+def apk_index_to_json(apk_index: ApkIndex) -> Dict:
+    return {
+        "entry_names": apk_index.entry_names.tolist(),
+        "header_offsets": apk_index.header_offsets.tolist(),
+        "end_offsets": apk_index.end_offsets.tolist(),
+        "sizes": apk_index.sizes.tolist(),
+    }
+
+
+def load_apk_index(cache_path: str) -> ApkIndex:
+    with open(cache_path) as f:
+        return apk_index_from_json(json.load(f))
+
+
+def save_apk_index(cache_path: str, apk_index: ApkIndex):
+    with open(cache_path, "w") as f:
+        json.dump(apk_index_to_json(apk_index), f)
+
+
+def load_apk_indexes(output_dir: str) -> Dict[str, ApkIndex]:
+    with open(os.path.join(output_dir, "apk_indexes.json")) as f:
+        return {
+            file_path: apk_index_from_json(cached)
+            for file_path, cached in json.load(f).items()
+        }
+
+
+def save_apk_indexes(output_dir: str, apk_indexes: Dict[str, ApkIndex]):
+    """
+    Save the APK indexes used by a run so it can be processed again without the device
+    """
+    with open(os.path.join(output_dir, "apk_indexes.json"), "w") as f:
+        json.dump(
+            {
+                file_path: apk_index_to_json(apk_index)
+                for file_path, apk_index in apk_indexes.items()
+            },
+            f,
+        )
+
+
+def get_cache_dir(name: str) -> str:
+    """
+    Returns a directory under the user's cache directory that persists across runs
+    """
+    cache_home = os.environ.get(
+        "XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")
+    )
+    cache_dir = os.path.join(cache_home, "android-fault-visualizer", name)
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def index_apks(device: DeviceSession, file_names: List[str]) -> Dict[str, ApkIndex]:
+    print("Indexing APKs...")
+    # Index the zip entries of APKs to compute the offsets of files within
+    apk_indexes = {}
+    cache_dir = get_cache_dir("apk_index")
 
     for file_path in file_names:
-        if file_path in pulled_apks or not file_path.endswith(".apk"):
+        if file_path in apk_indexes or not file_path.endswith(".apk"):
             continue
 
-        file_name = os.path.basename(file_path)
-        os.makedirs(os.path.join(output_dir, "artifacts"), exist_ok=True)
-        result = subprocess.run(
-            f"adb pull {file_path} {os.path.join(output_dir, 'artifacts', file_name)}",
-            shell=True,
-            stdout=subprocess.DEVNULL,
-        )
+        result = device.run(f"stat -c '%s %Y' {shlex.quote(file_path)}")
         if result.returncode != 0:
-            print(f"Failed to pull: {file_path}")
+            print(f"Failed to stat: {file_path}")
+            continue
+        file_size, mtime = (int(v) for v in result.stdout.split())
+
+        cache_key = hashlib.sha256(
+            f"{file_path}:{file_size}:{mtime}:{APK_INDEX_VERSION}".encode("utf-8")
+        ).hexdigest()
+        cache_path = os.path.join(cache_dir, f"{cache_key}.json")
+        if os.path.exists(cache_path):
+            apk_indexes[file_path] = load_apk_index(cache_path)
             continue
 
-        pulled_apks[file_path] = []
-        zf = ZipFile(os.path.join(output_dir, "artifacts", file_name))
-        for zinfo in zf.infolist():
-            pulled_apks[file_path].append(
-                {
-                    "file_name": zinfo.filename,
-                    "offset": int(zinfo.header_offset),
-                    "size": zinfo.compress_size,
-                }
-            )
+        try:
+            apk_index = read_apk_index(device, file_path, file_size)
+        except (subprocess.CalledProcessError, ValueError, struct.error) as e:
+            print(f"Failed to index: {file_path} ({e})")
+            continue
 
-    return pulled_apks
+        save_apk_index(cache_path, apk_index)
+        apk_indexes[file_path] = apk_index
 
+    return apk_indexes
 
-def compute_inode_mapping(output_dir: str) -> Dict[Tuple[int, int], str]:
-    with open(os.path.join(output_dir, "inodes.txt"), "r") as f:
-        inode_lines = f.read().split("\n")
 
+def parse_inode_lines(output: str) -> Dict[Tuple[int, int], str]:
+    """
+    Parse `stat -c "%d %i %n"` output, skipping lines that do not match (e.g. errors)
+    """
     inode_re = re.compile(r"^(?P<dev>[0-9]+)\s(?P<inode>[0-9]+)\s(?P<filename>.*)$")
     inode_mapping = {}
-    for line in inode_lines:
+    for line in output.split("\n"):
         match = inode_re.match(line)
+        if not match:
+            continue
         dev = int(match.group("dev"))
         inode = int(match.group("inode"))
         file_name = match.group("filename")
@@ -371,42 +1442,53 @@ def compute_inode_mapping(output_dir: str) -> Dict[Tuple[int, int], str]:
     return inode_mapping
 
 
-# Report the file sizes and APK entry sizes in a csv file
-def compute_file_sizes(
-    file_names: List[str], output_dir: str, pulled_apks: Dict[str, List[Dict]] = {}
+def format_inode_lines(inode_mapping: Dict[Tuple[int, int], str]) -> str:
+    return "\n".join(
+        f"{dev} {inode} {file_name}"
+        for (dev, inode), file_name in sorted(inode_mapping.items())
+    )
+
+
+def compute_inode_mapping(output_dir: str) -> Dict[Tuple[int, int], str]:
+    with open(os.path.join(output_dir, "inodes.txt"), "r") as f:
+        return parse_inode_lines(f.read())
+
+
+# Report the file sizes and APK entry sizes in a csv file
+def get_file_sizes(device: DeviceSession, file_names: List[str]) -> Dict[str, int]:
+    """
+    @returns the size of each file related to application code
+    """
+    # To speed up processing only compute file sizes files related to application code
+    code_files = list(dict.fromkeys(f for f in file_names if is_maybe_package_code(f)))
+    return device.file_sizes(code_files)
+
+
+def write_file_sizes(
+    output_dir: str, file_sizes: Dict[str, int], apk_indexes: Dict[str, ApkIndex] = {}
 ):
-    print("Computing file sizes...")
     with open(os.path.join(output_dir, "file_sizes.csv"), "w", newline="") as csvfile:
         writer = csv.DictWriter(
             csvfile, fieldnames=["file_name", "zip_entry_name", "size", "file_offset"]
         )
         writer.writeheader()
-        for file_path, zip_entries in pulled_apks.items():
+        for file_path, apk_index in apk_indexes.items():
             # Write zip entries
-            for zip_entry in zip_entries:
+            for entry_name, size, header_offset in zip(
+                apk_index.entry_names.tolist(),
+                apk_index.sizes.tolist(),
+                apk_index.header_offsets.tolist(),
+            ):
                 writer.writerow(
                     {
                         "file_name": file_path,
-                        "zip_entry_name": zip_entry["file_name"],
-                        "size": zip_entry["size"],
-                        "file_offset": zip_entry["offset"],
+                        "zip_entry_name": entry_name,
+                        "size": size,
+                        "file_offset": header_offset,
                     }
                 )
 
-        seen_files = set()
-        # To speed up processing only compute file sizes files related to application code
-        for file_name in file_names:
-            if file_name in seen_files or not is_maybe_package_code(file_name):
-                continue
-            seen_files.add(file_name)
-            quoted_name = shlex.quote(file_name)
-            result = run_root_shell(
-                f"wc {quoted_name}",
-                check=True,
-                capture_output=True,
-                text=True,
-            )
-            file_size = result.stdout.strip().split()[2]
+        for file_name, file_size in file_sizes.items():
             writer.writerow(
                 {
                     "file_name": file_name,
@@ -417,6 +1499,33 @@ def compute_file_sizes(
             )
 
 
+def load_file_sizes(output_dir: str) -> Dict[str, int]:
+    """
+    @returns the file sizes written by write_file_sizes, without the zip entries
+    """
+    with open(os.path.join(output_dir, "file_sizes.csv"), newline="") as csvfile:
+        return {
+            row["file_name"]: int(row["size"])
+            for row in csv.DictReader(csvfile)
+            if not row["zip_entry_name"]
+        }
+
+
+def compute_file_sizes(
+    device: DeviceSession,
+    file_names: List[str],
+    output_dir: str,
+    apk_indexes: Dict[str, ApkIndex] = {},
+) -> Dict[str, int]:
+    """
+    @returns the size of each file related to application code
+    """
+    print("Computing file sizes...")
+    file_sizes = get_file_sizes(device, file_names)
+    write_file_sizes(output_dir, file_sizes, apk_indexes)
+    return file_sizes
+
+
 def is_maybe_package_code(file_name: str):
     return any(
         file_name.endswith(extension) for extension in [".so", ".vdex", ".apk"]
@@ -426,149 +1535,1145 @@ def is_maybe_package_code(file_name: str):
     )
 
 
+class MappedFaultsWriter:
+    """
+    Incrementally writes mapped faults to mapped_faults.csv and the columnar fault store
+    """
+
+    def __init__(self, output_dir: str):
+        self._csv_file = open(
+            os.path.join(output_dir, "mapped_faults.csv"), "w", newline=""
+        )
+        self._csv_writer = csv.writer(self._csv_file)
+        self._csv_writer.writerow(MAPPED_FAULTS_FIELDS)
+        self._store_writer = FaultStoreWriter(os.path.join(output_dir, FAULT_STORE_DIR))
+
+    def append(self, columns: Dict[str, Sequence]):
+        self._csv_writer.writerows(
+            zip(*(columns[field] for field in MAPPED_FAULTS_FIELDS))
+        )
+        self._store_writer.append(columns)
+
+    def close(self):
+        self._csv_file.close()
+        self._store_writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._csv_file.close()
+
+
+def to_mapped_fault_columns(
+    entries: List[Dict],
+    file_names: np.ndarray,
+    file_offsets: np.ndarray,
+    apk_indexes: Dict[str, ApkIndex],
+    residency: ResidencyModel,
+) -> Dict[str, List]:
+    zip_entry_names = resolve_zip_entry_names(file_names, file_offsets, apk_indexes)
+    is_major = residency.classify(file_names.tolist(), file_offsets)
+    return {
+        "ts": [e["ts"] for e in entries],
+        "process_name": [e["process_name"] for e in entries],
+        "thread_name": [e["thread_name"] for e in entries],
+        "file_name": file_names.tolist(),
+        "zip_entry_name": zip_entry_names.tolist(),
+        "offset": file_offsets.tolist(),
+        "is_major": is_major.tolist(),
+        # Not written, used to attribute I/O stalls
+        "tid": [e.get("tid") for e in entries],
+    }
+
+
+class PageCacheMapper:
+    """
+    Maps chunks of mm_filemap_add_to_page_cache events to files using the inode mapping
+    """
+
+    def __init__(
+        self,
+        inode_mappings: Dict[Tuple[int, int], str],
+        apk_indexes: Dict[str, ApkIndex],
+        residency: ResidencyModel,
+    ):
+        self.inode_mappings = inode_mappings
+        self.apk_indexes = apk_indexes
+        self.residency = residency
+
+    def map(self, page_cache_entries: List[Dict]) -> Dict[str, List]:
+        mapped_entries = []
+        file_names = []
+        for page_cache_entry in page_cache_entries:
+            file_name = self.inode_mappings.get(
+                (page_cache_entry["sdev"], page_cache_entry["inode"]), None
+            )
+
+            if not file_name or not is_maybe_package_code(file_name):
+                continue
+
+            mapped_entries.append(page_cache_entry)
+            file_names.append(file_name)
+
+        file_offsets = np.fromiter(
+            (e["offset"] for e in mapped_entries),
+            dtype=np.int64,
+            count=len(mapped_entries),
+        )
+        return to_mapped_fault_columns(
+            mapped_entries,
+            np.array(file_names, dtype=object),
+            file_offsets,
+            self.apk_indexes,
+            self.residency,
+        )
+
+
+class UserPageFaultMapper:
+    """
+    Maps chunks of page_fault_user events to files using /proc/pid/maps
+    """
+
+    def __init__(
+        self,
+        map_entries: List[Dict],
+        apk_indexes: Dict[str, ApkIndex],
+        residency: ResidencyModel,
+    ):
+        self.set_map_entries(map_entries)
+        self.apk_indexes = apk_indexes
+        self.residency = residency
+
+    def set_map_entries(self, map_entries: List[Dict]):
+        self.map_index = build_map_index(map_entries)
+        # Filter on the map entries rather than on every fault
+        self.is_package_code = np.array(
+            [is_maybe_package_code(f) for f in self.map_index.file_names], dtype=bool
+        )
+
+    def map(self, user_page_fault_entries: List[Dict]) -> Dict[str, List]:
+        map_index = self.map_index
+        addresses = np.fromiter(
+            (e["address"] for e in user_page_fault_entries),
+            dtype=np.uint64,
+            count=len(user_page_fault_entries),
+        )
+        entry_idx = find_map_entries(map_index, addresses)
+
+        is_mapped = entry_idx >= 0
+        is_mapped[is_mapped] = self.is_package_code[entry_idx[is_mapped]]
+        fault_idx = np.flatnonzero(is_mapped)
+        entry_idx = entry_idx[fault_idx]
+
+        file_offsets = (
+            addresses[fault_idx] - map_index.begin_addresses[entry_idx]
+        ).astype(np.int64) + map_index.offsets[entry_idx]
+        return to_mapped_fault_columns(
+            [user_page_fault_entries[i] for i in fault_idx.tolist()],
+            map_index.file_names[entry_idx],
+            file_offsets,
+            self.apk_indexes,
+            self.residency,
+        )
+
+
+def select_fault_rows(columns: Dict[str, List], mask: np.ndarray) -> Dict[str, List]:
+    indices = np.flatnonzero(mask).tolist()
+    return {name: [values[i] for i in indices] for name, values in columns.items()}
+
+
+def get_window_dir(output_dir: str, window: Window) -> str:
+    return os.path.join(output_dir, WINDOWS_DIR, window.name)
+
+
+def write_fault_mappings(
+    entries: Iterable[Dict],
+    mapper,
+    output_dir: str,
+    chunk_size: int,
+    windows: Optional[List[Window]] = None,
+    on_mapped: Optional[Callable[[Dict[str, List]], None]] = None,
+    chunk_ns: Optional[int] = None,
+):
+    """
+    Map and write faults chunk by chunk so memory is bounded by the chunk size.
+
+    With windows, the faults of each window are also written to its directory and only the faults within a window
+    are written to the output directory. The page cache is modeled across windows in time order.
+
+    on_mapped: Called with each chunk of faults written to the output directory
+    chunk_ns: Also end chunks after this many nanoseconds of trace, see chunked
+
+    @returns the number of faults read and written
+    """
+    rows_in = rows_out = 0
+    with ExitStack() as stack:
+        writer = stack.enter_context(MappedFaultsWriter(output_dir))
+        window_writers = [
+            stack.enter_context(MappedFaultsWriter(get_window_dir(output_dir, window)))
+            for window in windows or []
+        ]
+        for chunk in chunked(entries, chunk_size, chunk_ns):
+            columns = mapper.map(chunk)
+            if windows:
+                ts = np.array(columns["ts"], dtype=np.int64)
+                in_windows = [
+                    (ts >= window.ts_start) & (ts <= window.ts_end)
+                    for window in windows
+                ]
+                for window_writer, in_window in zip(window_writers, in_windows):
+                    window_writer.append(select_fault_rows(columns, in_window))
+                columns = select_fault_rows(columns, np.logical_or.reduce(in_windows))
+            writer.append(columns)
+            if on_mapped:
+                on_mapped(columns)
+            rows_in += len(chunk)
+            rows_out += len(columns["ts"])
+    return rows_in, rows_out
+
+
 def compute_page_cache_mappings(
-    page_cache_entries,
+    page_cache_entries: Iterable[Dict],
     inode_mappings: Dict[Tuple[int, int], str],
-    pulled_apks: Dict[str, List[Dict]],
+    apk_indexes: Dict[str, ApkIndex],
     output_dir: str,
-):
-    page_fault_mappings = []
+    file_sizes: Dict[str, int] = {},
+    readahead_policy: Optional[ReadaheadPolicy] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    windows: Optional[List[Window]] = None,
+    on_mapped: Optional[Callable[[Dict[str, List]], None]] = None,
+    chunk_ns: Optional[int] = None,
+) -> Tuple[int, int]:
+    residency = ResidencyModel(page_size, readahead_policy, file_sizes)
+    mapper = PageCacheMapper(inode_mappings, apk_indexes, residency)
+    return write_fault_mappings(
+        page_cache_entries, mapper, output_dir, chunk_size, windows, on_mapped, chunk_ns
+    )
 
-    page_faulted_sections = {}
 
-    for page_cache_entry in page_cache_entries:
-        inode_entry = inode_mappings.get(
-            (page_cache_entry["sdev"], page_cache_entry["inode"]), None
-        )
+def compute_user_page_fault_mappings(
+    user_page_fault_entries: Iterable[Dict],
+    map_entries: List[Dict],
+    apk_indexes: Dict[str, ApkIndex],
+    output_dir: str,
+    file_sizes: Dict[str, int] = {},
+    readahead_policy: Optional[ReadaheadPolicy] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    windows: Optional[List[Window]] = None,
+    on_mapped: Optional[Callable[[Dict[str, List]], None]] = None,
+    chunk_ns: Optional[int] = None,
+) -> Tuple[int, int]:
+    residency = ResidencyModel(page_size, readahead_policy, file_sizes)
+    mapper = UserPageFaultMapper(map_entries, apk_indexes, residency)
+    return write_fault_mappings(
+        user_page_fault_entries,
+        mapper,
+        output_dir,
+        chunk_size,
+        windows,
+        on_mapped,
+        chunk_ns,
+    )
 
-        if not inode_entry:
-            continue
 
-        file_name = inode_entry
-        file_offset = page_cache_entry["offset"]
+def parse_io_stalls(
+    session: TraceSession,
+    process_name: str,
+    ranges: Optional[List[Tuple[int, int]]] = None,
+) -> Iterator[Dict]:
+    """
+    Stream the ts, dur and tid of the uninterruptible sleeps of the process's threads in ts order, during startup or
+    within the time ranges if provided
+    """
+    queries = [
+        io_stalls_query(process_name, bounds)
+        for bounds in ([None] if ranges is None else ranges)
+    ]
+    for row in session.query_chunks(queries):
+        row["ts"] = int(row["ts"])
+        row["dur"] = int(row["dur"])
+        row["tid"] = int(row["tid"])
+        yield row
+
+
+class IoStalls:
+    """
+    Charges each uninterruptible sleep of a thread to the latest major fault of the thread at most `max_gap_ns`
+    before it, as chunks of mapped faults stream in. A fault is only charged the first sleep after it, which is the
+    thread waiting for the read.
 
-        if not is_maybe_package_code(file_name):
-            continue
+    Faults and sleeps are both consumed in ts order, so only the latest major fault of each thread is kept along with
+    running totals per file, zip entry and thread, overall and for each window.
+    """
+
+    def __init__(
+        self,
+        sleeps: Iterable[Dict],
+        windows: Optional[List[Window]] = None,
+        max_gap_ns: int = IO_STALL_MAX_GAP_NS,
+    ):
+        self.windows = windows or []
+        self.max_gap_ns = max_gap_ns
+        # [major_faults, stalled_faults, stall_ns, max_stall_ns] by (file_name, zip_entry_name, thread_name)
+        self.totals: Dict[Tuple, List[int]] = {}
+        self.window_totals: List[Dict[Tuple, List[int]]] = [{} for _ in self.windows]
+        self.sleeps_read = 0
+        self.stalled_faults = 0
+        self._sleeps = iter(sleeps)
+        self._next_sleep: Optional[Dict] = None
+        # Latest major fault of each thread as [ts, totals it counts towards, charged]
+        self._latest_faults: Dict[int, List] = {}
+
+    def _charge_sleeps(self, until_ts: Optional[int] = None):
+        """
+        Charge the sleeps before `until_ts`, or every remaining sleep
+        """
+        while True:
+            if self._next_sleep is None:
+                self._next_sleep = next(self._sleeps, None)
+                if self._next_sleep is None:
+                    return
+                self.sleeps_read += 1
+            sleep = self._next_sleep
+            # A sleep at the ts of a fault is charged to it, so wait for the faults at that ts
+            if until_ts is not None and sleep["ts"] >= until_ts:
+                return
+            self._next_sleep = None
+
+            fault = self._latest_faults.get(sleep["tid"])
+            if fault is None or fault[2] or sleep["ts"] - fault[0] > self.max_gap_ns:
+                continue
+            fault[2] = True
+            stalled = int(sleep["dur"] > 0)
+            self.stalled_faults += stalled
+            for totals in fault[1]:
+                totals[1] += stalled
+                totals[2] += sleep["dur"]
+                totals[3] = max(totals[3], sleep["dur"])
+
+    def append(self, columns: Dict[str, List]):
+        """
+        Count the major faults of a chunk of mapped faults, ordered by ts, after charging the sleeps before them
+        """
+        for i in np.flatnonzero(np.array(columns["is_major"], dtype=bool)).tolist():
+            ts = columns["ts"][i]
+            self._charge_sleeps(ts)
+            key = (
+                columns["file_name"][i],
+                columns["zip_entry_name"][i],
+                columns["thread_name"][i],
+            )
+            targets = [self.totals.setdefault(key, [0, 0, 0, 0])] + [
+                totals.setdefault(key, [0, 0, 0, 0])
+                for window, totals in zip(self.windows, self.window_totals)
+                if window.ts_start <= ts <= window.ts_end
+            ]
+            for totals in targets:
+                totals[0] += 1
+            self._latest_faults[columns["tid"][i]] = [ts, targets, False]
+
+    def finish(self):
+        """
+        Charge the sleeps after the last major fault
+        """
+        self._charge_sleeps()
+
+
+def summarize_io_stalls(totals: Dict[Tuple, List[int]]) -> pd.DataFrame:
+    """
+    @returns the major faults and stall time of each file, zip entry and thread, ranked by stall time
+    """
+    summary = pd.DataFrame(
+        [key + tuple(values) for key, values in totals.items()],
+        columns=IO_STALLS_FIELDS,
+    )
+    summary["stall_ms"] = summary["stall_ms"].astype(np.int64) / 1e6
+    summary["max_stall_ms"] = summary["max_stall_ms"].astype(np.int64) / 1e6
+    return summary.sort_values(
+        ["stall_ms", "major_faults"], ascending=False, kind="stable"
+    )
 
-        zip_entry = None
-        if file_name in pulled_apks:
-            zip_entry = find_zip_entry(pulled_apks[file_name], file_offset)
 
-        fetched_pages = page_faulted_sections.get(file_name, None)
-        if not fetched_pages:
-            fetched_pages = set()
-        page_aligned_offset = file_offset - file_offset % PAGE_SIZE
-        is_major = page_aligned_offset not in fetched_pages
+def write_io_stalls(output_dir: str, io_stalls: IoStalls):
+    """
+    Write the I/O stalls of the output directory and of each window to io_stalls.csv
+    """
+    summarize_io_stalls(io_stalls.totals).to_csv(
+        os.path.join(output_dir, IO_STALLS_FILE), index=False
+    )
+    for window, totals in zip(io_stalls.windows, io_stalls.window_totals):
+        summarize_io_stalls(totals).to_csv(
+            os.path.join(get_window_dir(output_dir, window), IO_STALLS_FILE),
+            index=False,
+        )
 
-        # Always record the page itself; only assume readahead after a major fault
-        fetched_pages.add(page_aligned_offset)
-        if is_major:
-            for n in range(1, 33):
-                fetched_pages.add(page_aligned_offset + PAGE_SIZE * n)
-        page_faulted_sections[file_name] = fetched_pages
 
-        page_fault_mappings.append(
+def write_device_info(device: DeviceSession, output_dir: str):
+    with open(os.path.join(output_dir, DEVICE_INFO_FILE), "w") as f:
+        json.dump(
             {
-                "ts": page_cache_entry["ts"],
-                "process_name": page_cache_entry["process_name"],
-                "thread_name": page_cache_entry["thread_name"],
-                "file_name": file_name,
-                "zip_entry_name": zip_entry["file_name"] if zip_entry else None,
-                "offset": file_offset,
-                "is_major": is_major,
-            }
+                "serial": device.serial,
+                "sdk_version": device.sdk_version,
+                "arch": device.arch,
+                "page_size": device.page_size,
+                "fingerprint": device.fingerprint,
+            },
+            f,
+            indent=2,
         )
 
-    with open(
-        os.path.join(output_dir, "mapped_faults.csv"), "w", newline=""
-    ) as csvfile:
-        writer = csv.DictWriter(
-            csvfile,
-            fieldnames=[
-                "ts",
-                "process_name",
-                "thread_name",
-                "file_name",
-                "zip_entry_name",
-                "offset",
-                "is_major",
-            ],
+
+@dataclass
+class Stage:
+    """
+    A processing step whose outputs are reused while its inputs and parameters are unchanged.
+    Paths are relative to the output directory.
+    """
+
+    name: str
+    inputs: List[str]
+    outputs: List[str]
+
+
+def get_run_stages(arch: str, windowed: bool = False) -> Dict[str, Stage]:
+    """
+    windowed: Whether faults are also mapped per window
+
+    @returns the stages that process a collected run
+    """
+    if "arm" in arch:
+        device_state = ["faults.pftrace", "inodes.txt"]
+    else:
+        device_state = ["maps.txt"]
+    # faults.csv is the raw query output written while mapping
+    mapping_outputs = [
+        "faults.csv",
+        "mapped_faults.csv",
+        FAULT_STORE_DIR,
+        IO_STALLS_FILE,
+    ]
+    if windowed:
+        mapping_outputs.append(WINDOWS_DIR)
+
+    device_files_outputs = ["file_sizes.csv", "apk_indexes.json"]
+    return {
+        # Reads the size and zip entries of the faulted files from the device
+        "device_files": Stage("device_files", device_state, device_files_outputs),
+        "mapping": Stage(
+            "mapping",
+            list(
+                dict.fromkeys(["faults.pftrace"] + device_state + device_files_outputs)
+            ),
+            mapping_outputs,
+        ),
+    }
+
+
+class StageState:
+    """
+    Fingerprints of the stages that produced the outputs of a directory.
+
+    A stage's fingerprint is the hash of its parameters and the contents of its inputs. Input digests are reused
+    while the file's size and modification time are unchanged. A stage is also stale once its outputs are deleted or
+    modified.
+    """
+
+    def __init__(self, output_dir: str):
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, STAGES_FILE)
+        try:
+            with open(self.path) as f:
+                self._state = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self._state = {"stages": {}, "digests": {}}
+        self._state.setdefault("outputs", {})
+
+    def _digest(self, relative_path: str) -> Optional[str]:
+        path = os.path.join(self.output_dir, relative_path)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+
+        key = [stat.st_size, stat.st_mtime_ns]
+        cached = self._state["digests"].get(relative_path)
+        if cached and cached[:2] == key:
+            return cached[2]
+
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        self._state["digests"][relative_path] = key + [digest.hexdigest()]
+        return digest.hexdigest()
+
+    def fingerprint(self, stage: Stage, params: Dict) -> str:
+        fingerprint = hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8"))
+        for relative_path in stage.inputs:
+            fingerprint.update(
+                f"{relative_path}:{self._digest(relative_path)}\n".encode("utf-8")
+            )
+        return fingerprint.hexdigest()
+
+    def _stat(self, relative_path: str) -> Optional[List[int]]:
+        try:
+            stat = os.stat(os.path.join(self.output_dir, relative_path))
+        except FileNotFoundError:
+            return None
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def is_current(self, stage: Stage, fingerprint: str) -> bool:
+        if self._state["stages"].get(stage.name) != fingerprint:
+            return False
+        recorded = self._state["outputs"].get(stage.name)
+        # Stages recorded before outputs were tracked only need their outputs to exist
+        if recorded is None:
+            return all(self._stat(output) is not None for output in stage.outputs)
+        return all(
+            recorded.get(output) is not None
+            and recorded.get(output) == self._stat(output)
+            for output in stage.outputs
         )
-        writer.writeheader()
-        for page_fault in page_fault_mappings:
-            writer.writerow(page_fault)
 
+    def record(self, stage: Stage, fingerprint: str):
+        self._state["stages"][stage.name] = fingerprint
+        self._state["outputs"][stage.name] = {
+            output: self._stat(output) for output in stage.outputs
+        }
+        with open(f"{self.path}.partial", "w") as f:
+            json.dump(self._state, f, indent=2)
+        os.replace(f"{self.path}.partial", self.path)
 
-def compute_user_page_fault_mappings(
-    user_page_fault_entries, map_entries, pulled_apks, output_dir
+
+@dataclass
+class StageMetrics:
+    """
+    Resources used by a stage of a run.
+
+    CPU time is process-wide and includes child processes only once they exit, such as the trace_processor of each
+    query without the perfetto package, so it excludes a trace_processor still running. Peak RSS is the high-water
+    mark of the process, or of its largest exited child, since it started rather than during the stage.
+    """
+
+    name: str
+    wall_time_s: float = 0.0
+    cpu_time_s: float = 0.0
+    peak_rss_mb: float = 0.0
+    adb_round_trips: int = 0
+    rows_in: Optional[int] = None
+    rows_out: Optional[int] = None
+
+
+class StageProfiler:
+    """
+    Records the metrics of each stage of a run. A disabled profiler only runs the stages.
+
+    Stages can be nested, e.g. the trace_processor queries run while mapping consumes their rows, in which case the
+    time of the nested stage is excluded from the enclosing one. A stage entered several times is reported once with
+    its totals.
+
+    concurrent_jobs: Other jobs run in the same process, e.g. the other devices of scheduler.py, so the process-wide
+    metrics include their work and are unreliable
+    """
+
+    def __init__(
+        self,
+        device: Optional[DeviceSession] = None,
+        enabled: bool = True,
+        concurrent_jobs: bool = False,
+    ):
+        self.device = device
+        self.enabled = enabled
+        self.concurrent_jobs = concurrent_jobs
+        self.stages: List[StageMetrics] = []
+        # Wall and CPU time of the stages nested in each running stage
+        self._nested: List[List[float]] = []
+
+    def _add(self, metrics: StageMetrics):
+        previous = next((s for s in self.stages if s.name == metrics.name), None)
+        if previous is None:
+            self.stages.append(metrics)
+            return
+        previous.wall_time_s += metrics.wall_time_s
+        previous.cpu_time_s += metrics.cpu_time_s
+        previous.peak_rss_mb = max(previous.peak_rss_mb, metrics.peak_rss_mb)
+        previous.adb_round_trips += metrics.adb_round_trips
+        for field in ["rows_in", "rows_out"]:
+            if getattr(metrics, field) is not None:
+                setattr(
+                    previous,
+                    field,
+                    (getattr(previous, field) or 0) + getattr(metrics, field),
+                )
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[StageMetrics]:
+        """
+        Measure the enclosed stage. Set rows_in and rows_out on the yielded metrics.
+        """
+        metrics = StageMetrics(name)
+        if not self.enabled:
+            yield metrics
+            return
+
+        def cpu_time() -> float:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            return (
+                usage.ru_utime + usage.ru_stime + children.ru_utime + children.ru_stime
+            )
+
+        round_trips = self.device.round_trips if self.device else 0
+        wall_start = time.perf_counter()
+        cpu_start = cpu_time()
+        self._nested.append([0.0, 0.0])
+        try:
+            yield metrics
+        finally:
+            wall_time = time.perf_counter() - wall_start
+            stage_cpu_time = cpu_time() - cpu_start
+            nested_wall_time, nested_cpu_time = self._nested.pop()
+            if self._nested:
+                self._nested[-1][0] += wall_time
+                self._nested[-1][1] += stage_cpu_time
+            metrics.wall_time_s = wall_time - nested_wall_time
+            metrics.cpu_time_s = stage_cpu_time - nested_cpu_time
+            metrics.peak_rss_mb = (
+                max(
+                    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                    resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+                )
+                / MAXRSS_PER_MB
+            )
+            if self.device:
+                metrics.adb_round_trips = self.device.round_trips - round_trips
+            self._add(metrics)
+
+    def write(self, output_dir: str):
+        with open(os.path.join(output_dir, RUN_METRICS_FILE), "w") as f:
+            json.dump(
+                {
+                    "stages": [asdict(stage) for stage in self.stages],
+                    "concurrent_jobs": self.concurrent_jobs,
+                },
+                f,
+                indent=2,
+            )
+
+
+def collect_run(
+    device: DeviceSession,
+    package_name: str,
+    output_dir: str,
+    launch: bool = False,
+    settle_time: float = DEFAULT_SETTLE_TIME,
+    profiler: Optional[StageProfiler] = None,
+    window_specs: Sequence[str] = (),
 ):
-    page_fault_mappings = []
+    """
+    Collect a trace and the device state needed to map its faults to files, during startup or within the windows
+    if provided
+    """
+    profiler = profiler or StageProfiler(enabled=False)
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.makedirs(output_dir, exist_ok=True)
+    with profiler.stage("collect_trace"):
+        collect_trace(device, package_name, output_dir, launch, settle_time)
+        write_device_info(device, output_dir)
+
+    if "arm" in device.arch:
+        with (
+            profiler.stage("dump_inodes"),
+            TraceSession(os.path.join(output_dir, "faults.pftrace")) as session,
+        ):
+            _, ranges = resolve_query_ranges(session, package_name, window_specs)
+            dump_inodes(
+                device,
+                package_name,
+                output_dir,
+                parse_page_cache_inodes(session, package_name, ranges),
+            )
+    else:
+        with profiler.stage("dump_maps"):
+            dump_maps(device, package_name, output_dir)
 
-    page_faulted_sections = {}
 
-    for user_page_fault in user_page_fault_entries:
-        map_entry = find_map_entry(map_entries, user_page_fault["address"])
-        if not map_entry:
-            continue
+def get_run_file_names(
+    arch: str,
+    package_name: str,
+    output_dir: str,
+    window_specs: Sequence[str] = (),
+) -> List[str]:
+    """
+    @returns the files that faults of the run are mapped to
+    """
+    if "arm" in arch:
+        inode_mappings = compute_inode_mapping(output_dir)
+        with TraceSession(os.path.join(output_dir, "faults.pftrace")) as session:
+            _, ranges = resolve_query_ranges(session, package_name, window_specs)
+            return list(
+                set(
+                    inode_mappings[inode]
+                    for inode in parse_page_cache_inodes(session, package_name, ranges)
+                    if inode in inode_mappings
+                )
+            )
+    return list(set([e["file_name"] for e in parse_maps(output_dir)]))
 
-        file_name = map_entry["file_name"]
 
-        if not is_maybe_package_code(file_name):
-            continue
+def write_window_dirs(output_dir: str, windows: List[Window]):
+    """
+    Create the directory of each window with the run files needed to load its faults
+    """
+    windows_dir = os.path.join(output_dir, WINDOWS_DIR)
+    for window in windows:
+        window_dir = get_window_dir(output_dir, window)
+        os.makedirs(window_dir)
+        for file_name in WINDOW_RUN_FILES:
+            if os.path.exists(os.path.join(output_dir, file_name)):
+                shutil.copyfile(
+                    os.path.join(output_dir, file_name),
+                    os.path.join(window_dir, file_name),
+                )
+    os.makedirs(windows_dir, exist_ok=True)
+    with open(os.path.join(windows_dir, WINDOWS_FILE), "w") as f:
+        json.dump([asdict(window) for window in windows], f, indent=2)
 
-        file_offset = (
-            user_page_fault["address"]
-            - map_entry["begin_address"]
-            + map_entry["offset"]
-        )
 
-        zip_entry = None
-        if file_name in pulled_apks:
-            zip_entry = find_zip_entry(pulled_apks[file_name], file_offset)
+def process_run(
+    arch: str,
+    package_name: str,
+    output_dir: str,
+    readahead_policy: Optional[ReadaheadPolicy] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    profile: bool = False,
+    cprofile: bool = False,
+    window_specs: Sequence[str] = (),
+    window_chunk_ms: int = DEFAULT_WINDOW_CHUNK_MS,
+) -> List[StageMetrics]:
+    """
+    Map the faults of a collected run. Does not access the device so runs can be processed while the next one is
+    collected.
+
+    page_size: Page size of the device the run was collected on
+    profile: Measure the trace_processor, mapping and io_stalls stages
+    cprofile: Write the cProfile stats of the processing to processing.prof in the output directory
+    window_specs: Map the faults within these windows instead of the startup, see parse_window_spec
+    window_chunk_ms: Milliseconds of trace mapped at a time for windows
+
+    @returns the metrics of the stages if profiled
+    """
+    profiler = StageProfiler(enabled=profile)
+    python_profiler = cProfile.Profile() if cprofile else None
+    if python_profiler:
+        python_profiler.enable()
+
+    apk_indexes = load_apk_indexes(output_dir)
+    file_sizes = load_file_sizes(output_dir)
+    try:
+        # Queries run as mapping consumes their rows, one query per window
+        with TraceSession(
+            os.path.join(output_dir, "faults.pftrace"), profiler
+        ) as session:
+            windows, ranges = resolve_query_ranges(session, package_name, window_specs)
+            chunk_ns = window_chunk_ms * 1_000_000 if windows else None
+            # Windows of a previous processing would be stale
+            shutil.rmtree(os.path.join(output_dir, WINDOWS_DIR), ignore_errors=True)
+            if window_specs:
+                write_window_dirs(output_dir, windows)
+
+            # Sleeps are charged to the major faults of each chunk as it is mapped
+            io_stalls = IoStalls(
+                parse_io_stalls(session, package_name, ranges), windows
+            )
+
+            def attribute_io_stalls(columns: Dict[str, List]):
+                with profiler.stage("io_stalls"):
+                    io_stalls.append(columns)
+
+            with profiler.stage("mapping") as metrics:
+                if "arm" in arch:
+                    metrics.rows_in, metrics.rows_out = compute_page_cache_mappings(
+                        parse_add_to_page_cache(
+                            session, package_name, output_dir, page_size, ranges
+                        ),
+                        compute_inode_mapping(output_dir),
+                        apk_indexes,
+                        output_dir,
+                        file_sizes,
+                        readahead_policy,
+                        page_size=page_size,
+                        windows=windows,
+                        on_mapped=attribute_io_stalls,
+                        chunk_ns=chunk_ns,
+                    )
+                else:
+                    metrics.rows_in, metrics.rows_out = (
+                        compute_user_page_fault_mappings(
+                            parse_user_page_faults(
+                                session, package_name, output_dir, ranges
+                            ),
+                            parse_maps(output_dir),
+                            apk_indexes,
+                            output_dir,
+                            file_sizes,
+                            readahead_policy,
+                            page_size=page_size,
+                            windows=windows,
+                            on_mapped=attribute_io_stalls,
+                            chunk_ns=chunk_ns,
+                        )
+                    )
+
+            with profiler.stage("io_stalls") as metrics:
+                io_stalls.finish()
+                write_io_stalls(output_dir, io_stalls)
+                metrics.rows_in = io_stalls.sleeps_read
+                metrics.rows_out = io_stalls.stalled_faults
+    finally:
+        if python_profiler:
+            python_profiler.disable()
+            python_profiler.dump_stats(
+                os.path.join(output_dir, PROCESSING_PROFILE_FILE)
+            )
+    return profiler.stages
 
-        fetched_pages = page_faulted_sections.get(file_name, None)
-        if not fetched_pages:
-            fetched_pages = set()
-        page_aligned_offset = file_offset - file_offset % PAGE_SIZE
-        is_major = page_aligned_offset not in fetched_pages
 
-        # Always record the page itself; only assume readahead after a major fault
-        fetched_pages.add(page_aligned_offset)
-        if is_major:
-            for n in range(1, 33):
-                fetched_pages.add(page_aligned_offset + PAGE_SIZE * n)
-        page_faulted_sections[file_name] = fetched_pages
+def summarize_run(output_dir: str) -> Dict[str, Tuple[int, int]]:
+    """
+    @returns the number of major faults and faulted pages of each file
+    """
+    mapped_faults = load_mapped_faults(output_dir)
+    page_size = load_page_size(output_dir)
+    grouped = mapped_faults.assign(page=mapped_faults["offset"] // page_size).groupby(
+        "file_name", observed=True
+    )
+    major_faults = grouped["is_major"].sum()
+    faulted_pages = grouped["page"].nunique()
+    return {
+        file_name: (int(major_faults[file_name]), int(faulted_pages[file_name]))
+        for file_name in major_faults.index
+    }
+
 
-        page_fault_mappings.append(
+def write_summary(output_dir: str, run_summaries: List[Dict[str, Tuple[int, int]]]):
+    """
+    Write the median and p90 of major faults and faulted pages of each file across runs.
+    Files missing from a run count as having no faults in that run.
+    """
+    file_names = sorted(set().union(*run_summaries))
+    rows = []
+    for file_name in file_names:
+        stats = np.array(
+            [summary.get(file_name, (0, 0)) for summary in run_summaries]
+        ).reshape(-1, 2)
+        median = np.median(stats, axis=0)
+        p90 = np.percentile(stats, 90, axis=0)
+        rows.append(
             {
-                "ts": user_page_fault["ts"],
-                "process_name": user_page_fault["process_name"],
-                "thread_name": user_page_fault["thread_name"],
                 "file_name": file_name,
-                "zip_entry_name": zip_entry["file_name"] if zip_entry else None,
-                "offset": file_offset,
-                "is_major": is_major,
+                "runs": int(np.count_nonzero(stats[:, 1])),
+                "major_faults_median": median[0],
+                "major_faults_p90": p90[0],
+                "faulted_pages_median": median[1],
+                "faulted_pages_p90": p90[1],
             }
         )
+    rows.sort(key=lambda row: row["major_faults_median"], reverse=True)
 
-    with open(
-        os.path.join(output_dir, "mapped_faults.csv"), "w", newline=""
-    ) as csvfile:
+    with open(os.path.join(output_dir, "summary.csv"), "w", newline="") as csvfile:
         writer = csv.DictWriter(
             csvfile,
             fieldnames=[
-                "ts",
-                "process_name",
-                "thread_name",
                 "file_name",
-                "zip_entry_name",
-                "offset",
-                "is_major",
+                "runs",
+                "major_faults_median",
+                "major_faults_p90",
+                "faulted_pages_median",
+                "faulted_pages_p90",
             ],
         )
         writer.writeheader()
-        for page_fault in page_fault_mappings:
-            writer.writerow(page_fault)
+        writer.writerows(rows)
+
+
+def add_processing_arguments(parser: argparse.ArgumentParser):
+    """
+    Arguments shared by every entry point that collects and processes page faults
+    """
+    parser.add_argument(
+        "--pull-apks",
+        action="store_true",
+        default=False,
+        help="Index APKs to get details on which file a page fault in APK corresponds to (default: false)",
+    )
+    parser.add_argument(
+        "--skip-collect",
+        action="store_true",
+        default=False,
+        help="Skip data collection and process previously collected data (default: false)",
+    )
+    parser.add_argument(
+        "--readahead-pages",
+        type=int,
+        default=DEFAULT_RA_PAGES,
+        help=f"Max pages read ahead on a major page fault (default: {DEFAULT_RA_PAGES})",
+    )
+    parser.add_argument(
+        "--readahead-ramp-up",
+        action="store_true",
+        default=False,
+        help="Model the kernel's readahead window ramping up on sequential major page faults (default: false)",
+    )
+    parser.add_argument(
+        "--ra-pages",
+        type=str,
+        action="append",
+        default=[],
+        metavar="SUFFIX=PAGES",
+        help="Override the readahead pages for files ending with SUFFIX (e.g. base.vdex=64). Can be repeated",
+    )
+    parser.add_argument(
+        "--iterations",
+        type=int,
+        default=1,
+        help="Number of cold starts to trace. With more than one, the app is launched automatically, each run is "
+        "written to <output>/run_<i> and summary.csv aggregates the runs (default: 1)",
+    )
+    parser.add_argument(
+        "--settle-time",
+        type=float,
+        default=DEFAULT_SETTLE_TIME,
+        help=f"Seconds to keep tracing after an automatic launch completes (default: {DEFAULT_SETTLE_TIME})",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        default=False,
+        help="Write the wall time, CPU time, peak RSS, adb round trips and rows in and out of each stage that ran to "
+        f"{RUN_METRICS_FILE} in each run directory (default: false)",
+    )
+    parser.add_argument(
+        "--cprofile",
+        action="store_true",
+        default=False,
+        help=f"Write the cProfile stats of the processing phase to {PROCESSING_PROFILE_FILE} in each run directory, "
+        "e.g. for snakeviz or flameprof (default: false)",
+    )
+    parser.add_argument(
+        "--window",
+        type=window_spec,
+        action="append",
+        default=[],
+        metavar="SPEC",
+        help="Map the faults of a window of the trace instead of the startup and also write them to "
+        f"<run>/{WINDOWS_DIR}/<name>. SPEC is startup (every startup of the package), startup:N (the Nth), "
+        "slice:GLOB (every slice whose name matches, e.g. an atrace section or ftrace/print marker), "
+        "ts:START-END (trace timestamps in ns) or full (the whole trace). Can be repeated",
+    )
+    parser.add_argument(
+        "--window-chunk-ms",
+        type=int,
+        default=DEFAULT_WINDOW_CHUNK_MS,
+        help="Milliseconds of trace mapped at a time with --window, splitting the rows of each window's query "
+        "as they stream in "
+        f"(default: {DEFAULT_WINDOW_CHUNK_MS})",
+    )
+
+
+def get_readahead_policy(args: argparse.Namespace) -> ReadaheadPolicy:
+    return ReadaheadPolicy(
+        ra_pages=args.readahead_pages,
+        ramp_up=args.readahead_ramp_up,
+        file_ra_pages={
+            suffix: int(pages)
+            for suffix, pages in (override.split("=", 1) for override in args.ra_pages)
+        },
+    )
+
+
+def start_package_analysis(
+    device: DeviceSession,
+    package_name: str,
+    output_dir: str,
+    executor: Optional[ProcessPoolExecutor],
+    args: argparse.Namespace,
+    launch: bool = False,
+    concurrent_jobs: bool = False,
+) -> Callable[[], None]:
+    """
+    Collect (unless skipped) the package's cold starts on the device and start processing their page faults.
+
+    Runs are processed in the executor, overlapped with collecting the next run, or inline without one.
+    Without launch, the user launches the app and stops tracing with Ctrl-C.
+
+    concurrent_jobs: Other jobs run in this process, which makes the --profile metrics unreliable
+
+    @returns a function waiting for the processing to finish, which no longer needs the device
+    """
+    readahead_policy = get_readahead_policy(args)
+    if args.iterations > 1:
+        run_dirs = [
+            os.path.join(output_dir, f"run_{i}") for i in range(args.iterations)
+        ]
+    else:
+        run_dirs = [output_dir]
+
+    # Files do not change between runs so their sizes and APK indexes are only read once
+    apk_indexes: Dict[str, ApkIndex] = {}
+    file_sizes: Dict[str, int] = {}
+    seen_files: Set[str] = set()
+    runs: List[Tuple[StageState, Stage, str, Future, StageProfiler]] = []
+    for i, run_dir in enumerate(run_dirs):
+        profiler = StageProfiler(
+            device, enabled=args.profile, concurrent_jobs=concurrent_jobs
+        )
+
+        # Collection phase (unless skipped)
+        if not args.skip_collect:
+            print(
+                f"Collecting data for package: {package_name} ({i + 1}/{len(run_dirs)})"
+            )
+            if i == 0:
+                shutil.rmtree(output_dir, ignore_errors=True)
+            collect_run(
+                device,
+                package_name,
+                run_dir,
+                launch=launch,
+                settle_time=args.settle_time,
+                profiler=profiler,
+                window_specs=args.window,
+            )
+
+        # Runs collected before device_info.json was written need the device
+        device_info = read_device_info(run_dir)
+        arch = device_info.get("arch") or device.arch
+        page_size = device_info.get("page_size") or DEFAULT_PAGE_SIZE
+        stages = get_run_stages(arch, windowed=bool(args.window))
+        state = StageState(run_dir)
+
+        device_files = stages["device_files"]
+        params = {"package": package_name, "arch": arch, "pull_apks": args.pull_apks}
+        if args.window:
+            params["windows"] = args.window
+        fingerprint = state.fingerprint(device_files, params)
+        if state.is_current(device_files, fingerprint):
+            print(f"File sizes in {run_dir} are up to date")
+            apk_indexes.update(load_apk_indexes(run_dir))
+            file_sizes.update(load_file_sizes(run_dir))
+            seen_files.update(apk_indexes, file_sizes)
+        else:
+            file_names = get_run_file_names(arch, package_name, run_dir, args.window)
+            new_files = [f for f in file_names if f not in seen_files]
+            seen_files.update(new_files)
+            if args.pull_apks:
+                with profiler.stage("pull_apks") as metrics:
+                    new_indexes = index_apks(device, new_files)
+                    metrics.rows_in, metrics.rows_out = len(new_files), len(new_indexes)
+                apk_indexes.update(new_indexes)
+            print("Computing file sizes...")
+            with profiler.stage("file_sizes") as metrics:
+                new_sizes = get_file_sizes(device, new_files)
+                metrics.rows_in, metrics.rows_out = len(new_files), len(new_sizes)
+            file_sizes.update(new_sizes)
+            save_apk_indexes(
+                run_dir, {f: apk_indexes[f] for f in file_names if f in apk_indexes}
+            )
+            write_file_sizes(
+                run_dir,
+                {f: file_sizes[f] for f in file_names if f in file_sizes},
+                {f: apk_indexes[f] for f in file_names if f in apk_indexes},
+            )
+            state.record(device_files, fingerprint)
+
+        # Processing phase, overlapped with collecting the next run
+        mapping = stages["mapping"]
+        params = {
+            "package": package_name,
+            "arch": arch,
+            "page_size": page_size,
+            "readahead": asdict(readahead_policy),
+        }
+        # Runs processed before windows existed stay up to date
+        if args.window:
+            params["windows"] = args.window
+        fingerprint = state.fingerprint(mapping, params)
+        if state.is_current(mapping, fingerprint):
+            print(f"Mapped faults in {run_dir} are up to date")
+            if args.profile:
+                profiler.write(run_dir)
+            continue
+
+        print(f"Processing collected data in {run_dir}...")
+        process_args = (
+            arch,
+            package_name,
+            run_dir,
+            readahead_policy,
+            page_size,
+            args.profile,
+            args.cprofile,
+            args.window,
+            args.window_chunk_ms,
+        )
+        if executor is not None:
+            future = executor.submit(process_run, *process_args)
+            runs.append((state, mapping, fingerprint, future, profiler))
+        else:
+            profiler.stages.extend(process_run(*process_args))
+            state.record(mapping, fingerprint)
+            if args.profile:
+                profiler.write(run_dir)
+
+    def finish():
+        for state, stage, fingerprint, future, profiler in runs:
+            profiler.stages.extend(future.result())
+            state.record(stage, fingerprint)
+            if args.profile:
+                profiler.write(state.output_dir)
+
+        if len(run_dirs) > 1:
+            summary = Stage(
+                "summary",
+                [
+                    os.path.join(
+                        os.path.relpath(run_dir, output_dir), "mapped_faults.csv"
+                    )
+                    for run_dir in run_dirs
+                ],
+                ["summary.csv"],
+            )
+            state = StageState(output_dir)
+            fingerprint = state.fingerprint(
+                summary, {"page_sizes": [load_page_size(d) for d in run_dirs]}
+            )
+            if not state.is_current(summary, fingerprint):
+                write_summary(output_dir, [summarize_run(d) for d in run_dirs])
+                state.record(summary, fingerprint)
+            print("Summary written to:", os.path.join(output_dir, "summary.csv"))
+
+    return finish
+
+
+def analyze_package(
+    device: DeviceSession,
+    package_name: str,
+    output_dir: str,
+    executor: Optional[ProcessPoolExecutor],
+    args: argparse.Namespace,
+    launch: bool = False,
+):
+    """
+    Collect (unless skipped) and process the page faults of the package's cold starts on the device.
+    """
+    start_package_analysis(device, package_name, output_dir, executor, args, launch)()
 
 
 def main():
@@ -589,65 +2694,34 @@ def main():
         help="Output directory (default: output)",
     )
     parser.add_argument(
-        "--pull-apks",
-        action="store_true",
-        default=False,
-        help="Pull APKs to get details on which file a page fault in APK corresponds to (default: false)",
-    )
-    parser.add_argument(
-        "--skip-collect",
-        action="store_true",
-        default=False,
-        help="Skip data collection and process previously collected data (default: false)",
+        "--serial",
+        type=str,
+        default=None,
+        help="Serial of the device to use when several are connected (default: the only connected device)",
     )
+    add_processing_arguments(parser)
 
     args = parser.parse_args()
 
-    # Collection phase (unless skipped)
-    if not args.skip_collect:
-        print(f"Collecting data for package: {args.package}")
-        shutil.rmtree(args.output, ignore_errors=True)
-        os.makedirs(args.output, exist_ok=True)
-        collect_trace(args.package, args.output)
-
-        if "arm" in get_arch():
-            dump_inodes(args.output)
-        else:
-            dump_maps(args.package, args.output)
-
-    # Processing phase
-    print("Processing collected data...")
-    if "arm" in get_arch():
-        page_cache_entries = parse_add_to_page_cache(
-            args.package, args.output, os.path.join(args.output, "faults.pftrace")
-        )
-        inode_mappings = compute_inode_mapping(args.output)
-        file_names = list(
-            set(
-                filter(
-                    lambda x: x is not None,
-                    [
-                        inode_mappings.get((e["sdev"], e["inode"]), None)
-                        for e in page_cache_entries
-                    ],
+    # Commands are sent over a single shell opened on first use
+    with DeviceSession(args.serial) as device, ExitStack() as stack:
+        # A single run has no collection to overlap its processing with
+        executor = (
+            stack.enter_context(
+                ProcessPoolExecutor(
+                    max_workers=min(args.iterations, os.cpu_count() or 1)
                 )
             )
+            if args.iterations > 1
+            else None
         )
-        pulled_apks = pull_apks(file_names, args.output) if args.pull_apks else {}
-        compute_file_sizes(file_names, args.output, pulled_apks)
-        compute_page_cache_mappings(
-            page_cache_entries, inode_mappings, pulled_apks, args.output
-        )
-    else:
-        user_page_faults = parse_user_page_faults(
-            args.package, args.output, os.path.join(args.output, "faults.pftrace")
-        )
-        map_entries = parse_maps(args.output)
-        file_names = list(set([e["file_name"] for e in map_entries]))
-        pulled_apks = pull_apks(file_names, args.output) if args.pull_apks else {}
-        compute_file_sizes(file_names, args.output, pulled_apks)
-        compute_user_page_fault_mappings(
-            user_page_faults, map_entries, pulled_apks, args.output
+        analyze_package(
+            device,
+            args.package,
+            args.output,
+            executor,
+            args,
+            launch=args.iterations > 1,
         )
 
     print("Analysis complete. Results are in:", os.path.abspath(args.output))
@@ -0,0 +1,573 @@
+import argparse
+import csv
+import itertools
+import os
+import queue
+import re
+import shlex
+import subprocess
+import threading
+import time
+from collections import Counter, deque
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from faults import (
+    DEFAULT_CHUNK_SIZE,
+    DeviceSession,
+    PageCacheMapper,
+    UserPageFaultMapper,
+    chunked,
+    compute_inode_mapping,
+    find_map_entries,
+    get_readahead_policy,
+    launch_app,
+    load_apk_indexes,
+    load_file_sizes,
+    parse_maps,
+    parse_maps_lines,
+    prepare_cold_start,
+    resolve_inodes,
+)
+from readahead import DEFAULT_RA_PAGES, ResidencyModel
+from utilities import DEFAULT_PAGE_SIZE, load_page_size
+
+# Dedicated ftrace instance so live tracing does not disturb other tracing sessions
+FTRACE_INSTANCE = "android-fault-visualizer"
+USER_PAGE_FAULT_EVENT = "exceptions/page_fault_user"
+PAGE_CACHE_EVENT = "filemap/mm_filemap_add_to_page_cache"
+
+DEFAULT_INTERVAL_MS = 500
+DEFAULT_TOP = 10
+# Min seconds between dumps of the process's maps while faults fall outside of every mapping
+MAPS_REFRESH_INTERVAL = 1.0
+# Events kept until the package's process starts
+MAX_BACKLOG_EVENTS = 100000
+
+# Example line, with an optional (tgid) column when the record-tgid option is set:
+# RenderThread-1234  [003] d..2. 5123.456789: page_fault_user: address=0x7f12a000 ip=0x7f34b000 error_code=0x14
+TRACE_LINE_RE = re.compile(
+    r"^\s*(?P<comm>.*?)-(?P<tid>\d+)\s+(?:\(\s*[\d-]+\)\s+)?\[\d+\]\s+(?:\S+\s+)?"
+    r"(?P<ts>\d+)\.(?P<ts_fraction>\d+):\s+(?P<event>\w+):\s+(?P<fields>.*)$"
+)
+PAGE_FAULT_FIELDS_RE = re.compile(
+    r"address=(?P<address>0x[0-9a-f]+) ip=(?P<ip>0x[0-9a-f]+)"
+)
+# The page or pfn fields before ofs differ between kernel versions
+PAGE_CACHE_FIELDS_RE = re.compile(
+    r"dev (?P<major>\d+):(?P<minor>\d+) ino (?P<inode>[0-9a-f]+) .*ofs=(?P<offset>\d+)"
+)
+
+
+def parse_trace_line(line: str) -> Optional[Tuple[int, Dict]]:
+    """
+    Parse a page_fault_user or mm_filemap_add_to_page_cache line of trace_pipe
+
+    @returns the thread id and the event with the fields of the trace query rows, or None for other lines
+    """
+    match = TRACE_LINE_RE.match(line)
+    if not match:
+        return None
+
+    event = {
+        "ts": int(match.group("ts")) * 1_000_000_000
+        + int(match.group("ts_fraction").ljust(9, "0")[:9]),
+        "process_name": None,
+        "thread_name": match.group("comm"),
+    }
+    if match.group("event") == "page_fault_user":
+        fields = PAGE_FAULT_FIELDS_RE.search(match.group("fields"))
+        if not fields:
+            return None
+        event["address"] = int(fields.group("address"), 16)
+        event["ip"] = int(fields.group("ip"), 16)
+    elif match.group("event") == "mm_filemap_add_to_page_cache":
+        fields = PAGE_CACHE_FIELDS_RE.search(match.group("fields"))
+        if not fields:
+            return None
+        # Encoded like st_dev so it matches the devices of inodes.txt
+        event["sdev"] = os.makedev(
+            int(fields.group("major")), int(fields.group("minor"))
+        )
+        event["inode"] = int(fields.group("inode"), 16)
+        # Already in bytes
+        event["offset"] = int(fields.group("offset"))
+    else:
+        return None
+    return int(match.group("tid")), event
+
+
+class ReplaySource:
+    """
+    Feeds the events of a recorded faults.csv at `speed` times the recorded pace, or as fast as possible with a speed
+    of 0, to develop and benchmark the live path without a device
+    """
+
+    def __init__(self, path: str, speed: float, page_size: int = DEFAULT_PAGE_SIZE):
+        self.speed = speed
+        self.page_size = page_size
+        self.done = False
+        self._file = open(path, newline="")
+        # Query results are preceded by blank lines
+        self._rows = csv.DictReader(line for line in self._file if line.strip())
+        # faults.csv holds page_fault_user events on x86 and mm_filemap_add_to_page_cache events on arm
+        self.page_cache = "address" not in (self._rows.fieldnames or [])
+        self._next: Optional[Dict] = None
+        self._start_ts = 0
+        self._start_time = 0.0
+
+    def _parse(self, row: Dict) -> Dict:
+        row["ts"] = int(row["ts"])
+        if self.page_cache:
+            row["sdev"] = int(row["sdev"])
+            row["inode"] = int(row["inode"])
+            # Use byte offsets like parse_add_to_page_cache
+            row["offset"] = int(row["offset"]) * self.page_size
+        else:
+            row["address"] = int(row["address"])
+        return row
+
+    def read(self, deadline: float) -> List[Dict]:
+        """
+        @returns the events due by the deadline in time.monotonic() seconds, waiting until then
+        """
+        events = []
+        while len(events) < DEFAULT_CHUNK_SIZE:
+            if self._next is None:
+                row = next(self._rows, None)
+                if row is None:
+                    self.done = True
+                    return events
+                self._next = self._parse(row)
+                if not self._start_time:
+                    self._start_ts = self._next["ts"]
+                    self._start_time = time.monotonic()
+
+            if self.speed:
+                due = (
+                    self._start_time
+                    + (self._next["ts"] - self._start_ts) / 1e9 / self.speed
+                )
+                if due > deadline:
+                    time.sleep(max(0.0, deadline - time.monotonic()))
+                    break
+            events.append(self._next)
+            self._next = None
+        return events
+
+    def close(self):
+        self._file.close()
+
+
+class TracePipeSource:
+    """
+    Streams the page fault events of a package from trace_pipe of a dedicated ftrace instance on the device.
+
+    trace_pipe only reports thread ids, so events are matched to the package by polling the threads of its process.
+    Events are kept until the process starts and events of threads started since the last poll are retried once.
+    """
+
+    def __init__(self, device: DeviceSession, package_name: str, event: str):
+        self.device = device
+        self.package_name = package_name
+        self.event = event
+        self.done = False
+        self.pid: Optional[int] = None
+        self.tids: Set[int] = set()
+        self.instance = ""
+        # Unmatched events and whether they were already retried after the process started
+        self._backlog: Deque[Tuple[int, Dict, bool]] = deque(maxlen=MAX_BACKLOG_EVENTS)
+        self._lines: "queue.Queue[Optional[str]]" = queue.Queue()
+        self._reader: Optional[subprocess.Popen] = None
+
+    def start(self):
+        tracefs = self.device.run(
+            "[ -d /sys/kernel/tracing/instances ] && echo /sys/kernel/tracing || echo /sys/kernel/debug/tracing",
+            check=True,
+        ).stdout.strip()
+        self.instance = f"{tracefs}/instances/{FTRACE_INSTANCE}"
+        instance = shlex.quote(self.instance)
+        # Remove the instance left by an interrupted session
+        self.device.run(f"rmdir {instance} 2>/dev/null; mkdir {instance}", check=True)
+        self.device.run(
+            f"echo 1 > {instance}/events/{self.event}/enable && echo 1 > {instance}/tracing_on",
+            check=True,
+        )
+
+        # trace_pipe blocks, so it is read from another shell by a thread
+        self._reader = subprocess.Popen(
+            self.device.root_prefix,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            errors="replace",
+            # Keep reading when Ctrl-C stops the session
+            start_new_session=True,
+        )
+        self._reader.stdin.write(f"exec cat {instance}/trace_pipe\n")
+        self._reader.stdin.flush()
+        threading.Thread(target=self._read_lines, daemon=True).start()
+
+    def _read_lines(self):
+        for line in self._reader.stdout:
+            self._lines.put(line)
+        self._lines.put(None)
+
+    def _update_threads(self):
+        package = shlex.quote(self.package_name)
+        output = self.device.run(
+            f"pid=$(pidof {package}) && echo $pid && ls /proc/$pid/task"
+        ).stdout.split()
+        if output and output[0].isdigit():
+            self.pid = int(output[0])
+            self.tids.update(int(tid) for tid in output[1:] if tid.isdigit())
+
+    def read(self, deadline: float) -> List[Dict]:
+        """
+        @returns the events of the package read by the deadline in time.monotonic() seconds
+        """
+        time.sleep(max(0.0, deadline - time.monotonic()))
+        parsed = []
+        while True:
+            try:
+                line = self._lines.get_nowait()
+            except queue.Empty:
+                break
+            if line is None:
+                self.done = True
+                break
+            event = parse_trace_line(line)
+            if event:
+                parsed.append(event)
+
+        candidates = list(self._backlog) + [(tid, e, False) for tid, e in parsed]
+        self._backlog.clear()
+        self._update_threads()
+        events = []
+        for tid, event, retried in candidates:
+            if tid in self.tids:
+                event["process_name"] = self.package_name
+                events.append(event)
+            elif self.pid is None:
+                self._backlog.append((tid, event, False))
+            elif not retried:
+                # The thread may have started since the threads were polled
+                self._backlog.append((tid, event, True))
+        return events
+
+    def stop(self):
+        if self._reader:
+            self._reader.kill()
+            self._reader.wait()
+        instance = shlex.quote(self.instance)
+        self.device.run(f"echo 0 > {instance}/tracing_on; rmdir {instance}")
+
+
+class LiveUserPageFaultMapper(UserPageFaultMapper):
+    """
+    Maps page_fault_user events with the maps of the process, which are dumped again while faults fall outside of
+    every mapping as the process maps files during startup
+    """
+
+    def __init__(
+        self,
+        source: TracePipeSource,
+        residency: ResidencyModel,
+    ):
+        super().__init__([], {}, residency)
+        self.source = source
+        self._refresh_time = 0.0
+
+    def map(self, user_page_fault_entries: List[Dict]) -> Dict[str, List]:
+        now = time.monotonic()
+        if (
+            self.source.pid is not None
+            and now - self._refresh_time >= MAPS_REFRESH_INTERVAL
+        ):
+            addresses = np.fromiter(
+                (e["address"] for e in user_page_fault_entries),
+                dtype=np.uint64,
+                count=len(user_page_fault_entries),
+            )
+            if (find_map_entries(self.map_index, addresses) < 0).any():
+                self._refresh_time = now
+                result = self.source.device.run(f"cat /proc/{self.source.pid}/maps")
+                if result.returncode == 0:
+                    self.set_map_entries(parse_maps_lines(result.stdout.splitlines()))
+        return super().map(user_page_fault_entries)
+
+
+class LivePageCacheMapper(PageCacheMapper):
+    """
+    Maps mm_filemap_add_to_page_cache events, resolving the inodes on the device as they are first seen
+    """
+
+    def __init__(
+        self,
+        device: DeviceSession,
+        package_name: str,
+        residency: ResidencyModel,
+    ):
+        super().__init__({}, {}, residency)
+        self.device = device
+        self.package_name = package_name
+        self._searched: Set[Tuple[int, int]] = set()
+
+    def map(self, page_cache_entries: List[Dict]) -> Dict[str, List]:
+        unknown = (
+            set((e["sdev"], e["inode"]) for e in page_cache_entries)
+            - self.inode_mappings.keys()
+            - self._searched
+        )
+        if unknown:
+            self._searched.update(unknown)
+            self.inode_mappings.update(
+                resolve_inodes(self.device, self.package_name, unknown)
+            )
+        return super().map(page_cache_entries)
+
+
+class FaultCounts:
+    """
+    Cumulative and rolling fault counts of each file
+    """
+
+    def __init__(self):
+        self.start_time = time.monotonic()
+        self.events = 0
+        self.faults: Counter = Counter()
+        self.major_faults: Counter = Counter()
+        self._interval_start = self.start_time
+        self._interval_events = 0
+        self._interval_major_faults: Counter = Counter()
+
+    def add(self, events: int, columns: Dict[str, List]):
+        self.events += events
+        self._interval_events += events
+        self.faults.update(columns["file_name"])
+        major_files = list(
+            itertools.compress(columns["file_name"], columns["is_major"])
+        )
+        self.major_faults.update(major_files)
+        self._interval_major_faults.update(major_files)
+
+    def report(self, top: int) -> str:
+        """
+        Format the totals and the files with the most major faults, with their rate since the previous report
+        """
+        now = time.monotonic()
+        interval = max(now - self._interval_start, 1e-9)
+        lines = [
+            f"[{now - self.start_time:7.1f}s] {self.events} events "
+            f"({self._interval_events / interval:.0f}/s), "
+            f"{sum(self.faults.values())} mapped faults, "
+            f"{sum(self.major_faults.values())} major "
+            f"({sum(self._interval_major_faults.values()) / interval:.0f}/s)",
+            f"{'major':>8} {'major/s':>8} {'faults':>8}  file",
+        ]
+        for file_name, major_faults in self.major_faults.most_common(top):
+            lines.append(
+                f"{major_faults:>8} {self._interval_major_faults[file_name] / interval:>8.0f} "
+                f"{self.faults[file_name]:>8}  {file_name}"
+            )
+
+        self._interval_start = now
+        self._interval_events = 0
+        self._interval_major_faults.clear()
+        return "\n".join(lines)
+
+
+def run_live(
+    source,
+    mapper,
+    interval: float,
+    top: int,
+    duration: Optional[float] = None,
+) -> FaultCounts:
+    """
+    Map the events of the source as they arrive and print the rolling counts every `interval` seconds until the
+    source is exhausted, `duration` seconds passed or Ctrl-C
+    """
+    counts = FaultCounts()
+    next_report = counts.start_time + interval
+    try:
+        while not source.done:
+            if duration and time.monotonic() - counts.start_time >= duration:
+                break
+            events = source.read(next_report)
+            for chunk in chunked(events, DEFAULT_CHUNK_SIZE):
+                counts.add(len(chunk), mapper.map(chunk))
+            if time.monotonic() >= next_report:
+                print(counts.report(top), flush=True)
+                next_report = max(next_report + interval, time.monotonic())
+    except KeyboardInterrupt:
+        print("Stopped")
+
+    elapsed = time.monotonic() - counts.start_time
+    print(counts.report(top))
+    print(
+        f"Processed {counts.events} events in {elapsed:.2f}s ({counts.events / max(elapsed, 1e-9):.0f} events/s)"
+    )
+    return counts
+
+
+def launch(serial: Optional[str], package_name: str):
+    # `am start -W` blocks until the app is displayed, so the launch gets its own session
+    with DeviceSession(serial) as device:
+        launch_app(device, package_name)
+
+
+def live(args: argparse.Namespace):
+    with DeviceSession(args.serial) as device:
+        page_cache = "arm" in device.arch
+        residency = ResidencyModel(device.page_size, get_readahead_policy(args))
+        source = TracePipeSource(
+            device,
+            args.package,
+            PAGE_CACHE_EVENT if page_cache else USER_PAGE_FAULT_EVENT,
+        )
+        if page_cache:
+            mapper = LivePageCacheMapper(device, args.package, residency)
+        else:
+            mapper = LiveUserPageFaultMapper(source, residency)
+
+        if args.launch:
+            prepare_cold_start(device, args.package)
+        source.start()
+        try:
+            if args.launch:
+                print("Launching app...")
+                threading.Thread(
+                    target=launch, args=(args.serial, args.package), daemon=True
+                ).start()
+            else:
+                print("Tracing. Launch the app and press Ctrl-C to stop.")
+            run_live(source, mapper, args.interval_ms / 1000, args.top, args.duration)
+        finally:
+            source.stop()
+
+
+def replay(args: argparse.Namespace):
+    page_size = load_page_size(args.output)
+    source = ReplaySource(
+        os.path.join(args.output, "faults.csv"), args.speed, page_size
+    )
+    file_sizes = (
+        load_file_sizes(args.output)
+        if os.path.exists(os.path.join(args.output, "file_sizes.csv"))
+        else {}
+    )
+    apk_indexes = (
+        load_apk_indexes(args.output)
+        if os.path.exists(os.path.join(args.output, "apk_indexes.json"))
+        else {}
+    )
+    residency = ResidencyModel(page_size, get_readahead_policy(args), file_sizes)
+    if source.page_cache:
+        mapper = PageCacheMapper(
+            compute_inode_mapping(args.output), apk_indexes, residency
+        )
+    else:
+        mapper = UserPageFaultMapper(parse_maps(args.output), apk_indexes, residency)
+
+    try:
+        run_live(source, mapper, args.interval_ms / 1000, args.top, args.duration)
+    finally:
+        source.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Print rolling per-file page fault counts while an app starts"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    # Options shared by the device and replay sources
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument(
+        "--interval-ms",
+        type=int,
+        default=DEFAULT_INTERVAL_MS,
+        help=f"Milliseconds between reports (default: {DEFAULT_INTERVAL_MS})",
+    )
+    common.add_argument(
+        "--top",
+        type=int,
+        default=DEFAULT_TOP,
+        help=f"Number of files to report, ranked by major faults (default: {DEFAULT_TOP})",
+    )
+    common.add_argument(
+        "--duration",
+        type=float,
+        help="Stop after this many seconds (default: until Ctrl-C or the end of the replay)",
+    )
+    common.add_argument(
+        "--readahead-pages",
+        type=int,
+        default=DEFAULT_RA_PAGES,
+        help=f"Max pages read ahead on a major page fault (default: {DEFAULT_RA_PAGES})",
+    )
+    common.add_argument(
+        "--readahead-ramp-up",
+        action="store_true",
+        default=False,
+        help="Model the kernel's readahead window ramping up on sequential major page faults (default: false)",
+    )
+    common.add_argument(
+        "--ra-pages",
+        type=str,
+        action="append",
+        default=[],
+        metavar="SUFFIX=PAGES",
+        help="Override the readahead pages for files ending with SUFFIX (e.g. base.vdex=64). Can be repeated",
+    )
+
+    device_parser = subparsers.add_parser(
+        "device",
+        parents=[common],
+        help="Tail the page fault events of an app on the device",
+    )
+    device_parser.add_argument(
+        "--package", type=str, required=True, help="Android package name to analyze"
+    )
+    device_parser.add_argument(
+        "--serial",
+        type=str,
+        default=None,
+        help="Serial of the device to use when several are connected (default: the only connected device)",
+    )
+    device_parser.add_argument(
+        "--launch",
+        action="store_true",
+        default=False,
+        help="Force stop the app, clear the page cache and launch it once tracing started (default: false)",
+    )
+
+    replay_parser = subparsers.add_parser(
+        "replay",
+        parents=[common],
+        help="Feed the faults.csv of a collected run through the live path",
+    )
+    replay_parser.add_argument(
+        "--output",
+        type=str,
+        default="output",
+        help="Output directory of the run to replay (default: output)",
+    )
+    replay_parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="Replay speed relative to the recorded pace, 0 to replay as fast as possible (default: 1.0)",
+    )
+    args = parser.parse_args()
+
+    if args.command == "device":
+        live(args)
+    else:
+        replay(args)
+
+
+if __name__ == "__main__":
+    main()
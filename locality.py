@@ -0,0 +1,243 @@
+import argparse
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from readahead import DEFAULT_RA_PAGES, ReadaheadPolicy
+from utilities import DEFAULT_PAGE_SIZE, load_mappings, load_page_size
+
+# Pages are keyed by group * GROUP_STRIDE + page so the pages of every group sort together
+GROUP_STRIDE = 1 << 40
+
+
+def compute_group_locality(
+    groups: np.ndarray,
+    pages: np.ndarray,
+    is_major: np.ndarray,
+    window_pages: np.ndarray,
+    file_pages: np.ndarray,
+) -> Dict[str, np.ndarray]:
+    """
+    Compute the locality metrics of every group of faults at once. Readahead is modelled with a fixed window after
+    every major fault.
+
+    Args:
+        groups: Group of each fault, in [0, num_groups)
+        pages: Page of each fault
+        is_major: Whether each fault is major
+        window_pages: Readahead window of each group in pages
+        file_pages: Size of the file of each group in pages, 0 if unknown
+
+    @returns an array of length num_groups per metric
+    """
+    num_groups = len(window_pages)
+    groups = groups.astype(np.int64)
+    keys = groups * GROUP_STRIDE + pages
+
+    # Distinct pages sorted by group, then page
+    touched = np.unique(keys)
+    touched_groups = touched // GROUP_STRIDE
+    distinct_pages = np.bincount(touched_groups, minlength=num_groups)
+
+    # Each group's first and last touched pages bound its span
+    has_pages = distinct_pages > 0
+    last = np.cumsum(distinct_pages)[has_pages] - 1
+    first = last - distinct_pages[has_pages] + 1
+    span_pages = np.zeros(num_groups, np.int64)
+    span_pages[has_pages] = touched[last] - touched[first] + 1
+
+    # A run starts at every page that does not directly follow the previous touched page
+    run_starts = np.ones(len(touched), bool)
+    run_starts[1:] = np.diff(touched) != 1
+    contiguous_runs = np.bincount(touched_groups[run_starts], minlength=num_groups)
+
+    # Readahead windows [page, page + 1 + window) of the major faults, sorted by start
+    starts = np.sort(keys[is_major])
+    major_groups = starts // GROUP_STRIDE
+    window_ends = starts - major_groups * GROUP_STRIDE + 1 + window_pages[major_groups]
+    file_ends = file_pages[major_groups]
+    window_ends = np.where(
+        file_ends > 0, np.minimum(window_ends, file_ends), window_ends
+    )
+    ends = major_groups * GROUP_STRIDE + window_ends
+    readahead_windows = np.bincount(major_groups, minlength=num_groups)
+
+    # Count the pages of the union of the windows. Windows of a group never reach the next group
+    previous_end = np.concatenate([[-1], np.maximum.accumulate(ends)[:-1]])
+    fetched = np.maximum(ends - np.maximum(starts, previous_end), 0)
+    readahead_pages = np.bincount(
+        major_groups, weights=fetched, minlength=num_groups
+    ).astype(np.int64)
+
+    # Touched pages within the union of the windows were used
+    used_pages = np.zeros(num_groups, np.int64)
+    if len(starts):
+        block_starts = np.flatnonzero(starts > previous_end)
+        block_ends = np.maximum.reduceat(ends, block_starts)
+        block = np.searchsorted(starts[block_starts], touched, side="right") - 1
+        used = (block >= 0) & (touched < block_ends[np.maximum(block, 0)])
+        used_pages = np.bincount(touched_groups[used], minlength=num_groups)
+
+    return {
+        "distinct_pages": distinct_pages,
+        "span_pages": span_pages,
+        # Perfectly ordered, the touched pages would be contiguous
+        "ideal_span_pages": distinct_pages,
+        # Share of the span that was not touched
+        "fragmentation": np.divide(
+            span_pages - distinct_pages,
+            span_pages,
+            out=np.zeros(num_groups),
+            where=has_pages,
+        ),
+        "contiguous_runs": contiguous_runs,
+        "readahead_windows": readahead_windows,
+        "ideal_readahead_windows": -(-distinct_pages // (window_pages + 1)),
+        "readahead_pages": readahead_pages,
+        "readahead_waste_pages": readahead_pages - used_pages,
+    }
+
+
+def compute_locality(
+    mapped_faults: pd.DataFrame,
+    file_sizes: List[Dict],
+    readahead_policy: Optional[ReadaheadPolicy] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+) -> pd.DataFrame:
+    """
+    Compute the locality metrics of every file and of every zip entry of APKs
+
+    @returns a data frame indexed by (file_name, zip_entry_name), zip_entry_name is empty for whole files
+    """
+    readahead_policy = readahead_policy or ReadaheadPolicy()
+    sizes = {
+        file["file_name"]: file["size"]
+        for file in file_sizes
+        if file["zip_entry_name"] is None
+    }
+    pages = mapped_faults["offset"].to_numpy(dtype=np.int64) // page_size
+    is_major = mapped_faults["is_major"].to_numpy(dtype=bool)
+
+    results = []
+    for columns, selected in [
+        (["file_name"], np.ones(len(mapped_faults), bool)),
+        (
+            ["file_name", "zip_entry_name"],
+            mapped_faults["zip_entry_name"].notna().to_numpy(),
+        ),
+    ]:
+        grouped = mapped_faults.loc[selected, columns].groupby(
+            columns, observed=True, sort=True
+        )
+        # size() lists the groups in the order of ngroup()
+        keys = [
+            key if isinstance(key, tuple) else (key, "") for key in grouped.size().index
+        ]
+        file_names = [file_name for file_name, _ in keys]
+        metrics = compute_group_locality(
+            grouped.ngroup().to_numpy(),
+            pages[selected],
+            is_major[selected],
+            np.array(
+                [readahead_policy.ra_pages_for(name) for name in file_names], np.int64
+            ),
+            np.array(
+                [-(-sizes.get(name, 0) // page_size) for name in file_names], np.int64
+            ),
+        )
+        results.append(
+            pd.DataFrame(
+                metrics,
+                index=pd.MultiIndex.from_tuples(
+                    keys, names=["file_name", "zip_entry_name"]
+                ),
+            )
+        )
+
+    return pd.concat(results).sort_index()
+
+
+def format_locality(locality: pd.DataFrame, top: int) -> str:
+    rows = locality.sort_values(
+        ["readahead_waste_pages", "distinct_pages"], ascending=False
+    ).head(top)
+    lines = [
+        f"{'file':<60} {'pages':>7} {'span':>7} {'frag':>6} {'runs':>6} "
+        f"{'ra':>5} {'ideal':>5} {'fetched':>8} {'waste':>7}"
+    ]
+    for row in rows.itertuples():
+        file_name, zip_entry_name = row.Index
+        name = f"{file_name}!{zip_entry_name}" if zip_entry_name else file_name
+        if len(name) > 60:
+            name = "..." + name[-57:]
+        lines.append(
+            f"{name:<60} {row.distinct_pages:>7} {row.span_pages:>7} "
+            f"{row.fragmentation:>6.2f} {row.contiguous_runs:>6} "
+            f"{row.readahead_windows:>5} {row.ideal_readahead_windows:>5} "
+            f"{row.readahead_pages:>8} {row.readahead_waste_pages:>7}"
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Score the code locality of the files faulted in by a run"
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="output",
+        help="Output directory of the run (default: output)",
+    )
+    parser.add_argument(
+        "--readahead-pages",
+        type=int,
+        default=DEFAULT_RA_PAGES,
+        help=f"Max pages read ahead on a major page fault (default: {DEFAULT_RA_PAGES})",
+    )
+    parser.add_argument(
+        "--ra-pages",
+        type=str,
+        action="append",
+        default=[],
+        metavar="SUFFIX=PAGES",
+        help="Override the readahead pages for files ending with SUFFIX (e.g. base.vdex=64). Can be repeated",
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=20,
+        help="Number of files and zip entries to print, ranked by readahead waste (default: 20)",
+    )
+    parser.add_argument(
+        "--csv",
+        type=str,
+        help="Write the metrics of every file and zip entry to this CSV file",
+    )
+    args = parser.parse_args()
+
+    mapped_faults, file_sizes = load_mappings(args.output)
+    locality = compute_locality(
+        mapped_faults,
+        file_sizes,
+        ReadaheadPolicy(
+            ra_pages=args.readahead_pages,
+            file_ra_pages={
+                suffix: int(pages)
+                for suffix, pages in (
+                    override.split("=", 1) for override in args.ra_pages
+                )
+            },
+        ),
+        load_page_size(args.output),
+    )
+    print(format_locality(locality, args.top))
+
+    if args.csv:
+        locality.to_csv(args.csv)
+        print(f"Wrote {args.csv}")
+
+
+if __name__ == "__main__":
+    main()
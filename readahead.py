@@ -0,0 +1,172 @@
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+
+# Default max readahead of 128KB
+DEFAULT_RA_PAGES = 32
+
+
+@dataclass
+class ReadaheadPolicy:
+    """
+    Approximation of the kernel's readahead on a major page fault.
+
+    ra_pages: Max number of pages read ahead of the faulting page
+    ramp_up: Model the kernel's on-demand readahead where the window starts small and doubles on each sequential miss
+    file_ra_pages: Overrides of ra_pages for files ending with the given suffix (e.g. "base.vdex")
+    """
+
+    ra_pages: int = DEFAULT_RA_PAGES
+    ramp_up: bool = False
+    file_ra_pages: Dict[str, int] = field(default_factory=dict)
+
+    def ra_pages_for(self, file_name: str) -> int:
+        for suffix, ra_pages in self.file_ra_pages.items():
+            if file_name.endswith(suffix):
+                return ra_pages
+        return self.ra_pages
+
+    def initial_window(self, max_pages: int) -> int:
+        """
+        Mirrors get_init_ra_size() in mm/readahead.c for a single page request
+        """
+        if not self.ramp_up:
+            return max_pages
+        if 1 <= max_pages // 32:
+            return min(4, max_pages)
+        if 1 <= max_pages // 4:
+            return min(2, max_pages)
+        return max_pages
+
+    def next_window(self, window: int, max_pages: int) -> int:
+        """
+        Mirrors get_next_ra_size() in mm/readahead.c
+        """
+        if not self.ramp_up:
+            return max_pages
+        if window < max_pages // 16:
+            return min(4 * window, max_pages)
+        if window <= max_pages // 2:
+            return min(2 * window, max_pages)
+        return max_pages
+
+
+class PageResidency:
+    """
+    Bitmap of the pages of a file that are assumed to be in the page cache
+    """
+
+    def __init__(self, num_pages: int = 0):
+        self._bits = bytearray((num_pages + 7) // 8)
+        # A known size bounds readahead to the end of the file
+        self.num_pages = num_pages
+
+    def is_resident(self, page: int) -> bool:
+        byte = page >> 3
+        return byte < len(self._bits) and bool(self._bits[byte] >> (page & 7) & 1)
+
+    def count(self) -> int:
+        """
+        @returns the number of resident pages
+        """
+        return int.from_bytes(self._bits, "little").bit_count()
+
+    def mark(self, start: int, end: int):
+        """
+        Mark the pages in [start, end) as resident
+        """
+        if self.num_pages:
+            end = min(end, self.num_pages)
+        if end <= start:
+            return
+        first_byte = start >> 3
+        last_byte = (end - 1) >> 3
+        if last_byte >= len(self._bits):
+            self._bits.extend(bytes(last_byte + 1 - len(self._bits)))
+
+        if first_byte == last_byte:
+            self._bits[first_byte] |= ((1 << (end - start)) - 1) << (start & 7)
+            return
+        self._bits[first_byte] |= (0xFF << (start & 7)) & 0xFF
+        self._bits[first_byte + 1 : last_byte] = b"\xff" * (last_byte - first_byte - 1)
+        self._bits[last_byte] |= (1 << (((end - 1) & 7) + 1)) - 1
+
+
+class ResidencyModel:
+    """
+    Tracks the page cache residency of every file to classify page faults as major or minor.
+
+    A fault is major if its page is not resident. A major fault brings in the page along with a readahead window
+    of the following pages.
+    """
+
+    def __init__(
+        self,
+        page_size: int,
+        policy: Optional[ReadaheadPolicy] = None,
+        file_sizes: Dict[str, int] = {},
+    ):
+        self.page_size = page_size
+        self.policy = policy or ReadaheadPolicy()
+        self.file_sizes = file_sizes
+        self._residency: Dict[str, PageResidency] = {}
+        # file name -> (end page of the last readahead window, size of the last readahead window)
+        self._windows: Dict[str, tuple] = {}
+
+    def _get_residency(self, file_name: str) -> PageResidency:
+        residency = self._residency.get(file_name)
+        if residency is None:
+            file_size = self.file_sizes.get(file_name, 0)
+            residency = PageResidency(
+                (file_size + self.page_size - 1) // self.page_size
+            )
+            self._residency[file_name] = residency
+        return residency
+
+    def access(self, file_name: str, offset: int) -> bool:
+        """
+        Record an access to the file offset
+
+        @returns whether the access was a major fault
+        """
+        residency = self._get_residency(file_name)
+        page = offset // self.page_size
+        if residency.is_resident(page):
+            return False
+
+        max_pages = self.policy.ra_pages_for(file_name)
+        last_end, last_window = self._windows.get(file_name, (None, 0))
+        if page == last_end:
+            window = self.policy.next_window(last_window, max_pages)
+        else:
+            window = self.policy.initial_window(max_pages)
+
+        # Always record the page itself and the readahead window that follows
+        residency.mark(page, page + 1 + window)
+        self._windows[file_name] = (page + 1 + window, window)
+        return True
+
+    def resident_pages(self) -> Dict[str, int]:
+        """
+        @returns the number of pages of each file brought into the page cache so far
+        """
+        return {
+            file_name: residency.count()
+            for file_name, residency in self._residency.items()
+        }
+
+    def classify(self, file_names: Sequence[str], offsets: np.ndarray) -> np.ndarray:
+        """
+        Replay accesses in order
+
+        @returns whether each access was a major fault
+        """
+        return np.fromiter(
+            (
+                self.access(file_name, offset)
+                for file_name, offset in zip(file_names, offsets.tolist())
+            ),
+            dtype=bool,
+            count=len(offsets),
+        )
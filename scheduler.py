@@ -0,0 +1,172 @@
+import argparse
+import json
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+from faults import DeviceSession, add_processing_arguments, start_package_analysis
+
+
+def parse_job(job: str) -> Tuple[str, str]:
+    serial, separator, package_name = job.rpartition("=")
+    if not separator or not serial or not package_name:
+        raise argparse.ArgumentTypeError(f"Expected SERIAL=PACKAGE, got: {job}")
+    return serial, package_name
+
+
+class Manifest:
+    """
+    Record of every job of a run written to <output>/manifest.json as jobs finish
+    """
+
+    def __init__(self, output_dir: str):
+        self.path = os.path.join(output_dir, "manifest.json")
+        self.jobs: List[Dict] = []
+        self._lock = threading.Lock()
+
+    def add(self, job: Dict):
+        with self._lock:
+            self.jobs.append(job)
+            self.jobs.sort(key=lambda j: (j["serial"], j["package"]))
+            with open(self.path, "w") as f:
+                json.dump({"jobs": self.jobs}, f, indent=2)
+
+
+def fail_job(job: Dict):
+    traceback.print_exc()
+    job["status"] = "failed"
+    job["error"] = traceback.format_exc()
+
+
+def finish_job(job: Dict, finish: Optional[Callable[[], None]], manifest: Manifest):
+    """
+    Wait for the processing of the job, unless its collection failed, and add it to the manifest
+    """
+    if finish is not None:
+        try:
+            finish()
+            job["status"] = "succeeded"
+        except Exception:
+            fail_job(job)
+    job["finished"] = time.time()
+    manifest.add(job)
+
+
+def run_device_jobs(
+    serial: str,
+    package_names: List[str],
+    output_dir: str,
+    executor: ProcessPoolExecutor,
+    manifest: Manifest,
+    args: argparse.Namespace,
+):
+    """
+    Run the jobs of a device one after another since they share the device's page cache.
+    The processing of a job runs in the executor while the next job collects.
+    """
+    pending: List[Tuple[Dict, Optional[Callable[[], None]]]] = []
+    with DeviceSession(serial) as device:
+        for package_name in package_names:
+            job = {
+                "serial": serial,
+                "package": package_name,
+                "output": os.path.join(output_dir, serial, package_name),
+                "started": time.time(),
+            }
+            round_trips = device.round_trips
+            finish = None
+            try:
+                job["device"] = {
+                    "sdk_version": device.sdk_version,
+                    "arch": device.arch,
+                    "page_size": device.page_size,
+                    "fingerprint": device.fingerprint,
+                    "root_prefix": device.root_prefix,
+                }
+                # Jobs of other devices and earlier processing share the processes
+                finish = start_package_analysis(
+                    device,
+                    package_name,
+                    job["output"],
+                    executor,
+                    args,
+                    launch=True,
+                    concurrent_jobs=True,
+                )
+            except Exception:
+                fail_job(job)
+            job["adb_round_trips"] = device.round_trips - round_trips
+            for previous in pending:
+                finish_job(*previous, manifest)
+            pending = [(job, finish)]
+    for previous in pending:
+        finish_job(*previous, manifest)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Collect and process Android page faults on several devices concurrently"
+    )
+    parser.add_argument(
+        "--job",
+        type=parse_job,
+        action="append",
+        required=True,
+        metavar="SERIAL=PACKAGE",
+        help="Package to analyze on the device with the adb serial. Can be repeated",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="output",
+        help="Output directory, results are written to <output>/<serial>/<package> (default: output)",
+    )
+    add_processing_arguments(parser)
+
+    args = parser.parse_args()
+
+    device_jobs: Dict[str, List[str]] = {}
+    for serial, package_name in args.job:
+        device_jobs.setdefault(serial, []).append(package_name)
+
+    if args.profile:
+        print(
+            "Profiled metrics are process-wide and include the work of concurrent jobs, they are marked as "
+            "concurrent_jobs in run_metrics.json"
+        )
+    os.makedirs(args.output, exist_ok=True)
+    manifest = Manifest(args.output)
+    with (
+        # Forking while device threads run could copy their held locks
+        ProcessPoolExecutor(
+            mp_context=multiprocessing.get_context("forkserver")
+        ) as executor,
+        ThreadPoolExecutor(max_workers=len(device_jobs)) as device_executor,
+    ):
+        futures = [
+            device_executor.submit(
+                run_device_jobs,
+                serial,
+                package_names,
+                args.output,
+                executor,
+                manifest,
+                args,
+            )
+            for serial, package_names in device_jobs.items()
+        ]
+        for future in futures:
+            future.result()
+
+    failed = [job for job in manifest.jobs if job["status"] != "succeeded"]
+    print(
+        f"{len(manifest.jobs) - len(failed)}/{len(manifest.jobs)} jobs succeeded. Manifest: {manifest.path}"
+    )
+
+
+if __name__ == "__main__":
+    main()
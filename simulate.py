@@ -0,0 +1,194 @@
+import argparse
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from readahead import ReadaheadPolicy, ResidencyModel
+from utilities import load_mappings
+
+TOTAL = "(total)"
+
+# The recorded faults, set in each worker by load_worker
+_file_names: List[str] = []
+_offsets: np.ndarray = np.empty(0, np.int64)
+_file_sizes: Dict[str, int] = {}
+
+
+@dataclass(frozen=True)
+class Config:
+    """
+    A page size and readahead configuration to replay the faults with.
+
+    readahead_kb: Max readahead in KB, like /sys/block/<dev>/queue/read_ahead_kb
+    """
+
+    page_size: int
+    readahead_kb: int
+    ramp_up: bool = False
+
+    @property
+    def ra_pages(self) -> int:
+        return self.readahead_kb * 1024 // self.page_size
+
+
+def load_worker(file_names: List[str], offsets: np.ndarray, file_sizes: Dict[str, int]):
+    global _file_names, _offsets, _file_sizes
+    _file_names, _offsets, _file_sizes = file_names, offsets, file_sizes
+
+
+def simulate(config: Config) -> Dict[str, Dict[str, int]]:
+    """
+    Replay the recorded faults in order through the page cache model
+
+    @returns the predicted major faults and bytes read of each file
+    """
+    residency = ResidencyModel(
+        config.page_size,
+        ReadaheadPolicy(ra_pages=config.ra_pages, ramp_up=config.ramp_up),
+        _file_sizes,
+    )
+    is_major = residency.classify(_file_names, _offsets)
+
+    major_faults: Dict[str, int] = {}
+    for file_name, major in zip(_file_names, is_major.tolist()):
+        major_faults[file_name] = major_faults.get(file_name, 0) + major
+    return {
+        file_name: {
+            "major_faults": major_faults[file_name],
+            "io_bytes": pages * config.page_size,
+        }
+        for file_name, pages in residency.resident_pages().items()
+    }
+
+
+def run_grid(
+    mapped_faults: pd.DataFrame,
+    file_sizes: Dict[str, int],
+    configs: List[Config],
+    jobs: Optional[int] = None,
+) -> pd.DataFrame:
+    """
+    Simulate every configuration in parallel
+
+    @returns the predicted major faults and bytes read per configuration and file, with a total row per configuration
+    """
+    # Faults must be replayed in the order they happened
+    mapped_faults = mapped_faults.sort_values("ts", kind="stable")
+    file_names = mapped_faults["file_name"].astype(str).tolist()
+    offsets = mapped_faults["offset"].to_numpy(dtype=np.int64)
+
+    rows = []
+    with ProcessPoolExecutor(
+        max_workers=jobs,
+        initializer=load_worker,
+        initargs=(file_names, offsets, file_sizes),
+    ) as executor:
+        for config, results in zip(configs, executor.map(simulate, configs)):
+            totals = {
+                "major_faults": sum(r["major_faults"] for r in results.values()),
+                "io_bytes": sum(r["io_bytes"] for r in results.values()),
+            }
+            for file_name, result in [(TOTAL, totals)] + sorted(results.items()):
+                rows.append(
+                    {
+                        "page_size": config.page_size,
+                        "readahead_kb": config.readahead_kb,
+                        "ramp_up": config.ramp_up,
+                        "file_name": file_name,
+                        **result,
+                    }
+                )
+    return pd.DataFrame(rows)
+
+
+def format_grid(results: pd.DataFrame, recorded_major_faults: int) -> str:
+    totals = results[results["file_name"] == TOTAL]
+    lines = [
+        f"Recorded major faults: {recorded_major_faults}",
+        f"{'page size':>9} {'readahead':>10} {'ramp-up':>8} {'major faults':>13} {'I/O (MB)':>9}",
+    ]
+    for row in totals.itertuples():
+        lines.append(
+            f"{row.page_size // 1024:>8}K {row.readahead_kb:>9}K {str(row.ramp_up):>8} "
+            f"{row.major_faults:>13} {row.io_bytes / (1 << 20):>9.1f}"
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Predict the major faults and I/O of a run under other page sizes and readahead settings"
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="output",
+        help="Output directory of the run to replay (default: output)",
+    )
+    parser.add_argument(
+        "--page-sizes",
+        type=int,
+        nargs="+",
+        default=[4096, 16384],
+        help="Page sizes in bytes to simulate (default: 4096 16384)",
+    )
+    parser.add_argument(
+        "--readahead-kb",
+        type=int,
+        nargs="+",
+        default=[32, 64, 128, 256],
+        help="Max readahead sizes in KB to simulate, converted to pages of each page size (default: 32 64 128 256)",
+    )
+    parser.add_argument(
+        "--readahead-ramp-up",
+        action="store_true",
+        default=False,
+        help="Also simulate the kernel's readahead window ramping up on sequential major page faults (default: false)",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of configurations to simulate in parallel (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--csv",
+        type=str,
+        help="Write the predictions of every configuration and file to this CSV file",
+    )
+    args = parser.parse_args()
+
+    mapped_faults, file_sizes = load_mappings(args.output)
+    configs = [
+        Config(page_size, readahead_kb, ramp_up)
+        for page_size, readahead_kb, ramp_up in itertools.product(
+            args.page_sizes,
+            args.readahead_kb,
+            [False, True] if args.readahead_ramp_up else [False],
+        )
+    ]
+    print(f"Simulating {len(configs)} configurations...")
+    results = run_grid(
+        mapped_faults,
+        {
+            file["file_name"]: file["size"]
+            for file in file_sizes
+            if file["zip_entry_name"] is None
+        },
+        configs,
+        args.jobs,
+    )
+    print(format_grid(results, int(mapped_faults["is_major"].sum())))
+
+    if args.csv:
+        results.to_csv(args.csv, index=False)
+        print(f"Wrote {args.csv}")
+
+
+if __name__ == "__main__":
+    main()
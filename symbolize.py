@@ -0,0 +1,670 @@
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+import subprocess
+import zipfile
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+import pandas as pd
+
+from elf import find_stored_libraries, is_elf, parse_elf, pull_library
+from faults import DeviceSession, get_cache_dir
+from utilities import load_mapped_faults, load_page_size
+
+DEX_MAGIC_PREFIX = b"dex\n0"
+DEX_HEADER_SIZE = 0x70
+DEX_ENDIAN_CONSTANT = 0x12345678
+# file_size through data_off, after the magic, checksum and signature
+DEX_HEADER_FORMAT = "<20L"
+DEX_HEADER_OFFSET = 32
+DEX_CODE_ITEM_HEADER_SIZE = 16
+
+# Bump when the cached indexes change
+SYMBOL_INDEX_VERSION = 2
+
+# Extensions of the faulted files that can contain dex or native code
+ARTIFACT_EXTENSIONS = (".apk", ".dex", ".jar", ".vdex", ".so")
+
+# Names of the dex map_list item types
+MAP_ITEM_TYPES = {
+    0x0000: "header_item",
+    0x0001: "string_id_item",
+    0x0002: "type_id_item",
+    0x0003: "proto_id_item",
+    0x0004: "field_id_item",
+    0x0005: "method_id_item",
+    0x0006: "class_def_item",
+    0x0007: "call_site_id_item",
+    0x0008: "method_handle_item",
+    0x1000: "map_list",
+    0x1001: "type_list",
+    0x1002: "annotation_set_ref_list",
+    0x1003: "annotation_set_item",
+    0x2000: "class_data_item",
+    0x2001: "code_item",
+    0x2002: "string_data_item",
+    0x2003: "debug_info_item",
+    0x2004: "annotation_item",
+    0x2005: "encoded_array_item",
+    0x2006: "annotations_directory_item",
+    0xF000: "hiddenapi_class_data_item",
+}
+
+METHOD_ID_DTYPE = np.dtype(
+    [("class_idx", "<u2"), ("proto_idx", "<u2"), ("name_idx", "<u4")]
+)
+PROTO_ID_DTYPE = np.dtype(
+    [("shorty_idx", "<u4"), ("return_type_idx", "<u4"), ("parameters_off", "<u4")]
+)
+CLASS_DEF_DTYPE = np.dtype(
+    [
+        ("class_idx", "<u4"),
+        ("access_flags", "<u4"),
+        ("superclass_idx", "<u4"),
+        ("interfaces_off", "<u4"),
+        ("source_file_idx", "<u4"),
+        ("annotations_off", "<u4"),
+        ("class_data_off", "<u4"),
+        ("static_values_off", "<u4"),
+    ]
+)
+MAP_ITEM_DTYPE = np.dtype(
+    [("type", "<u2"), ("unused", "<u2"), ("size", "<u4"), ("offset", "<u4")]
+)
+
+# Flags of a method line of an ART profile, e.g. HSPLcom/example/Foo;->bar()V
+PROFILE_METHOD_RE = re.compile(r"^[HSP]*(L[^;]+;->.+)$")
+
+
+@dataclass
+class SymbolIndex:
+    """
+    Code and data of the dex files and native libraries within an artifact. Ranges span [start, end) in offsets of
+    the artifact and are sorted by start.
+
+    Symbols are the code items of methods and the class data of classes, or the functions and objects of native
+    libraries. Sections are the map_list sections of dex files and the sections of native libraries.
+    """
+
+    symbol_names: np.ndarray
+    symbol_kinds: np.ndarray
+    symbol_starts: np.ndarray
+    symbol_ends: np.ndarray
+    section_names: np.ndarray
+    section_starts: np.ndarray
+    section_ends: np.ndarray
+
+
+def read_uleb128(data, pos: int) -> Tuple[int, int]:
+    """
+    @returns the value and the position after it
+    """
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def read_sleb128(data, pos: int) -> Tuple[int, int]:
+    """
+    @returns the value and the position after it
+    """
+    start = pos
+    value, pos = read_uleb128(data, pos)
+    bits = 7 * (pos - start)
+    if value & (1 << (bits - 1)):
+        value -= 1 << bits
+    return value, pos
+
+
+def code_item_end(data, offset: int) -> int:
+    """
+    @returns the offset after the code item, including its tries and handlers
+    """
+    (tries_size,) = struct.unpack_from("<H", data, offset + 6)
+    (insns_size,) = struct.unpack_from("<L", data, offset + 12)
+    end = offset + DEX_CODE_ITEM_HEADER_SIZE + insns_size * 2
+    if tries_size == 0:
+        return end
+
+    # Tries are 4-byte aligned
+    if insns_size % 2:
+        end += 2
+    handlers_size, pos = read_uleb128(data, end + tries_size * 8)
+    for _ in range(handlers_size):
+        size, pos = read_sleb128(data, pos)
+        # (type_idx, addr) pairs, then a catch all address if size <= 0
+        for _ in range(abs(size) * 2 + (size <= 0)):
+            _, pos = read_uleb128(data, pos)
+    return pos
+
+
+def find_dex_files(data) -> List[int]:
+    """
+    Scan for standard dex files, which vdex files and APKs with stored dex entries embed whole
+
+    @returns the offset of each dex file
+    """
+    offsets = []
+    pos = data.find(DEX_MAGIC_PREFIX)
+    while pos != -1 and pos + DEX_HEADER_SIZE <= len(data):
+        # The magic is "dex\n" followed by a 3 digit version and a NUL
+        version = data[pos + 4 : pos + 8]
+        file_size, header_size, endian_tag = struct.unpack_from(
+            "<3L", data, pos + DEX_HEADER_OFFSET
+        )
+        if (
+            version[:3].isdigit()
+            and version[3] == 0
+            and header_size == DEX_HEADER_SIZE
+            and endian_tag == DEX_ENDIAN_CONSTANT
+            and pos + file_size <= len(data)
+        ):
+            offsets.append(pos)
+            pos = data.find(DEX_MAGIC_PREFIX, pos + file_size)
+        else:
+            pos = data.find(DEX_MAGIC_PREFIX, pos + 1)
+    return offsets
+
+
+def parse_dex(
+    data, base: int
+) -> Tuple[List[Tuple[int, int, str, str]], List[Tuple[int, int, str]]]:
+    """
+    Parse the dex file at `base`
+
+    @returns the (start, end, name, kind) of its methods and classes and the (start, end, name) of its sections
+    """
+    (
+        file_size,
+        _header_size,
+        _endian_tag,
+        _link_size,
+        _link_off,
+        map_off,
+        string_ids_size,
+        string_ids_off,
+        type_ids_size,
+        type_ids_off,
+        proto_ids_size,
+        proto_ids_off,
+        _field_ids_size,
+        _field_ids_off,
+        method_ids_size,
+        method_ids_off,
+        class_defs_size,
+        class_defs_off,
+        _data_size,
+        _data_off,
+    ) = struct.unpack_from(DEX_HEADER_FORMAT, data, base + DEX_HEADER_OFFSET)
+
+    def table(dtype, count: int, offset: int) -> np.ndarray:
+        # Copy so the mmap can be closed
+        return np.frombuffer(data, dtype, count, base + offset).copy()
+
+    string_offsets = table("<u4", string_ids_size, string_ids_off)
+    type_ids = table("<u4", type_ids_size, type_ids_off)
+    proto_ids = table(PROTO_ID_DTYPE, proto_ids_size, proto_ids_off)
+    method_ids = table(METHOD_ID_DTYPE, method_ids_size, method_ids_off)
+    class_defs = table(CLASS_DEF_DTYPE, class_defs_size, class_defs_off)
+
+    strings: Dict[int, str] = {}
+
+    def string(idx: int) -> str:
+        if idx not in strings:
+            # Skip the UTF-16 length, MUTF-8 is close enough to UTF-8 for descriptors
+            _, start = read_uleb128(data, base + int(string_offsets[idx]))
+            end = data.find(b"\0", start)
+            strings[idx] = data[start:end].decode("utf-8", errors="replace")
+        return strings[idx]
+
+    def type_name(idx: int) -> str:
+        return string(int(type_ids[idx]))
+
+    protos: Dict[int, str] = {}
+
+    def proto(idx: int) -> str:
+        if idx not in protos:
+            parameters_off = int(proto_ids[idx]["parameters_off"])
+            parameters = []
+            if parameters_off:
+                (size,) = struct.unpack_from("<L", data, base + parameters_off)
+                parameters = struct.unpack_from(
+                    f"<{size}H", data, base + parameters_off + 4
+                )
+            protos[idx] = (
+                f"({''.join(type_name(p) for p in parameters)})"
+                f"{type_name(int(proto_ids[idx]['return_type_idx']))}"
+            )
+        return protos[idx]
+
+    symbols = []
+    for class_def in class_defs:
+        class_data_off = int(class_def["class_data_off"])
+        if not class_data_off:
+            continue
+        descriptor = type_name(int(class_def["class_idx"]))
+
+        pos = base + class_data_off
+        static_fields, pos = read_uleb128(data, pos)
+        instance_fields, pos = read_uleb128(data, pos)
+        direct_methods, pos = read_uleb128(data, pos)
+        virtual_methods, pos = read_uleb128(data, pos)
+        # Fields are (field_idx_diff, access_flags)
+        for _ in range((static_fields + instance_fields) * 2):
+            _, pos = read_uleb128(data, pos)
+        for methods_size in (direct_methods, virtual_methods):
+            method_idx = 0
+            for _ in range(methods_size):
+                method_idx_diff, pos = read_uleb128(data, pos)
+                _access_flags, pos = read_uleb128(data, pos)
+                code_off, pos = read_uleb128(data, pos)
+                method_idx += method_idx_diff
+                if not code_off:
+                    continue
+                method_id = method_ids[method_idx]
+                name = (
+                    f"{type_name(int(method_id['class_idx']))}->"
+                    f"{string(int(method_id['name_idx']))}{proto(int(method_id['proto_idx']))}"
+                )
+                symbols.append(
+                    (
+                        base + code_off,
+                        code_item_end(data, base + code_off),
+                        name,
+                        "method",
+                    )
+                )
+        symbols.append((base + class_data_off, pos, descriptor, "class"))
+
+    (map_size,) = struct.unpack_from("<L", data, base + map_off)
+    map_items = table(MAP_ITEM_DTYPE, map_size, map_off + 4)
+    map_items.sort(order="offset")
+    section_ends = np.append(map_items["offset"][1:], file_size)
+    sections = [
+        (
+            base + int(item["offset"]),
+            base + int(end),
+            MAP_ITEM_TYPES.get(int(item["type"]), f"0x{int(item['type']):04x}"),
+        )
+        for item, end in zip(map_items, section_ends)
+    ]
+    return symbols, sections
+
+
+def build_symbol_index(path: str) -> SymbolIndex:
+    """
+    Index the dex files and native libraries within a local copy of an artifact (vdex, APK, dex or native library)
+    """
+    # (starts, ends, names, kinds) arrays of each dex file and library
+    symbols = []
+    sections = []
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                library_offsets = [0] if is_elf(data) else []
+                for base in [] if library_offsets else find_dex_files(data):
+                    dex_symbols, dex_sections = parse_dex(data, base)
+                    if dex_symbols:
+                        starts, ends, names, kinds = zip(*dex_symbols)
+                        symbols.append(
+                            (
+                                np.array(starts, np.int64),
+                                np.array(ends, np.int64),
+                                np.array(names, object),
+                                np.array(kinds, object),
+                            )
+                        )
+                    sections.extend(dex_sections)
+                if not library_offsets and zipfile.is_zipfile(path):
+                    library_offsets = find_stored_libraries(path, data)
+
+                for base in library_offsets:
+                    elf_symbols, elf_sections = parse_elf(data, base)
+                    symbols.append(elf_symbols)
+                    sections.extend(elf_sections)
+
+    if symbols:
+        starts, ends, names, kinds = (
+            np.concatenate(column) for column in zip(*symbols)
+        )
+    else:
+        starts, ends = np.empty(0, np.int64), np.empty(0, np.int64)
+        names, kinds = np.empty(0, object), np.empty(0, object)
+    order = np.lexsort((ends, starts))
+    sections.sort()
+    return SymbolIndex(
+        symbol_names=names[order],
+        symbol_kinds=kinds[order],
+        symbol_starts=starts[order],
+        symbol_ends=ends[order],
+        section_names=np.array([s[2] for s in sections], dtype=object),
+        section_starts=np.array([s[0] for s in sections], dtype=np.int64),
+        section_ends=np.array([s[1] for s in sections], dtype=np.int64),
+    )
+
+
+def symbol_index_from_json(cached: Dict) -> SymbolIndex:
+    return SymbolIndex(
+        symbol_names=np.array(cached["symbol_names"], dtype=object),
+        symbol_kinds=np.array(cached["symbol_kinds"], dtype=object),
+        symbol_starts=np.array(cached["symbol_starts"], dtype=np.int64),
+        symbol_ends=np.array(cached["symbol_ends"], dtype=np.int64),
+        section_names=np.array(cached["section_names"], dtype=object),
+        section_starts=np.array(cached["section_starts"], dtype=np.int64),
+        section_ends=np.array(cached["section_ends"], dtype=np.int64),
+    )
+
+
+def symbol_index_to_json(symbol_index: SymbolIndex) -> Dict:
+    return {
+        "symbol_names": symbol_index.symbol_names.tolist(),
+        "symbol_kinds": symbol_index.symbol_kinds.tolist(),
+        "symbol_starts": symbol_index.symbol_starts.tolist(),
+        "symbol_ends": symbol_index.symbol_ends.tolist(),
+        "section_names": symbol_index.section_names.tolist(),
+        "section_starts": symbol_index.section_starts.tolist(),
+        "section_ends": symbol_index.section_ends.tolist(),
+    }
+
+
+def load_symbol_index(path: str) -> SymbolIndex:
+    """
+    Index an artifact, reusing the index cached for the same contents
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    cache_path = os.path.join(
+        get_cache_dir("symbols"),
+        f"{digest.hexdigest()}-{SYMBOL_INDEX_VERSION}.json",
+    )
+    if os.path.exists(cache_path):
+        with open(cache_path) as f:
+            return symbol_index_from_json(json.load(f))
+
+    print(f"Indexing {path}...")
+    symbol_index = build_symbol_index(path)
+    with open(f"{cache_path}.partial", "w") as f:
+        json.dump(symbol_index_to_json(symbol_index), f)
+    os.replace(f"{cache_path}.partial", cache_path)
+    return symbol_index
+
+
+def find_ranges(
+    starts: np.ndarray, ends: np.ndarray, offsets: np.ndarray
+) -> np.ndarray:
+    """
+    @returns the index of the range containing each offset or -1
+    """
+    idx = np.searchsorted(starts, offsets, side="right") - 1
+    in_range = idx >= 0
+    in_range[in_range] = offsets[in_range] < ends[idx[in_range]]
+    return np.where(in_range, idx, -1)
+
+
+def find_overlapping_ranges(
+    starts: np.ndarray, ends: np.ndarray, pages: np.ndarray, page_size: int
+) -> np.ndarray:
+    """
+    @returns whether each range overlaps one of the sorted pages
+    """
+    first_pages = starts // page_size
+    last_pages = (ends - 1) // page_size
+    idx = np.searchsorted(pages, first_pages)
+    return (idx < len(pages)) & (pages[np.minimum(idx, len(pages) - 1)] <= last_pages)
+
+
+def symbolize_faults(
+    mapped_faults: pd.DataFrame, symbol_indexes: Dict[str, SymbolIndex]
+) -> pd.DataFrame:
+    """
+    Annotate each fault with the section and the method, class or native symbol it touched
+    """
+    offsets = mapped_faults["offset"].to_numpy(dtype=np.int64)
+    sections = np.full(len(mapped_faults), "", dtype=object)
+    symbols = np.full(len(mapped_faults), "", dtype=object)
+    file_names = mapped_faults["file_name"].astype(str).to_numpy()
+    for file_name, symbol_index in symbol_indexes.items():
+        in_file = np.flatnonzero(file_names == file_name)
+        file_offsets = offsets[in_file]
+
+        section_idx = find_ranges(
+            symbol_index.section_starts, symbol_index.section_ends, file_offsets
+        )
+        found = section_idx >= 0
+        sections[in_file[found]] = symbol_index.section_names[section_idx[found]]
+
+        symbol_idx = find_ranges(
+            symbol_index.symbol_starts, symbol_index.symbol_ends, file_offsets
+        )
+        found = symbol_idx >= 0
+        symbols[in_file[found]] = symbol_index.symbol_names[symbol_idx[found]]
+
+    return mapped_faults.assign(section=sections, symbol=symbols)
+
+
+def faulted_symbols(
+    mapped_faults: pd.DataFrame,
+    symbol_indexes: Dict[str, SymbolIndex],
+    page_size: Optional[int] = None,
+) -> Tuple[Set[str], Set[str]]:
+    """
+    Find the dex methods and classes touched by the faults. With a page size, every method and class on a faulted page
+    counts as touched, which suits page cache faults that only have page granularity.
+
+    @returns the methods and classes
+    """
+    methods = set()
+    classes = set()
+    file_names = mapped_faults["file_name"].astype(str).to_numpy()
+    offsets = mapped_faults["offset"].to_numpy(dtype=np.int64)
+    for file_name, symbol_index in symbol_indexes.items():
+        file_offsets = offsets[file_names == file_name]
+        if page_size:
+            touched = find_overlapping_ranges(
+                symbol_index.symbol_starts,
+                symbol_index.symbol_ends,
+                np.unique(file_offsets // page_size),
+                page_size,
+            )
+        else:
+            symbol_idx = find_ranges(
+                symbol_index.symbol_starts, symbol_index.symbol_ends, file_offsets
+            )
+            touched = np.zeros(len(symbol_index.symbol_starts), dtype=bool)
+            touched[symbol_idx[symbol_idx >= 0]] = True
+
+        for name, kind in zip(
+            symbol_index.symbol_names[touched], symbol_index.symbol_kinds[touched]
+        ):
+            if kind == "method":
+                methods.add(name)
+                classes.add(name.split("->", 1)[0])
+            elif kind == "class":
+                classes.add(name)
+    return methods, classes
+
+
+def write_profile(path: str, methods: Set[str], classes: Set[str]):
+    """
+    Write an ART profile in the text format of baseline and startup profiles, marking methods hot and startup
+    """
+    with open(path, "w") as f:
+        for descriptor in sorted(classes):
+            f.write(f"{descriptor}\n")
+        for method in sorted(methods):
+            f.write(f"HS{method}\n")
+
+
+def read_profile_methods(path: str) -> Set[str]:
+    with open(path) as f:
+        return {
+            match.group(1)
+            for match in (PROFILE_METHOD_RE.match(line.strip()) for line in f)
+            if match
+        }
+
+
+def match_artifacts(file_names: List[str], artifacts: List[str]) -> Dict[str, str]:
+    """
+    Match local artifacts given as [SUFFIX=]PATH to the faulted files. The suffix defaults to the artifact's
+    file name since install paths differ between runs.
+
+    @returns the local path of each faulted file
+    """
+    matched = {}
+    for artifact in artifacts:
+        suffix, _, path = artifact.rpartition("=")
+        suffix = suffix or os.path.basename(path)
+        matches = [f for f in file_names if f == suffix or f.endswith(f"/{suffix}")]
+        if len(matches) != 1:
+            raise ValueError(
+                f"Expected one faulted file matching {suffix}, found: {matches or 'none'}"
+            )
+        matched[matches[0]] = path
+    return matched
+
+
+def pull_artifacts(
+    device: DeviceSession, file_names: List[str], artifact_dir: str
+) -> Dict[str, str]:
+    """
+    Pull the faulted files that can contain dex or native code. Native libraries with a build ID are shared
+    between runs.
+
+    @returns the local path of each pulled file
+    """
+    pulled = {}
+    for file_name in file_names:
+        if not file_name.endswith(ARTIFACT_EXTENSIONS):
+            continue
+        if file_name.endswith(".so"):
+            library_path = pull_library(device, file_name)
+            if library_path:
+                pulled[file_name] = library_path
+                continue
+
+        local_path = os.path.join(artifact_dir, file_name.lstrip("/"))
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        print(f"Pulling {file_name}...")
+        result = subprocess.run(
+            device.adb + ["pull", file_name, local_path], capture_output=True, text=True
+        )
+        if result.returncode != 0:
+            print(f"Failed to pull: {file_name} ({result.stderr.strip()})")
+            continue
+        pulled[file_name] = local_path
+    return pulled
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Attribute the faults of a run to the dex methods and classes and the native symbols they touched"
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="output",
+        help="Output directory of the run (default: output)",
+    )
+    parser.add_argument(
+        "--artifact",
+        type=str,
+        action="append",
+        default=[],
+        metavar="[SUFFIX=]PATH",
+        help="Local copy of a faulted vdex, APK, dex file or native library, matched to the faulted file ending with SUFFIX "
+        "(default: the file name of PATH). Can be repeated",
+    )
+    parser.add_argument(
+        "--pull",
+        action="store_true",
+        default=False,
+        help="Pull the faulted vdex, APK, dex files and native libraries from the device into <output>/artifacts "
+        "(default: false)",
+    )
+    parser.add_argument(
+        "--serial",
+        type=str,
+        help="Serial of the device to pull from when several are connected",
+    )
+    parser.add_argument(
+        "--whole-pages",
+        action="store_true",
+        default=False,
+        help="Count every method and class on a faulted page as touched, for runs with page cache faults "
+        "(default: false)",
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        help="Write the touched methods and classes as an ART startup profile (default: <output>/startup-prof.txt)",
+    )
+    parser.add_argument(
+        "--validate",
+        type=str,
+        metavar="PROFILE",
+        help="Report the touched methods missing from an existing baseline or startup profile",
+    )
+    args = parser.parse_args()
+
+    mapped_faults = load_mapped_faults(args.output)
+    file_names = sorted(mapped_faults["file_name"].astype(str).unique())
+
+    artifacts = {}
+    if args.pull:
+        with DeviceSession(args.serial) as device:
+            artifacts.update(
+                pull_artifacts(
+                    device, file_names, os.path.join(args.output, "artifacts")
+                )
+            )
+    artifacts.update(match_artifacts(file_names, args.artifact))
+    if not artifacts:
+        parser.error("Pass --artifact or --pull to provide the faulted files")
+
+    symbol_indexes = {
+        file_name: load_symbol_index(path) for file_name, path in artifacts.items()
+    }
+    for file_name, symbol_index in symbol_indexes.items():
+        print(f"{len(symbol_index.symbol_names)} symbols in {file_name}")
+
+    symbolized_path = os.path.join(args.output, "symbolized_faults.csv")
+    symbolize_faults(mapped_faults, symbol_indexes).to_csv(symbolized_path, index=False)
+    print(f"Wrote {symbolized_path}")
+
+    page_size = None
+    if args.whole_pages:
+        page_size = load_page_size(args.output)
+    methods, classes = faulted_symbols(mapped_faults, symbol_indexes, page_size)
+    profile_path = args.profile or os.path.join(args.output, "startup-prof.txt")
+    write_profile(profile_path, methods, classes)
+    print(f"Wrote {len(methods)} methods and {len(classes)} classes to {profile_path}")
+
+    if args.validate:
+        profile_methods = read_profile_methods(args.validate)
+        missing = sorted(methods - profile_methods)
+        print(
+            f"{len(methods) - len(missing)}/{len(methods)} touched methods are in {args.validate}"
+        )
+        for method in missing[:20]:
+            print(f"  missing: {method}")
+        if len(missing) > 20:
+            print(f"  ... and {len(missing) - 20} more")
+
+
+if __name__ == "__main__":
+    main()
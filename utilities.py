@@ -1,26 +1,207 @@
 import csv
-from typing import Optional
+import json
+import re
+from typing import Dict, List, Optional, Sequence, Tuple
+import numpy as np
 import pandas as pd
+import plotly.graph_objects as go
 import os
 
-# TODO: Support variable page sizes. Android will soon support 16KB pages
-PAGE_SIZE = 4096
+# Page size of runs collected before device_info.json recorded the device's page size
+DEFAULT_PAGE_SIZE = 4096
+DEVICE_INFO_FILE = "device_info.json"
 
+# Install directories of apps contain random components, e.g. /data/app/~~<random>==/<package>-<random>==/
+INSTALL_PATH_RE = re.compile(r"^/data/app/(?:~~[^/]*/)?([^/-]+)-[^/]*/")
 
-def load_mappings(output_dir: str = "output"):
+# Scatter plots with more points are rendered with WebGL and decimated
+SCATTERGL_THRESHOLD = 10000
+# Decimated scatter plots keep a single point per cell of this (x, y) grid, roughly the resolution of the plot
+DECIMATION_GRID = (1600, 1000)
+# Pages per row of first touch images
+FIRST_TOUCH_IMAGE_WIDTH = 128
+
+FAULT_STORE_DIR = "mapped_faults.store"
+# Columns stored as raw little-endian arrays
+FAULT_STORE_ARRAY_COLUMNS = {"ts": "<i8", "offset": "<i8", "is_major": "|b1"}
+# Columns stored as int32 codes into a list of categories (-1 for missing values)
+FAULT_STORE_CATEGORY_COLUMNS = [
+    "process_name",
+    "thread_name",
+    "file_name",
+    "zip_entry_name",
+]
+
+
+class FaultStoreWriter:
     """
-    Load the Fault mapping (file_name, offset) and the File Sizes (File Name, file size) from the csv files
+    Writes mapped faults to a columnar store that can be appended to in chunks.
+
+    The store is a directory with one raw array file per column and a meta.json holding the categories of the
+    dictionary-encoded columns. meta.json is written on close so incomplete stores are never read.
     """
-    mapped_faults = []
-    with open(os.path.join(output_dir, "mapped_faults.csv")) as csv_file:
-        for row in csv.DictReader(csv_file):
-            row["zip_entry_name"] = (
-                row["zip_entry_name"] if row["zip_entry_name"] else None
+
+    def __init__(self, store_dir: str, source_mtime: Optional[float] = None):
+        self.store_dir = store_dir
+        self.source_mtime = source_mtime
+        self.num_rows = 0
+        self._category_codes: Dict[str, Dict[str, int]] = {
+            column: {} for column in FAULT_STORE_CATEGORY_COLUMNS
+        }
+        os.makedirs(store_dir, exist_ok=True)
+        meta_path = os.path.join(store_dir, "meta.json")
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        for column in [*FAULT_STORE_ARRAY_COLUMNS, *FAULT_STORE_CATEGORY_COLUMNS]:
+            open(self._column_path(column), "wb").close()
+
+    def _column_path(self, column: str) -> str:
+        return os.path.join(self.store_dir, f"{column}.bin")
+
+    def _encode(self, column: str, values: Sequence) -> np.ndarray:
+        local_codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+        codes = self._category_codes[column]
+        global_codes = np.array(
+            [codes.setdefault(value, len(codes)) for value in uniques.tolist()] + [-1],
+            dtype=np.int32,
+        )
+        # Missing values are factorized to -1 which selects the trailing -1
+        return global_codes[local_codes]
+
+    def append(self, columns: Dict[str, Sequence]):
+        for column, dtype in FAULT_STORE_ARRAY_COLUMNS.items():
+            with open(self._column_path(column), "ab") as f:
+                np.asarray(columns[column], dtype=dtype).tofile(f)
+        for column in FAULT_STORE_CATEGORY_COLUMNS:
+            with open(self._column_path(column), "ab") as f:
+                self._encode(column, columns[column]).tofile(f)
+        self.num_rows += len(columns["ts"])
+
+    def close(self):
+        with open(os.path.join(self.store_dir, "meta.json"), "w") as f:
+            json.dump(
+                {
+                    "num_rows": self.num_rows,
+                    "source_mtime": self.source_mtime,
+                    "categories": {
+                        column: list(codes)
+                        for column, codes in self._category_codes.items()
+                    },
+                },
+                f,
             )
-            row["offset"] = int(row["offset"])
-            row["ts"] = int(row["ts"])
-            row["is_major"] = row["is_major"] == "True"
-            mapped_faults.append(row)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+
+
+def read_fault_store_meta(store_dir: str) -> Optional[Dict]:
+    meta_path = os.path.join(store_dir, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        return json.load(f)
+
+
+def read_fault_store(store_dir: str, meta: Dict) -> pd.DataFrame:
+    """
+    Read a store written by FaultStoreWriter into a DataFrame with categorical path and name columns
+    """
+    columns = {}
+    for column in [
+        "ts",
+        "process_name",
+        "thread_name",
+        "file_name",
+        "zip_entry_name",
+        "offset",
+        "is_major",
+    ]:
+        path = os.path.join(store_dir, f"{column}.bin")
+        if column in FAULT_STORE_ARRAY_COLUMNS:
+            columns[column] = np.fromfile(path, dtype=FAULT_STORE_ARRAY_COLUMNS[column])
+        else:
+            columns[column] = pd.Categorical.from_codes(
+                np.fromfile(path, dtype=np.int32),
+                categories=meta["categories"][column],
+            )
+    return pd.DataFrame(columns)
+
+
+def read_mapped_faults_csv(csv_path: str) -> pd.DataFrame:
+    return pd.read_csv(
+        csv_path,
+        dtype={
+            "ts": np.int64,
+            "offset": np.int64,
+            "is_major": bool,
+            **{column: "category" for column in FAULT_STORE_CATEGORY_COLUMNS},
+        },
+        keep_default_na=False,
+        na_values={"zip_entry_name": [""]},
+    )
+
+
+def load_mapped_faults(output_dir: str) -> pd.DataFrame:
+    """
+    Load the mapped faults from the columnar store, falling back to mapped_faults.csv.
+
+    CSV results are cached as a store which is invalidated when the CSV is modified
+    """
+    store_dir = os.path.join(output_dir, FAULT_STORE_DIR)
+    meta = read_fault_store_meta(store_dir)
+    if meta:
+        return read_fault_store(store_dir, meta)
+
+    csv_path = os.path.join(output_dir, "mapped_faults.csv")
+    csv_mtime = os.path.getmtime(csv_path)
+    cache_dir = os.path.join(output_dir, ".cache", FAULT_STORE_DIR)
+    meta = read_fault_store_meta(cache_dir)
+    if meta and meta["source_mtime"] == csv_mtime:
+        return read_fault_store(cache_dir, meta)
+
+    mapped_faults = read_mapped_faults_csv(csv_path)
+    try:
+        with FaultStoreWriter(cache_dir, source_mtime=csv_mtime) as writer:
+            writer.append(
+                {
+                    column: (
+                        mapped_faults[column].to_numpy()
+                        if column in FAULT_STORE_ARRAY_COLUMNS
+                        else mapped_faults[column].astype(object).to_numpy()
+                    )
+                    for column in mapped_faults.columns
+                }
+            )
+    except OSError as e:
+        print(f"Unable to cache mapped faults: {e}")
+    return mapped_faults
+
+
+def read_device_info(output_dir: str) -> Dict:
+    try:
+        with open(os.path.join(output_dir, DEVICE_INFO_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def load_page_size(output_dir: str) -> int:
+    """
+    @returns the page size of the device the run was collected on
+    """
+    return read_device_info(output_dir).get("page_size") or DEFAULT_PAGE_SIZE
+
+
+def load_mappings(output_dir: str = "output"):
+    """
+    Load the Fault mapping (file_name, offset) as a DataFrame and the File Sizes (File Name, file size) from the output directory
+    """
+    mapped_faults = load_mapped_faults(output_dir)
 
     file_sizes = []
     with open(os.path.join(output_dir, "file_sizes.csv")) as csv_file:
@@ -41,6 +222,7 @@ def extract_faults(
     file_sizes,
     mapped_faults,
     include_minor: bool = False,
+    page_size: int = DEFAULT_PAGE_SIZE,
 ):
     """
     Extract the faults mathcing the file name and optional zip entry name
@@ -62,23 +244,291 @@ def extract_faults(
     file_size = file["size"]
     file_offset = file["file_offset"]
 
-    faults = pd.DataFrame(
-        [
-            entry
-            for entry in mapped_faults
-            if entry["file_name"] == file_name
-            and (not zip_entry_name or entry["zip_entry_name"] == zip_entry_name)
-        ]
+    matches = mapped_faults["file_name"] == file_name
+    if zip_entry_name:
+        matches &= mapped_faults["zip_entry_name"] == zip_entry_name
+
+    return (
+        normalize_faults(mapped_faults[matches], include_minor, page_size),
+        file_size,
+        file_offset,
     )
 
+
+def normalize_faults(
+    faults: pd.DataFrame, include_minor: bool, page_size: int = DEFAULT_PAGE_SIZE
+) -> pd.DataFrame:
+    """
+    Convert offsets to pages, compute the delta between fault offsets and normalize timestamps
+    """
     if not include_minor:
         faults = faults[faults["is_major"]]
+    faults = faults.copy()
 
     # Compute delta between fault offsets
-    faults["offset"] = faults["offset"].div(PAGE_SIZE)
+    faults["offset"] = faults["offset"].div(page_size)
     faults["offset_diff"] = faults["offset"].diff()
 
     # Normalize timestamps
     faults["ts"] = faults["ts"] - faults["ts"].min()
     faults.reset_index(drop=True, inplace=True)
-    return faults, file_size, file_offset
+    return faults
+
+
+def normalize_install_path(file_name: str) -> str:
+    """
+    Strip the random components of an app's install directory so files can be matched across installs
+    """
+    return INSTALL_PATH_RE.sub(r"/data/app/\1/", file_name)
+
+
+def _to_cells(values: np.ndarray, num_cells: int) -> np.ndarray:
+    values = np.asarray(values, dtype=np.float64)
+    low, high = np.nanmin(values), np.nanmax(values)
+    scale = num_cells / (high - low) if high > low else 0.0
+    cells = (np.nan_to_num(values, nan=low) - low) * scale
+    return np.minimum(cells.astype(np.int64), num_cells - 1)
+
+
+def decimate(x: Sequence, y: Sequence, grid: Tuple[int, int] = DECIMATION_GRID):
+    """
+    Level of detail decimation keeping the first point in each cell of a grid spanning the points.
+    Points that would be drawn over each other are dropped while outliers are kept.
+
+    @returns the sorted positions of the kept points
+    """
+    if len(x) == 0:
+        return np.arange(0)
+    cells = _to_cells(x, grid[0]) * grid[1] + _to_cells(y, grid[1])
+    _, positions = np.unique(cells, return_index=True)
+    return np.sort(positions)
+
+
+def scatter(x: Sequence, y: Sequence, threshold: int = SCATTERGL_THRESHOLD, **kwargs):
+    """
+    Scatter trace that switches to WebGL and decimates the points past the threshold
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if len(x) <= threshold:
+        return go.Scatter(x=x, y=y, **kwargs)
+
+    positions = decimate(x, y)
+    return go.Scattergl(x=x[positions], y=y[positions], **kwargs)
+
+
+def heatmap(counts: np.ndarray, ts_edges: np.ndarray, page_edges: np.ndarray, **kwargs):
+    """
+    Heatmap trace of binned faults. Empty bins are left blank
+    """
+    return go.Heatmap(
+        x=(ts_edges[:-1] + ts_edges[1:]) / 2,
+        y=(page_edges[:-1] + page_edges[1:]) / 2,
+        z=np.where(counts > 0, counts, np.nan).T,
+        **kwargs,
+    )
+
+
+class FaultBinner:
+    """
+    Pre-aggregates the faults of a file for rendering as images instead of one marker per fault.
+
+    Faults are sorted by time once, so binning a zoomed in time range only histograms the faults within it.
+    """
+
+    def __init__(self, faults: pd.DataFrame):
+        ts = faults["ts"].to_numpy(dtype=np.float64) if len(faults) else np.array([])
+        order = np.argsort(ts, kind="stable")
+        self.ts = ts[order]
+        self.pages = (
+            faults["offset"].to_numpy(dtype=np.int64)[order]
+            if len(faults)
+            else np.array([], dtype=np.int64)
+        )
+        self.is_major = (
+            faults["is_major"].to_numpy(dtype=bool)[order]
+            if len(faults)
+            else np.array([], dtype=bool)
+        )
+        self._first_touch: Optional[np.ndarray] = None
+
+    def histogram(
+        self,
+        time_bins: int = 400,
+        page_bins: int = 400,
+        ts_range: Optional[Tuple[float, float]] = None,
+        page_range: Optional[Tuple[int, int]] = None,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Count the faults in a time x page grid
+
+        @returns the counts with shape (time_bins, page_bins), the time bin edges and the page bin edges
+        """
+        if ts_range is None:
+            ts_range = (self.ts[0], self.ts[-1]) if len(self.ts) else (0, 1)
+        if page_range is None:
+            page_range = (0, int(self.pages.max()) + 1 if len(self.pages) else 1)
+
+        start = np.searchsorted(self.ts, ts_range[0], side="left")
+        end = np.searchsorted(self.ts, ts_range[1], side="right")
+        ts = self.ts[start:end]
+        pages = self.pages[start:end]
+        in_range = (pages >= page_range[0]) & (pages < page_range[1])
+        ts, pages = ts[in_range], pages[in_range]
+
+        ts_span = max(ts_range[1] - ts_range[0], 1)
+        page_span = max(page_range[1] - page_range[0], 1)
+        ts_cells = np.minimum(
+            ((ts - ts_range[0]) * (time_bins / ts_span)).astype(np.int64), time_bins - 1
+        )
+        page_cells = np.minimum(
+            ((pages - page_range[0]) * (page_bins / page_span)).astype(np.int64),
+            page_bins - 1,
+        )
+        counts = np.bincount(
+            ts_cells * page_bins + page_cells, minlength=time_bins * page_bins
+        ).reshape(time_bins, page_bins)
+        return (
+            counts,
+            np.linspace(ts_range[0], ts_range[0] + ts_span, time_bins + 1),
+            np.linspace(page_range[0], page_range[0] + page_span, page_bins + 1),
+        )
+
+    def first_touch(self) -> np.ndarray:
+        """
+        @returns the time each page was first faulted, NaN for pages that were never faulted
+        """
+        if self._first_touch is None:
+            num_pages = int(self.pages.max()) + 1 if len(self.pages) else 0
+            first_touch = np.full(num_pages, np.nan)
+            # Faults are sorted by time so the first occurrence of a page is its first touch
+            pages, positions = np.unique(self.pages, return_index=True)
+            first_touch[pages] = self.ts[positions]
+            self._first_touch = first_touch
+        return self._first_touch
+
+    def first_touch_image(
+        self, width: int = FIRST_TOUCH_IMAGE_WIDTH, num_pages: Optional[int] = None
+    ) -> np.ndarray:
+        """
+        Lay out the first touch time of each page row by row with `width` pages per row
+
+        @returns an image with shape (rows, width)
+        """
+        first_touch = self.first_touch()
+        if num_pages is None:
+            num_pages = len(first_touch)
+        num_rows = max((num_pages + width - 1) // width, 1)
+        image = np.full(num_rows * width, np.nan)
+        image[: min(num_pages, len(first_touch))] = first_touch[:num_pages]
+        return image.reshape(num_rows, width)
+
+
+class FaultStore:
+    """
+    Indexed access to the faults of each file and zip entry of a run.
+
+    The faults of a file are located through an index built once, and normalized views are computed on first access
+    and memoized.
+    """
+
+    def __init__(
+        self,
+        mapped_faults: pd.DataFrame,
+        file_sizes: List[Dict],
+        page_size: int = DEFAULT_PAGE_SIZE,
+    ):
+        self.mapped_faults = mapped_faults
+        self.file_sizes = file_sizes
+        self.page_size = page_size
+        self._file_sizes = {
+            (file["file_name"], file["zip_entry_name"]): file for file in file_sizes
+        }
+        # (file_name, None) selects every fault of the file
+        self._positions = {
+            (file_name, None): positions
+            for file_name, positions in mapped_faults.groupby(
+                "file_name", observed=True
+            ).indices.items()
+        }
+        self._positions.update(
+            mapped_faults.groupby(
+                ["file_name", "zip_entry_name"], observed=True
+            ).indices
+        )
+        self._views: Dict[Tuple[str, Optional[str], bool], pd.DataFrame] = {}
+        self._binners: Dict[Tuple[str, Optional[str], bool], FaultBinner] = {}
+
+    @classmethod
+    def load(cls, output_dir: str = "output") -> "FaultStore":
+        return cls(*load_mappings(output_dir), load_page_size(output_dir))
+
+    def file_names(self) -> List[str]:
+        return sorted(
+            file_name
+            for file_name, zip_entry_name in self._positions
+            if not zip_entry_name
+        )
+
+    def zip_entry_names(self, file_name: str) -> List[str]:
+        return sorted(
+            zip_entry_name
+            for name, zip_entry_name in self._positions
+            if name == file_name and zip_entry_name
+        )
+
+    def extract_faults(
+        self,
+        file_name: str,
+        zip_entry_name: Optional[str] = None,
+        include_minor: bool = False,
+    ):
+        """
+        Equivalent to `extract_faults` with the views memoized
+
+        @returns a data frame with found faults, the size of the file, the offset of the zip entry within the file (applicably only if zip_entry_name is provided)
+        """
+        file = self._file_sizes.get((file_name, zip_entry_name))
+        if not file:
+            print(f"No file found: {file_name} - {zip_entry_name}")
+            return pd.DataFrame([]), None, None
+
+        return (
+            self.faults(file_name, zip_entry_name, include_minor),
+            file["size"],
+            file["file_offset"],
+        )
+
+    def faults(
+        self,
+        file_name: str,
+        zip_entry_name: Optional[str] = None,
+        include_minor: bool = False,
+    ) -> pd.DataFrame:
+        key = (file_name, zip_entry_name, include_minor)
+        view = self._views.get(key)
+        if view is None:
+            positions = self._positions.get(
+                (file_name, zip_entry_name), np.array([], dtype=np.intp)
+            )
+            view = normalize_faults(
+                self.mapped_faults.iloc[positions], include_minor, self.page_size
+            )
+            self._views[key] = view
+        return view
+
+    def binner(
+        self,
+        file_name: str,
+        zip_entry_name: Optional[str] = None,
+        include_minor: bool = True,
+    ) -> FaultBinner:
+        """
+        @returns a memoized binner of the faults, so re-binning a zoomed in range reuses its sorted index
+        """
+        key = (file_name, zip_entry_name, include_minor)
+        binner = self._binners.get(key)
+        if binner is None:
+            binner = FaultBinner(self.faults(file_name, zip_entry_name, include_minor))
+            self._binners[key] = binner
+        return binner